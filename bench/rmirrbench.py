@@ -0,0 +1,417 @@
+#! /usr/bin/env python2
+#
+# rmirrbench.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Benchmarks for rmirr.
+
+Run from the source tree:
+    python2 bench/rmirrbench.py [-o <path>] [--compare <path>] [<name> ...]
+
+Results are printed and, with -o, saved as JSON. With --compare,
+timings are compared to those of a previously saved JSON file;
+the exit value is 1 if any is slower by more than --threshold
+(a ratio; default 1.25).
+"""
+
+import atexit
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# private home so that ~/.rmirr (confcache, reports, history, ...)
+# of the user is not touched; must be set before rmirr is imported
+BENCH_HOME = tempfile.mkdtemp(prefix="rmirrbench-home-")
+os.environ["HOME"] = BENCH_HOME
+atexit.register(shutil.rmtree, BENCH_HOME, True)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "../static/lib/rmirr"))
+
+import compress
+import globls
+import mirrorindex
+import rmirr
+import rsyncstats
+
+# remote shell stub: runs the "remote" command locally so that rsync
+# uses its remote protocol (and compression) without a network
+STUB_RSH = """#! /bin/sh
+if [ "$1" = "-l" ]; then
+    shift 2
+fi
+shift
+# the remote command is run by a shell, as with ssh
+exec sh -c "$*"
+"""
+
+# synthetic source trees: name -> [(nfiles, filesize), ...]
+TREES = {
+    "huge": [(2, 64*1024*1024)],
+    "mixed": [(1000, 4*1024), (50, 256*1024), (1, 64*1024*1024)],
+    "small": [(5000, 1024)],
+}
+
+def make_conf(nmirrors, suitedepth):
+    """Generate configuration with nmirrors mirrors and suites. Each
+    suite lists mirror source paths and subpaths down to suitedepth
+    levels.
+    """
+    mirrors = make_mirrors(nmirrors)
+    rnd = random.Random(0)
+    suitesd = {}
+    for i in range(max(1, nmirrors//10)):
+        paths = []
+        for mirrord in rnd.sample(mirrors, min(len(mirrors), 10)):
+            _, _, srcpath = rmirr.userhostpath_split(mirrord["source"])
+            paths.append(os.path.join(srcpath, *["d%d" % j for j in range(rnd.randint(0, suitedepth))]))
+        suitesd["suite%04d" % i] = paths
+    return {
+        "defaults": {"email_recipients": []},
+        "mirrors": mirrors,
+        "suites": suitesd,
+    }
+
+def make_mirrors(nmirrors):
+    """Generate mirrors, one per project directory.
+    """
+    mirrors = []
+    for i in range(nmirrors):
+        mirrors.append({
+            "name": "proj%05d" % i,
+            "source": "data@home.abc.xyz:/data/group%03d/proj%05d" % (i % 100, i),
+            "destinations": ["finance.abc.xyz", "hr.abc.xyz:~/backup/proj%05d" % i],
+        })
+    return mirrors
+
+def make_paths(mirrors, npaths):
+    """Generate paths at and below mirror source paths.
+    """
+    rnd = random.Random(0)
+    paths = []
+    for _ in range(npaths):
+        mirrord = rnd.choice(mirrors)
+        _, _, srcpath = rmirr.userhostpath_split(mirrord["source"])
+        paths.append(os.path.join(srcpath, *["d%d" % rnd.randint(0, 9) for _ in range(rnd.randint(0, 4))]))
+    return paths
+
+def make_stub_rsh(dirpath):
+    path = os.path.join(dirpath, "stub-rsh")
+    with open(path, "w") as f:
+        f.write(STUB_RSH)
+    os.chmod(path, 0755)
+    return path
+
+def make_tree(rootpath, nfiles, filesize, compressible):
+    """Generate tree of nfiles files of filesize bytes, spread over
+    subdirectories. Compressible files hold repetitive text.
+    """
+    rnd = random.Random(0)
+    words = ["alpha", "beta", "gamma", "delta", "mirror", "rsync", "data", "file"]
+    for i in range(nfiles):
+        dirpath = os.path.join(rootpath, "d%03d" % (i % 100))
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        with open(os.path.join(dirpath, "f%d-%06d" % (filesize, i)), "wb") as f:
+            if compressible:
+                s = " ".join([rnd.choice(words) for _ in range(filesize//5)])
+                f.write(s[:filesize])
+            else:
+                f.write(os.urandom(filesize))
+
+def has_rsync():
+    try:
+        subprocess.call(["rsync", "--version"], stdout=open(os.devnull, "w"))
+        return True
+    except OSError:
+        sys.stderr.write("warning: rsync not found; skipping\n")
+        return False
+
+def timeit(fn, *args):
+    t0 = time.time()
+    fn(*args)
+    return time.time()-t0
+
+def bench_compress():
+    """Time a full rsync of synthetic trees (compressible text and
+    random data) through a stub remote shell for each compression
+    setting.
+    """
+    results = []
+    if not has_rsync():
+        return results
+    supported = compress.get_supported()
+    settings = ["off", "zlib:1", "zlib:6", "zstd", "zstd:1", "lz4"]
+    tmpdirpath = tempfile.mkdtemp(prefix="rmirrbench-")
+    try:
+        rsh = make_stub_rsh(tmpdirpath)
+        print "%-12s %-8s %12s %14s" % ("tree", "setting", "time (s)", "sent (bytes)")
+        for treename, compressible in [("text", True), ("random", False)]:
+            srcpath = os.path.join(tmpdirpath, treename)
+            make_tree(srcpath, 200, 256*1024, compressible)
+            for setting in settings:
+                if setting.split(":")[0] in ["zstd", "lz4"] and setting.split(":")[0] not in supported:
+                    continue
+                dstpath = os.path.join(tmpdirpath, "dst")
+                shutil.rmtree(dstpath, True)
+                cmdargs = ["rsync", "-a", "--stats", "-e", rsh] \
+                    +compress.get_args(setting, [], supported) \
+                    +[srcpath+"/", "localhost:%s" % dstpath]
+                t0 = time.time()
+                p = subprocess.Popen(cmdargs, stdout=subprocess.PIPE)
+                out = p.communicate()[0]
+                t = time.time()-t0
+                sent = rsyncstats.parse(out).get("bytes_sent")
+                print "%-12s %-8s %12.3f %14s" % (treename, setting, t, sent)
+                results.append({"case": "%s/%s" % (treename, setting), "seconds": t, "bytes_sent": sent})
+    finally:
+        shutil.rmtree(tmpdirpath, True)
+    return results
+
+def bench_conf():
+    """Time configuration handling against mirror count: load_conf()
+    (with normalization), the compiled configuration cache (cold and
+    warm), userhostpath_normalize() of all sources and destinations,
+    and expansion of all suites to their mirrors.
+    """
+    results = []
+    tmpdirpath = tempfile.mkdtemp(prefix="rmirrbench-")
+    try:
+        rmirr.setup()
+        print "%-8s %10s %10s %10s %10s %10s" % ("mirrors", "load (s)", "cold (s)", "warm (s)", "norm (s)", "suites (s)")
+        for nmirrors in [10, 100, 1000, 10000]:
+            confpath = os.path.join(tmpdirpath, "rmirr-%d.json" % nmirrors)
+            with open(confpath, "w") as f:
+                json.dump(make_conf(nmirrors, 6), f)
+
+            tload = timeit(rmirr.load_conf, confpath, True)
+            shutil.rmtree(rmirr.CONFCACHE_DIRPATH, True)
+            tcold = timeit(rmirr.load_conf_cached, confpath)
+            t0 = time.time()
+            conf, index = rmirr.load_conf_cached(confpath)
+            twarm = time.time()-t0
+
+            userhostpaths = []
+            for mirrord in conf["mirrors"]:
+                userhostpaths.append(mirrord["source"])
+                userhostpaths.extend(mirrord["destinations"])
+            tnorm = timeit(lambda: [rmirr.userhostpath_normalize(userhostpath) for userhostpath in userhostpaths])
+
+            globls.mirrors = conf["mirrors"]
+            globls.mirrorindex = index
+
+            def expand():
+                for suitename, paths in conf["suites"].items():
+                    for path in map(os.path.expanduser, paths):
+                        rmirr.find_mirror(path, globls.mirrors)
+
+            tsuites = timeit(expand)
+            print "%-8s %10.4f %10.4f %10.4f %10.4f %10.4f" % (nmirrors, tload, tcold, twarm, tnorm, tsuites)
+            results.append({"case": "mirrors=%d" % nmirrors, "load_conf": tload,
+                "load_conf_cached_cold": tcold, "load_conf_cached_warm": twarm,
+                "userhostpath_normalize": tnorm, "suite_expand": tsuites})
+    finally:
+        globls.mirrorindex = None
+        shutil.rmtree(tmpdirpath, True)
+    return results
+
+def bench_mirror():
+    """Time full do_mirror() runs of synthetic source trees (many
+    small files, few huge files, mixed) to local-path destinations
+    through a stub remote shell: an initial sync, then a no-change
+    resync.
+    """
+    results = []
+    if not has_rsync():
+        return results
+    tmpdirpath = tempfile.mkdtemp(prefix="rmirrbench-")
+    oldrsh = os.environ.get("RSYNC_RSH")
+    try:
+        rmirr.setup()
+        os.environ["RSYNC_RSH"] = make_stub_rsh(tmpdirpath)
+        globls.thisusername = rmirr.whoami()
+        globls.thishostname = "localhost"
+        globls.defaultsd = {"ssh_multiplex": False}
+        globls.mirrorindex = None
+        globls.yes = True
+
+        print "%-8s %12s %12s %14s" % ("tree", "sync (s)", "resync (s)", "total (bytes)")
+        for treename in sorted(TREES.keys()):
+            srcpath = os.path.join(tmpdirpath, "src", treename)
+            for nfiles, filesize in TREES[treename]:
+                make_tree(srcpath, nfiles, filesize, False)
+            dstpath = os.path.join(tmpdirpath, "dst", treename)
+            os.makedirs(dstpath)
+            mirrors = [{
+                "name": treename,
+                "source": "%s@localhost:%s" % (globls.thisusername, srcpath),
+                "destinations": ["localhost:%s" % dstpath],
+            }]
+            globls.mirrors = mirrors
+
+            times = []
+            for _ in range(2):
+                stdout = sys.stdout
+                sys.stdout = open(os.devnull, "w")
+                try:
+                    t0 = time.time()
+                    transfers = rmirr.do_mirror(None, srcpath, mirrors)
+                    times.append(time.time()-t0)
+                finally:
+                    sys.stdout = stdout
+                if not transfers or transfers[0]["status"] != "ok":
+                    sys.stderr.write("error: mirror failed (%s)\n" % (treename,))
+                    sys.exit(1)
+            total = (transfers[0]["stats"] or {}).get("total_size")
+            print "%-8s %12.3f %12.3f %14s" % (treename, times[0], times[1], total)
+            results.append({"case": treename, "sync": times[0], "resync": times[1], "total_size": total})
+    finally:
+        if oldrsh == None:
+            os.environ.pop("RSYNC_RSH", None)
+        else:
+            os.environ["RSYNC_RSH"] = oldrsh
+        shutil.rmtree(tmpdirpath, True)
+    return results
+
+def bench_resolve():
+    """Time find_mirror() resolution of 1000 paths against mirror
+    count, with a linear scan and with the index.
+    """
+    results = []
+    npaths = 1000
+    print "%-8s %12s %12s %12s" % ("mirrors", "linear (s)", "indexed (s)", "build (s)")
+    for nmirrors in [10, 100, 1000, 10000]:
+        mirrors = make_mirrors(nmirrors)
+        paths = make_paths(mirrors, npaths)
+        globls.mirrors = mirrors
+
+        def resolve():
+            return [rmirr.find_mirror(path, mirrors) for path in paths]
+
+        globls.mirrorindex = None
+        tlinear = timeit(resolve)
+        tbuild = timeit(lambda: setattr(globls, "mirrorindex", mirrorindex.build(mirrors, rmirr.userhostpath_split)))
+        tindexed = timeit(resolve)
+        if nmirrors <= 1000:
+            expected = resolve()
+            globls.mirrorindex = None
+            if resolve() != expected:
+                sys.stderr.write("error: indexed and linear results differ\n")
+                sys.exit(1)
+        print "%-8s %12.4f %12.4f %12.4f" % (nmirrors, tlinear, tindexed, tbuild)
+        results.append({"case": "mirrors=%d" % nmirrors, "linear": tlinear, "indexed": tindexed, "build": tbuild})
+    globls.mirrorindex = None
+    return results
+
+def compare(resultsd, oldresultsd, threshold):
+    """Print timing ratios (new/old) of results found in both and
+    return the number slower than threshold.
+    """
+    nslower = 0
+    print "== compare"
+    print "%-10s %-16s %-24s %10s %10s %8s" % ("bench", "case", "metric", "old", "new", "ratio")
+    for name in sorted(resultsd.keys()):
+        oldcasesd = dict([(d["case"], d) for d in oldresultsd.get(name, [])])
+        for d in resultsd[name]:
+            oldd = oldcasesd.get(d["case"])
+            if oldd == None:
+                continue
+            for metric in sorted(d.keys()):
+                if metric == "case" or metric in BYTES_METRICS:
+                    continue
+                old, new = oldd.get(metric), d[metric]
+                if not old or new == None:
+                    continue
+                ratio = new/old
+                flag = ""
+                if ratio > threshold:
+                    flag = " *"
+                    nslower += 1
+                print "%-10s %-16s %-24s %10.4f %10.4f %8.2f%s" % (name, d["case"], metric, old, new, ratio, flag)
+    return nslower
+
+BENCHES = {
+    "compress": bench_compress,
+    "conf": bench_conf,
+    "mirror": bench_mirror,
+    "resolve": bench_resolve,
+}
+
+# non-timing metrics
+BYTES_METRICS = ["bytes_sent", "total_size"]
+
+def print_usage():
+    print """\
+usage: rmirrbench.py [-o <path>] [--compare <path>] [--threshold <ratio>] [<name> ...]
+
+Benchmarks: %s""" % (", ".join(sorted(BENCHES.keys())),)
+
+def main():
+    args = sys.argv[1:]
+    outpath = None
+    comparepath = None
+    threshold = 1.25
+    names = []
+    while args:
+        arg = args.pop(0)
+        if arg == "--compare" and args:
+            comparepath = args.pop(0)
+        elif arg in ["-h", "--help"]:
+            print_usage()
+            sys.exit(0)
+        elif arg == "-o" and args:
+            outpath = args.pop(0)
+        elif arg == "--threshold" and args:
+            threshold = float(args.pop(0))
+        elif arg in BENCHES:
+            names.append(arg)
+        else:
+            sys.stderr.write("error: unknown benchmark or bad argument (%s)\n" % (arg,))
+            sys.exit(1)
+    names = names or sorted(BENCHES.keys())
+
+    resultsd = {}
+    for name in names:
+        print "== %s" % (name,)
+        resultsd[name] = BENCHES[name]()
+
+    if outpath:
+        with open(outpath, "w") as f:
+            json.dump({
+                "benchmarks": resultsd,
+                "hostname": platform.node(),
+                "python": platform.python_version(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }, f, indent=1, sort_keys=True)
+
+    if comparepath:
+        oldresultsd = json.load(open(comparepath)).get("benchmarks", {})
+        if compare(resultsd, oldresultsd, threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
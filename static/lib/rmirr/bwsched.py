@@ -0,0 +1,145 @@
+#! /usr/bin/env python2
+#
+# bwsched.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Bandwidth budgets shared by concurrent transfers, and time-of-day
+transfer windows.
+
+A link has a budget (KiB/s). Transfers are registered with their link
+up front, in groups run by a number of workers (slots). When a
+transfer starts it is given an equal share of the capacity not held
+by running transfers among those which can start now: the transfers
+not yet started, up to the free slots of each group. Capacity freed
+by finished transfers thus goes to those started later. rsync cannot
+change --bwlimit while running.
+"""
+
+import itertools
+import threading
+
+# link -> {"budget", "allocated", "groups": {group: [slots, unstarted, running]}}
+_linksd = {}
+_cond = threading.Condition()
+_groupids = itertools.count(1)
+
+def _drop_group(linkd, group):
+    slots, unstarted, running = linkd["groups"][group]
+    if not unstarted and not running:
+        del linkd["groups"][group]
+
+def _get_starting(linkd):
+    """Return number of transfers which can start now on the link.
+    """
+    return sum([min(unstarted, max(0, slots-running)) \
+        for slots, unstarted, running in linkd["groups"].values()])
+
+def acquire(link, group):
+    """Take a share of the link budget for a starting transfer of the
+    group. Return the share (KiB/s, at least 1).
+    """
+    with _cond:
+        linkd = _linksd[link]
+        groupl = linkd["groups"][group]
+        while True:
+            free = linkd["budget"]-linkd["allocated"]
+            share = int(free/max(1, _get_starting(linkd)))
+            if share >= 1:
+                break
+            _cond.wait()
+        linkd["allocated"] += share
+        groupl[1] = max(0, groupl[1]-1)
+        groupl[2] += 1
+        return share
+
+def in_window(windows, minute):
+    """Return True if minute of the day is in any of the windows (or
+    there are no windows).
+    """
+    if not windows:
+        return True
+    for start, end in windows:
+        if start <= end:
+            if start <= minute < end:
+                return True
+        elif minute >= start or minute < end:
+            # wraps past midnight
+            return True
+    return False
+
+def minutes_until_window(windows, minute):
+    """Return minutes until the next window opens (0 if in one).
+    """
+    if in_window(windows, minute):
+        return 0
+    return min([(start-minute) % 1440 for start, _ in windows])
+
+def parse_windows(windows):
+    """Parse list of "HH:MM-HH:MM" into list of (start, end) minutes
+    of the day.
+    """
+    l = []
+    for s in windows or []:
+        start, end = s.split("-", 1)
+        l.append((_parse_hhmm(start), _parse_hhmm(end)))
+    return l
+
+def _parse_hhmm(s):
+    hh, mm = s.strip().split(":", 1)
+    return int(hh)*60+int(mm)
+
+def new_group():
+    """Return a new group id.
+    """
+    return next(_groupids)
+
+def register(link, budget, group, slots):
+    """Register a transfer to run on link with budget (KiB/s). The
+    transfers of the group (see new_group) are run up to slots at a
+    time.
+    """
+    with _cond:
+        linkd = _linksd.setdefault(link, {"budget": budget, "allocated": 0, "groups": {}})
+        linkd["budget"] = budget
+        groupl = linkd["groups"].setdefault(group, [slots, 0, 0])
+        groupl[0] = max(1, slots)
+        groupl[1] += 1
+
+def release(link, group, share):
+    """Return the share of a finished transfer of the group.
+    """
+    with _cond:
+        linkd = _linksd[link]
+        linkd["allocated"] -= share
+        linkd["groups"][group][2] -= 1
+        _drop_group(linkd, group)
+        _cond.notify_all()
+
+def unregister(link, group):
+    """Forget a registered transfer of the group which will not be
+    started.
+    """
+    with _cond:
+        linkd = _linksd[link]
+        groupl = linkd["groups"][group]
+        groupl[1] = max(0, groupl[1]-1)
+        _drop_group(linkd, group)
+        _cond.notify_all()
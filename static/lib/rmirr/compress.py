@@ -0,0 +1,100 @@
+#! /usr/bin/env python2
+#
+# compress.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""rsync compression settings.
+
+A setting is one of: "off" (or false), "zlib" (or true), "zlib:<level>",
+"zstd", "zstd:<level>", "lz4", or "auto". zstd and lz4 are used only
+if the local rsync supports them (rsync >= 3.2); zlib is used
+otherwise.
+"""
+
+import subprocess
+import time
+
+# wire throughput (MB/s) above which compression costs more than it saves
+FAST_LINK_MB_PER_SEC = 50.0
+# sent/literal ratio above which data is considered incompressible
+INCOMPRESSIBLE_RATIO = 0.9
+# age (seconds) after which an "incompressible" ratio is measured again
+REPROBE_SECS = 7*24*3600
+
+_supported = None
+
+def choose_auto(linkstatd, supported, reprobe=REPROBE_SECS):
+    """Choose a setting from past measurements of a link: "mb_per_sec"
+    (wire throughput) and "ratio" (bytes sent/literal data when
+    compressed) measured at "ratio_time". The ratio is only measured
+    with compression on, so an "off" choice is dropped once the ratio
+    is older than reprobe seconds.
+    """
+    if not linkstatd:
+        return "zlib"
+    ratio = linkstatd.get("ratio")
+    if ratio != None and ratio > INCOMPRESSIBLE_RATIO:
+        if time.time()-linkstatd.get("ratio_time", 0) < reprobe:
+            return "off"
+        return "zstd" in supported and "zstd" or "zlib"
+    if linkstatd.get("mb_per_sec", 0) > FAST_LINK_MB_PER_SEC:
+        return "lz4" in supported and "lz4" or "off"
+    return "zstd" in supported and "zstd" or "zlib"
+
+def get_args(setting, skipsuffixes, supported):
+    """Return rsync arguments for a (non-auto) setting.
+    """
+    if setting in [None, False, "off", "none"]:
+        return []
+    if setting in [True, "on"]:
+        setting = "zlib"
+
+    choice, _, level = str(setting).partition(":")
+    if choice not in supported:
+        choice = "zlib"
+
+    args = ["-z"]
+    if choice != "zlib":
+        # only supported (and known) by rsync >= 3.2
+        args.append("--compress-choice=%s" % choice)
+    if level:
+        args.append("--compress-level=%d" % int(level))
+    if skipsuffixes:
+        args.append("--skip-compress=%s" % "/".join(skipsuffixes))
+    return args
+
+def get_supported():
+    """Return set of compression choices supported by the local rsync.
+    """
+    global _supported
+
+    if _supported == None:
+        _supported = set(["zlib"])
+        try:
+            p = subprocess.Popen(["rsync", "--version"], stdout=subprocess.PIPE, close_fds=True)
+            out = p.communicate()[0]
+            lines = out.splitlines()
+            for i, line in enumerate(lines):
+                if line.strip().startswith("Compress list:") and i+1 < len(lines):
+                    _supported.update(lines[i+1].split())
+        except:
+            pass
+    return _supported
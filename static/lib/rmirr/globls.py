@@ -22,19 +22,43 @@
 
 allowdelete = False
 conf = None
+confcache = True
 debug = False
 defaultsd = None
 destinations = None
 dry = False
 dryrsync = False
+fsjobs = 2
+fullsync = False
+healthcheck = True
+hostjobs = 2
+interactive = True
+itemize = False
+jobs = 1
+lockwait = 0
+maildigest = False
 mailreport = False
 mailto = None
+metricspath = None
+maxattempts = None
+maxruntime = None
+mirrorindex = None
 mirrors = None
 safemode = True
 showreport = False
+showtimings = False
+skipsyncedwithin = None
+stalltimeout = None
+suitejobs = 1
 suitesd = None
 thishostname = None
 thisusername = None
+timingsd = {}
 uselock = True
 verbose = False
+verify = False
+verifyfix = False
+verifysample = None
+watch = False
+windowwait = False
 yes = False
@@ -0,0 +1,111 @@
+#! /usr/bin/env python2
+#
+# health.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Destination health probes.
+
+A probe runs one short remote command on the destination host (via
+the remote shell) which reports whether rsync is available and the
+free space of the filesystem holding each of the given paths (or their
+nearest existing ancestors). The probe does not prompt: hosts which
+need a password (or an unknown host key accepted) cannot be probed
+and are reported as unknown rather than unhealthy.
+"""
+
+import os
+import os.path
+import pipes
+import signal
+import subprocess
+import threading
+
+# ssh messages of hosts needing interaction to log in
+AUTH_ERRORS = ["Permission denied", "Host key verification failed"]
+
+SCRIPT = """\
+if command -v rsync >/dev/null 2>&1; then echo RSYNC yes; else echo RSYNC no; fi
+for p in %s; do
+    q="$p"
+    while [ ! -d "$q" ]; do q=`dirname "$q"`; done
+    echo "FREE `df -Pk "$q" | tail -n 1 | awk '{print $4}'` $p"
+done
+"""
+
+def probe(rshargs, userhost, paths, timeout):
+    """Probe userhost. The probe is killed after timeout seconds.
+
+    Return dict with "reachable", "rsync" (bools), "free" (path ->
+    free KB, or None if unknown), "error" (or None) and "unknown" (why
+    the host could not be probed, or None).
+    """
+    resultd = {"reachable": False, "rsync": False, "free": {}, "error": None, "unknown": None}
+    rshargs = list(rshargs)
+    if os.path.basename(rshargs[0]) == "ssh":
+        rshargs[1:1] = ["-o", "ConnectTimeout=%d" % max(1, int(timeout)), "-o", "BatchMode=yes"]
+    script = SCRIPT % " ".join([pipes.quote(path) for path in paths])
+    cmdargs = rshargs+[userhost, script]
+
+    try:
+        devnull = open(os.devnull, "r+")
+        # own process group, to kill any children too
+        p = subprocess.Popen(cmdargs, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            close_fds=True, preexec_fn=os.setsid)
+    except OSError as e:
+        resultd["error"] = "cannot run remote shell (%s)" % (e,)
+        return resultd
+    timedout = []
+
+    def kill():
+        timedout.append(True)
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        out, err = p.communicate()
+    finally:
+        timer.cancel()
+
+    if timedout:
+        resultd["error"] = "timed out after %ss" % (timeout,)
+        return resultd
+    for line in out.splitlines():
+        if line.startswith("RSYNC "):
+            resultd["reachable"] = True
+            resultd["rsync"] = line[6:] == "yes"
+        elif line.startswith("FREE "):
+            fields = line.split(" ", 2)
+            if len(fields) == 3:
+                try:
+                    resultd["free"][fields[2]] = int(fields[1])
+                except ValueError:
+                    resultd["free"][fields[2]] = None
+    if not resultd["reachable"]:
+        for msg in AUTH_ERRORS:
+            if msg in err:
+                resultd["unknown"] = "cannot log in without interaction (%s)" % (msg,)
+                return resultd
+        resultd["error"] = "unreachable (exit %s)" % (p.returncode,)
+    return resultd
@@ -0,0 +1,189 @@
+#! /usr/bin/env python2
+#
+# lockmgr.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Lock manager for (mirror name, destination host, path) keys.
+
+Locks on keys with the same name and destination and overlapping
+paths (same, or one below the other) conflict; others do not.
+
+Each held lock is an entry file under <dirpath>/held which its holder
+keeps locked (fcntl); an entry which can be locked by another process
+belongs to a dead holder and is removed. The entries are examined and
+changed only under the table lock (<dirpath>/table.lock). Within a
+process, locks on the same key are shared (reference counted) and
+locks on overlapping keys are taken in turn, waiting as for locks of
+other processes.
+"""
+
+import fcntl
+import json
+import os
+import os.path
+import socket
+import threading
+import time
+
+POLL_INTERVAL = 0.5
+
+# key -> [fd, entrypath, count]; this process' locks
+_heldd = {}
+_mutex = threading.Lock()
+_released = threading.Condition(_mutex)
+_seq = [0]
+
+def _lock_table(dirpath):
+    fd = os.open(os.path.join(dirpath, "table.lock"), os.O_CREAT|os.O_WRONLY)
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+def _is_stale(entrypath):
+    """Return True if the holder of entry is gone.
+    """
+    try:
+        fd = os.open(entrypath, os.O_RDWR)
+    except OSError:
+        return True
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+    except IOError:
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+def acquire(dirpath, key, timeout):
+    """Acquire lock on key (name, dsthost, path), waiting up to timeout
+    seconds (0 to not wait, None to wait indefinitely).
+
+    Return seconds waited, or None if not acquired.
+    """
+    helddirpath = os.path.join(dirpath, "held")
+    if not os.path.exists(helddirpath):
+        try:
+            os.mkdir(helddirpath)
+        except OSError:
+            pass
+
+    t0 = time.time()
+    while True:
+        with _mutex:
+            # wait for overlapping locks of this process
+            while key not in _heldd \
+                and [heldkey for heldkey in _heldd if overlaps(key, heldkey)]:
+                if timeout == None:
+                    _released.wait()
+                else:
+                    remaining = timeout-(time.time()-t0)
+                    if remaining <= 0:
+                        return None
+                    _released.wait(remaining)
+            if key in _heldd:
+                _heldd[key][2] += 1
+                return time.time()-t0
+
+            tablefd = _lock_table(dirpath)
+            try:
+                if not get_conflicts(dirpath, key):
+                    _seq[0] += 1
+                    entrypath = os.path.join(helddirpath, "%s.%s.%s" % (socket.gethostname(), os.getpid(), _seq[0]))
+                    fd = os.open(entrypath, os.O_CREAT|os.O_RDWR|os.O_TRUNC, 0644)
+                    fcntl.lockf(fd, fcntl.LOCK_EX)
+                    os.write(fd, json.dumps({
+                        "name": key[0],
+                        "dsthost": key[1],
+                        "path": key[2],
+                        "host": socket.gethostname(),
+                        "pid": os.getpid(),
+                        "started": time.time(),
+                    }))
+                    _heldd[key] = [fd, entrypath, 1]
+                    return time.time()-t0
+            finally:
+                os.close(tablefd)
+
+        waited = time.time()-t0
+        if timeout != None and waited >= timeout:
+            return None
+        time.sleep(timeout == None and POLL_INTERVAL or min(POLL_INTERVAL, timeout-waited))
+
+def get_conflicts(dirpath, key):
+    """Return list of entries (dicts) of live locks of other processes
+    conflicting with key. Stale entries are removed. The table lock
+    must be held.
+    """
+    ownpaths = [heldl[1] for heldl in _heldd.values()]
+    conflicts = []
+    helddirpath = os.path.join(dirpath, "held")
+    for filename in os.listdir(helddirpath):
+        entrypath = os.path.join(helddirpath, filename)
+        if entrypath in ownpaths:
+            continue
+        try:
+            entryd = json.load(open(entrypath))
+        except:
+            entryd = None
+        if entryd and not overlaps(key, (entryd["name"], entryd["dsthost"], entryd["path"])):
+            continue
+        if _is_stale(entrypath):
+            try:
+                os.remove(entrypath)
+            except OSError:
+                pass
+            continue
+        if entryd:
+            conflicts.append(entryd)
+    return conflicts
+
+def overlaps(key, otherkey):
+    """Return True if keys conflict.
+    """
+    name, dsthost, path = key
+    othername, otherdsthost, otherpath = otherkey
+    if name != othername or dsthost != otherdsthost:
+        return False
+    path = path.rstrip("/")+"/"
+    otherpath = otherpath.rstrip("/")+"/"
+    return path.startswith(otherpath) or otherpath.startswith(path)
+
+def release(dirpath, key):
+    """Release lock on key.
+    """
+    with _mutex:
+        heldl = _heldd.get(key)
+        if heldl == None:
+            return
+        heldl[2] -= 1
+        if heldl[2] > 0:
+            return
+        del _heldd[key]
+        tablefd = _lock_table(dirpath)
+        try:
+            os.remove(heldl[1])
+            os.close(heldl[0])
+        finally:
+            os.close(tablefd)
+        _released.notify_all()
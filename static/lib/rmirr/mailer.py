@@ -0,0 +1,105 @@
+#! /usr/bin/env python2
+#
+# mailer.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Background mail sender.
+
+Messages are queued and sent by one thread over a single SMTP
+connection which is reused for all messages (and reopened if the
+server drops it), so that callers never wait on the mail server.
+Send failures are logged and printed, as the caller no longer sees
+them.
+"""
+
+import logging
+import Queue
+import smtplib
+import threading
+
+_queue = Queue.Queue()
+_mutex = threading.Lock()
+_thread = [None]
+
+def _connect(host, port):
+    return smtplib.SMTP(host, port)
+
+def _error(logger, recipients, e):
+    logger.error("cannot send mail to (%s): %s" % (", ".join(recipients), e))
+    print "error: failed to send mail to (%s): %s" % (", ".join(recipients), e)
+
+def _run():
+    logger = logging.getLogger()
+    conn = None
+    connkey = None
+    while True:
+        item = _queue.get()
+        if item == None:
+            break
+        host, port, sender, recipients, text = item
+        for tries in range(2):
+            try:
+                if conn == None or connkey != (host, port):
+                    if conn != None:
+                        try:
+                            conn.quit()
+                        except Exception:
+                            pass
+                    conn, connkey = _connect(host, port), (host, port)
+                conn.sendmail(sender, recipients, text)
+                logger.info("mail sent to (%s)" % (", ".join(recipients),))
+                break
+            except smtplib.SMTPServerDisconnected as e:
+                # idle connection dropped; reconnect once
+                conn = None
+                if tries:
+                    _error(logger, recipients, e)
+            except Exception as e:
+                _error(logger, recipients, e)
+                conn = None
+                break
+    if conn != None:
+        try:
+            conn.quit()
+        except Exception:
+            pass
+
+def close(timeout=None):
+    """Send all queued messages and stop the sender, waiting up to
+    timeout seconds (None to wait until done).
+    """
+    with _mutex:
+        th = _thread[0]
+        if th == None:
+            return
+        _queue.put(None)
+        _thread[0] = None
+    th.join(timeout)
+
+def send(host, port, sender, recipients, text):
+    """Queue message for sending.
+    """
+    with _mutex:
+        if _thread[0] == None:
+            th = _thread[0] = threading.Thread(target=_run)
+            th.daemon = True
+            th.start()
+        _queue.put((host, port, sender, recipients, text))
@@ -0,0 +1,80 @@
+#! /usr/bin/env python2
+#
+# manifest.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Manifest of a source tree: relative path -> (size, mtime, inode).
+
+Manifests are stored with marshal (compact and fast to load).
+"""
+
+import marshal
+import os
+import os.path
+import tempfile
+
+def diff(oldentries, newentries):
+    """Return (changed, deleted) relative paths between two sets of
+    entries. Changed includes new entries.
+    """
+    changed = [relpath for relpath, v in newentries.iteritems() if oldentries.get(relpath) != v]
+    deleted = [relpath for relpath in oldentries if relpath not in newentries]
+    changed.sort()
+    deleted.sort()
+    return changed, deleted
+
+def load(path):
+    """Load manifest. Return dict with "entries" and "full_sweep"
+    (time of last full sync), or None.
+    """
+    try:
+        with open(path, "rb") as f:
+            return marshal.load(f)
+    except:
+        return None
+
+def save(path, entries, full_sweep):
+    """Save manifest atomically.
+    """
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump({"entries": entries, "full_sweep": full_sweep}, f)
+        os.rename(tmppath, path)
+    except:
+        os.remove(tmppath)
+        raise
+
+def scan(rootpath):
+    """Scan tree under rootpath. Return dict of relative path ->
+    (size, mtime, inode) for all entries (directories included).
+    """
+    entries = {}
+    prefixlen = len(rootpath.rstrip("/"))+1
+    for dirpath, dirnames, filenames in os.walk(rootpath):
+        for name in dirnames+filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            entries[path[prefixlen:]] = (st.st_size, st.st_mtime, st.st_ino)
+    return entries
@@ -0,0 +1,126 @@
+#! /usr/bin/env python2
+#
+# metrics.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Prometheus textfile exporter.
+
+Samples are kept in the textfile itself (the format node_exporter's
+textfile collector reads): each update reads the file back, replaces
+gauges, adds to counters, and rewrites it atomically, under a lock
+so that concurrent rmirr processes do not lose updates.
+"""
+
+import fcntl
+import os
+import os.path
+import re
+import tempfile
+import threading
+
+# (name, type, help)
+METRICS = [
+    ("rmirr_bytes_transferred", "gauge", "Bytes sent and received by the last run."),
+    ("rmirr_failures_total", "counter", "Failed runs."),
+    ("rmirr_files_changed", "gauge", "Files transferred by the last run."),
+    ("rmirr_last_run_success", "gauge", "1 if the last run succeeded, 0 otherwise."),
+    ("rmirr_last_run_timestamp_seconds", "gauge", "End time of the last run."),
+    ("rmirr_lock_wait_seconds", "gauge", "Time the last run waited for its lock."),
+    ("rmirr_phase_duration_seconds", "gauge", "Time spent in each phase of the last run."),
+    ("rmirr_run_duration_seconds", "gauge", "Duration of the last run."),
+    ("rmirr_runs_total", "counter", "Runs."),
+]
+
+LABELS_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+SAMPLE_RE = re.compile(r"^(\w+)(?:\{(.*)\})?\s+(\S+)")
+
+_mutex = threading.Lock()
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _unescape(value):
+    return re.sub(r"\\(.)", lambda m: m.group(1) == "n" and "\n" or m.group(1), value)
+
+def format(samplesd):
+    """Format samples ((name, labels) -> value; labels is a sorted
+    tuple of (key, value)) in the text exposition format.
+    """
+    lines = []
+    for name, typ, help in METRICS:
+        keys = sorted([key for key in samplesd if key[0] == name])
+        if not keys:
+            continue
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, typ))
+        for key in keys:
+            labels = ",".join(['%s="%s"' % (k, _escape(v)) for k, v in key[1]])
+            lines.append("%s{%s} %s" % (name, labels, repr(float(samplesd[key]))))
+    return "\n".join(lines)+"\n"
+
+def get_key(name, **labels):
+    """Return sample key for metric name and labels.
+    """
+    return (name, tuple(sorted(labels.items())))
+
+def load(path):
+    """Load samples from textfile. Return dict (empty if missing).
+    """
+    samplesd = {}
+    try:
+        f = open(path)
+    except IOError:
+        return samplesd
+    with f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            m = SAMPLE_RE.match(line)
+            if m:
+                labels = [(k, _unescape(v)) for k, v in LABELS_RE.findall(m.group(2) or "")]
+                samplesd[(m.group(1), tuple(sorted(labels)))] = float(m.group(3))
+    return samplesd
+
+def update(path, setd, incd):
+    """Update textfile: set gauge samples in setd and add to counter
+    samples in incd (both dicts of key (see get_key) -> value).
+    """
+    with _mutex:
+        with open(path+".lock", "a") as lockf:
+            fcntl.lockf(lockf, fcntl.LOCK_EX)
+            samplesd = load(path)
+            samplesd.update(setd)
+            for key, value in incd.items():
+                samplesd[key] = samplesd.get(key, 0)+value
+
+            # rename so that the collector never sees a partial file
+            fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".rmirr-metrics")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(format(samplesd))
+                os.chmod(tmppath, 0644)
+                os.rename(tmppath, path)
+            except:
+                try:
+                    os.remove(tmppath)
+                except OSError:
+                    pass
+                raise
@@ -0,0 +1,79 @@
+#! /usr/bin/env python2
+#
+# mirrorindex.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Index of mirrors for lookup by name and by longest source path
+prefix.
+
+The index is made of plain lists/dicts (mirrors referred to by their
+position in the mirrors list) so that it can be pickled, with the
+configuration, in the configuration cache (~/.rmirr/confcache).
+"""
+
+def build(mirrors, splitfn):
+    """Build index for (normalized) mirrors. splitfn splits a
+    userhostpath into (user, host, path).
+
+    Path trie nodes are [mirror position or None, {component: node}].
+    Where mirrors share a name or source path, the first one wins.
+    """
+    names = {}
+    trie = [None, {}]
+    for i, mirrord in enumerate(mirrors):
+        name = mirrord.get("name")
+        if name != None and name not in names:
+            names[name] = i
+
+        _, _, srcpath = splitfn(mirrord["source"])
+        if srcpath == None:
+            continue
+        node = trie
+        for comp in srcpath.split("/"):
+            node = node[1].setdefault(comp, [None, {}])
+        if node[0] == None:
+            node[0] = i
+    return {"names": names, "trie": trie}
+
+def find(index, path):
+    """Return (srcpath, position) of the mirror with the longest
+    source path which is path or a parent of path. Return ("", None)
+    if there is no match.
+    """
+    best = None
+    bestdepth = 0
+    comps = path.split("/")
+    node = index["trie"]
+    for depth, comp in enumerate(comps):
+        node = node[1].get(comp)
+        if node == None:
+            break
+        if node[0] != None:
+            best = node[0]
+            bestdepth = depth+1
+    if best == None:
+        return "", None
+    return "/".join(comps[:bestdepth]), best
+
+def get(index, name):
+    """Return position of mirror by name, or None.
+    """
+    return index["names"].get(name)
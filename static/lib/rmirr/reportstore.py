@@ -0,0 +1,251 @@
+#! /usr/bin/env python2
+#
+# reportstore.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Report store.
+
+Finished reports are compressed ("gzip", "zstd" or "off"; zstd
+requires the zstd program and falls back to gzip), indexed (one JSON
+line per report in INDEX_FILENAME), and pruned by age, count and
+total size. Reports are read back transparently and can be
+summarized (head/tail) without loading them whole.
+"""
+
+import collections
+import fcntl
+import gzip
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import threading
+import time
+
+CHUNK_SIZE = 1024*1024
+INDEX_FILENAME = "index.jsonl"
+SUFFIXES = {
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+
+_has_zstd = None
+_mutex = threading.Lock()
+
+def get_stem(path):
+    """Return path without report/record suffixes.
+    """
+    for suffix in SUFFIXES.values()+[".txt", ".json"]:
+        if path.endswith(suffix):
+            path = path[:-len(suffix)]
+    return path
+
+def _has_zstd_program():
+    global _has_zstd
+
+    if _has_zstd == None:
+        try:
+            subprocess.call(["zstd", "--version"], stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+            _has_zstd = True
+        except OSError:
+            _has_zstd = False
+    return _has_zstd
+
+def _lock(dirpath):
+    """Acquire the store lock (threads and processes). Return lock
+    file object for _unlock().
+    """
+    _mutex.acquire()
+    try:
+        f = open(os.path.join(dirpath, INDEX_FILENAME+".lock"), "a")
+        fcntl.lockf(f, fcntl.LOCK_EX)
+    except:
+        _mutex.release()
+        raise
+    return f
+
+def _unlock(f):
+    try:
+        f.close()
+    finally:
+        _mutex.release()
+
+def add(dirpath, entryd):
+    """Add entry (at least "report_path") to the index.
+    """
+    lockf = _lock(dirpath)
+    try:
+        with open(os.path.join(dirpath, INDEX_FILENAME), "a") as f:
+            f.write(json.dumps(entryd, sort_keys=True)+"\n")
+    finally:
+        _unlock(lockf)
+
+def compress(path, method):
+    """Compress report file with method, removing the original. Return
+    new path (the original path if not compressed).
+    """
+    if method in [None, False, "off", "none"]:
+        return path
+    if method == "zstd" and not _has_zstd_program():
+        method = "gzip"
+    if method not in SUFFIXES:
+        raise Exception("unknown report compression (%s)" % (method,))
+
+    newpath = path+SUFFIXES[method]
+    tmppath = newpath+".tmp"
+    try:
+        if method == "zstd":
+            subprocess.check_call(["zstd", "-q", "-f", "-o", tmppath, path])
+        else:
+            with open(path, "rb") as f:
+                gf = gzip.open(tmppath, "wb")
+                try:
+                    shutil.copyfileobj(f, gf, CHUNK_SIZE)
+                finally:
+                    gf.close()
+        os.rename(tmppath, newpath)
+    except:
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+        raise
+    os.remove(path)
+    return newpath
+
+def find(dirpath, name=None, dsthost=None, limit=None):
+    """Return index entries (oldest first) matching name and dsthost,
+    the last limit of them if given.
+    """
+    entries = []
+    for entryd in load_index(dirpath):
+        if (name == None or entryd.get("name") == name) \
+            and (dsthost == None or entryd.get("dsthost") == dsthost):
+            entries.append(entryd)
+    if limit:
+        entries = entries[-limit:]
+    return entries
+
+def load_index(dirpath):
+    """Return list of index entries for reports which still exist.
+    """
+    entries = []
+    try:
+        f = open(os.path.join(dirpath, INDEX_FILENAME))
+    except IOError:
+        return entries
+    with f:
+        for line in f:
+            try:
+                entryd = json.loads(line)
+            except ValueError:
+                continue
+            if os.path.exists(entryd.get("report_path", "")):
+                entries.append(entryd)
+    return entries
+
+def open_report(path):
+    """Open report (compressed or not) for reading lines.
+    """
+    if path.endswith(SUFFIXES["gzip"]):
+        return gzip.open(path, "rb")
+    if path.endswith(SUFFIXES["zstd"]):
+        p = subprocess.Popen(["zstd", "-q", "-d", "-c", path], stdout=subprocess.PIPE, close_fds=True)
+        return p.stdout
+    return open(path, "rb")
+
+def prune(dirpath, maxage, maxcount, maxbytes):
+    """Remove oldest reports (and their records) so that none is older
+    than maxage seconds, at most maxcount remain, and they total at
+    most maxbytes. A limit of None is not applied. Reports not in the
+    index (e.g., older ones) are included. The index is rewritten
+    with the remaining reports.
+
+    Return number of reports removed.
+    """
+    lockf = _lock(dirpath)
+    try:
+        # group report and record files by stem
+        groupsd = {}
+        for filename in os.listdir(dirpath):
+            if filename.startswith(INDEX_FILENAME) or filename.endswith(".tmp"):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            groupd = groupsd.setdefault(get_stem(path), {"mtime": 0, "size": 0, "paths": []})
+            groupd["mtime"] = max(groupd["mtime"], st.st_mtime)
+            groupd["size"] += st.st_size
+            groupd["paths"].append(path)
+
+        # newest first
+        groups = sorted(groupsd.values(), key=lambda groupd: -groupd["mtime"])
+        now = time.time()
+        total = 0
+        nremoved = 0
+        for i, groupd in enumerate(groups):
+            total += groupd["size"]
+            if (maxage != None and now-groupd["mtime"] > maxage) \
+                or (maxcount != None and i >= maxcount) \
+                or (maxbytes != None and total > maxbytes):
+                for path in groupd["paths"]:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                nremoved += 1
+
+        if nremoved:
+            entries = load_index(dirpath)
+            indexpath = os.path.join(dirpath, INDEX_FILENAME)
+            tmppath = indexpath+".tmp"
+            with open(tmppath, "w") as f:
+                for entryd in entries:
+                    f.write(json.dumps(entryd, sort_keys=True)+"\n")
+            os.rename(tmppath, indexpath)
+    finally:
+        _unlock(lockf)
+    return nremoved
+
+def summarize(path, nhead, ntail):
+    """Read report, keeping only the first nhead and last ntail lines.
+
+    Return (headlines, taillines, nlines, nbytes).
+    """
+    headlines = []
+    taillines = collections.deque(maxlen=ntail)
+    nlines = 0
+    nbytes = 0
+    f = open_report(path)
+    try:
+        for line in f:
+            nlines += 1
+            nbytes += len(line)
+            if len(headlines) < nhead:
+                headlines.append(line)
+            else:
+                taillines.append(line)
+    finally:
+        f.close()
+    return headlines, list(taillines), nlines, nbytes
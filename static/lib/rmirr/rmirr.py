@@ -21,265 +21,668 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 # GPL--end
 
+import cPickle
 import datetime
-import fcntl
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import os.path
+import pipes
 import pwd
-import smtplib
+import Queue
+import random
+import shlex
+import shutil
+import signal
 import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import types
 
+import bwsched
+import compress
 import globls
-
+import health
+import lockmgr
+import mailer
+import manifest
+import metrics
+import mirrorindex
+import reportstore
+import rsyncstats
+import rundb
+import shard
+import sshmux
+import stall
+import verify
+import watch
+
+BATCHES_DIRPATH = os.path.expanduser("~/.rmirr/batches")
+CONFCACHE_DIRPATH = os.path.expanduser("~/.rmirr/confcache")
+CONFCACHE_VERSION = 1
+DURATIONS_FILEPATH = os.path.expanduser("~/.rmirr/durations.json")
 HISTORY_FILEPATH = os.path.expanduser("~/.rmirr/history.log")
+IDLE_FILEPATH = os.path.expanduser("~/.rmirr/idle.json")
+LINKSTATS_FILEPATH = os.path.expanduser("~/.rmirr/linkstats.json")
+LINKSTATS_MIN_BYTES = 10*1000*1000
 LOCKS_DIRPATH = os.path.expanduser("~/.rmirr/locks")
+MANIFESTS_DIRPATH = os.path.expanduser("~/.rmirr/manifests")
+PLAN_VERSION = 1
 REPORTS_DIRPATH = os.path.expanduser("~/.rmirr/reports")
+RETRY_EXIT_CODES = [10, 12, 23, 30, 35]
 RMIRR_DIRPATH = os.path.expanduser("~/.rmirr")
+RUN_TIMING_PHASES = ["conf", "resolve", "health", "mail"]
+RUNDB_FILEPATH = os.path.expanduser("~/.rmirr/runs.sqlite")
+SHARDS_DIRPATH = os.path.expanduser("~/.rmirr/shards")
+SSH_DIRPATH = os.path.expanduser("~/.rmirr/ssh")
+STALL_EXIT_CODE = 30
+TIMING_PHASES = ["lock", "plan", "ssh", "filelist", "transfer", "wait", "report", "mail"]
+VERIFY_DIRPATH = os.path.expanduser("~/.rmirr/verify")
 
 class RmirrException(Exception):
     pass
 
-def do_mirror(mirrorname, mirrorpath, mirrors):
-    if mirrorname:
-        mirrord = get_mirror(mirrorname)
-        if not mirrord:
-            sys.stderr.write("error: cannot find mirror name\n")
-            return
-        mirrors = [mirrord]
-
-    bestsrcpath, bestmirrord = find_mirror(mirrorpath, mirrors)
-    if bestsrcpath == "":
-        sys.stderr.write("error: no match\n")
+_digestd = {}
+_digest_mutex = threading.Lock()
+_healthd = {}
+_health_mutex = threading.Lock()
+# source scans shared by transfers of this run: mirrorpath -> entries
+_scansd = {}
+_scans_mutex = threading.Lock()
+_shardsd = {}
+_shards_mutex = threading.Lock()
+
+# serializes console output of parallel transfers
+_console_lock = threading.Lock()
+
+def acquire_lock(transferd):
+    """Acquire lock on (mirror name, destination host, mirror path)
+    for the transfer, waiting up to --lock-wait seconds. Transfers of
+    other paths not overlapping it or to other destinations are not
+    blocked. The time waited is recorded ("lock_wait"). Return True on
+    success.
+    """
+    if not globls.uselock:
+        logger.info("bypassing lock (%s)" % transferd["name"])
+        return True
+
+    key = get_lock_key(transferd)
+    if globls.lockwait != 0:
+        log_transfer(transferd, "waiting for lock (%s)" % (":".join(key),))
+    waited = lockmgr.acquire(LOCKS_DIRPATH, key, globls.lockwait)
+    if waited == None:
+        sys.stdout.write("error: cannot get lock for (%s)\n" % (transferd["dstuserhostpath"],))
+        log_transfer(transferd, "cannot get lock (%s)" % (":".join(key),))
+        return False
+    transferd["lock_wait"] = round(waited, 3)
+    log_transfer(transferd, "obtained lock (%s) wait=%.3f" % (":".join(key), waited))
+    return True
+
+def add_timing(timingsd, phase, started):
+    """Add time since started to phase in timingsd.
+    """
+    timingsd[phase] = round(timingsd.get(phase, 0)+time.time()-started, 3)
+
+def check_health(transfers):
+    """Probe the destination hosts of transfers concurrently (one
+    probe per host, "health_timeout" seconds, default 10) for
+    reachability, rsync, and free space at the destination paths
+    ("health_min_free_mb", default 100). Transfers to unhealthy
+    destinations are marked "unhealthy" and not run. Hosts which cannot
+    be probed without interaction are assumed healthy. Results are kept
+    (e.g., for a whole suite run) so hosts and paths are probed once,
+    until expire_health() is called. Relayed transfers are not probed
+    (their relay is).
+    Mirrors may set "health_check" to false.
+    """
+    if not globls.healthcheck:
         return
-    else:
-        if globls.debug:
-            print "debug: bestsrcpath (%s)" % (bestsrcpath,)
-            print "debug: bestmirrord (%s)" % (bestmirrord,)
 
-        cmdargs = ["rsync", "-avz"]
-
-        # name
-        name = bestmirrord.get("name", None)
-        comment = bestmirrord.get("comment", None)
-
-        if globls.mailto:
-            email_recipients = globls.mailto
+    probeds = []
+    needd = {}
+    with _health_mutex:
+        for transferd in transfers:
+            mirrord = transferd["mirrord"]
+            if transferd["relay"] or transferd["status"] != "pending" \
+                or not mirrord.get("health_check", globls.defaultsd.get("health_check", True)):
+                continue
+            userhost = "%s@%s" % (transferd["dstuser"], transferd["dsthost"])
+            resultd = _healthd.get(userhost)
+            if resultd and (resultd["error"] or not resultd["rsync"] or transferd["dstpath"] in resultd["free"]):
+                continue
+            needd.setdefault(userhost, [])
+            if transferd["dstpath"] not in needd[userhost]:
+                needd[userhost].append(transferd["dstpath"])
+
+    if needd:
+        started = time.time()
+        timeout = float(globls.defaultsd.get("health_timeout", 10))
+        rshargs = shlex.split(os.environ.get("RSYNC_RSH", "ssh"))
+        userhosts = sorted(needd.keys())
+        logger.info("health: probing %s" % (" ".join(userhosts),))
+        results = run_pool(lambda userhost: health.probe(rshargs, userhost, needd[userhost], timeout),
+            userhosts, len(userhosts))
+        with _health_mutex:
+            for userhost, resultd in zip(userhosts, results):
+                resultd = resultd or {"reachable": False, "rsync": False, "free": {}, "error": "probe failed", "unknown": None}
+                if userhost in _healthd and not resultd["error"]:
+                    _healthd[userhost]["free"].update(resultd["free"])
+                else:
+                    _healthd[userhost] = resultd
+        add_timing(globls.timingsd, "health", started)
+
+    for transferd in transfers:
+        mirrord = transferd["mirrord"]
+        userhost = "%s@%s" % (transferd["dstuser"], transferd["dsthost"])
+        resultd = _healthd.get(userhost)
+        if transferd["relay"] or transferd["status"] != "pending" or resultd == None:
+            continue
+        minfree = float(mirrord.get("health_min_free_mb", globls.defaultsd.get("health_min_free_mb", 100)))
+        free = resultd["free"].get(transferd["dstpath"])
+        if resultd.get("unknown"):
+            log_transfer(transferd, "health: unknown (%s); not checked" % (resultd["unknown"],))
+            continue
+        elif resultd["error"]:
+            reason = resultd["error"]
+        elif not resultd["rsync"]:
+            reason = "rsync not found"
+        elif free != None and free*1024 < minfree*1000000:
+            reason = "low free space (%d MB)" % (free*1024/1000000,)
         else:
-            email_recipients = bestmirrord.get("email_recipients", globls.defaultsd.get("email_recipients", None))
-            if type(email_recipients) != types.ListType:
-                email_recipients = []
-
-        # excludes
-        excludes = bestmirrord.get("excludes", [])
-        for s in excludes:
-            cmdargs.append("--exclude=%s" % s)
-
-        # delete
-        if globls.allowdelete:
-            cmdargs.append("--delete")
-
-        # dry run
-        if globls.dryrsync:
-            cmdargs.append("--dry-run")
-
-        # validate source
-        relpath = mirrorpath[len(bestsrcpath)+1:]
-        if globls.safemode:
-            if mirrorpath != bestsrcpath:
-                if mirrorpath[len(bestsrcpath)] != "/" or relpath.startswith("/"):
-                    print "warning: unexpected values for bestsrcpath (%s) and relpath (%s)" % (bestsrcpath, relpath)
-                    reply = raw_input("continue (y/n)? ")
-                    if reply not in ["y"]:
-                        return
-
-        srcuserhostpath = bestmirrord["source"]
-        srcuser, srchost, srcpath = userhostpath_split(srcuserhostpath)
-
-        srcpath = mirrorpath
-        if not os.path.exists(mirrorpath):
-            print "warning: skipping path (%s); does not exist on source" % (mirrorpath,)
-            return
-
-        if os.path.isdir(mirrorpath):
-            srcpath += "/"
-        srcuserhostpath = "%s@%s:%s" % (globls.thisusername, globls.thishostname, srcpath)
-        if globls.debug:
-            print "debug: new srcuserhostpath (%s)" % (srcuserhostpath,)
+            continue
+        transferd["status"] = "unhealthy"
+        transferd["health"] = reason
+        sys.stdout.write("warning: skipping unhealthy destination (%s): %s\n" % (transferd["dstuserhostpath"], reason))
+        log_transfer(transferd, "health: unhealthy (%s); skipping" % (reason,), logging.WARNING)
+
+def coalesce_paths(mirrorname, mirrorpaths, mirrors):
+    """Resolve mirror paths to mirrors and coalesce them: paths covered
+    by another (same or ancestor) path of the same mirror are dropped,
+    and remaining paths of the same mirror are merged into one entry
+    for their common ancestor directory with the paths (relative to
+    it) to sync with --files-from.
+
+    Return (entries, dropped): entry dicts ("name", "mirrorpath",
+    "files" (None for the whole path), "covers"), and dicts ("path",
+    "reason") of paths not planned.
+    """
+    groupsd = {}
+    names = []
+    dropped = []
+    for path in mirrorpaths:
+        path = os.path.normpath(path)
+        if mirrorname:
+            mirrord = get_mirror(mirrorname)
+        else:
+            _, mirrord = find_mirror(path, mirrors)
+        if not mirrord:
+            dropped.append({"path": path, "reason": "no matching mirror"})
+            continue
+        if mirrord["name"] not in groupsd:
+            groupsd[mirrord["name"]] = []
+            names.append(mirrord["name"])
+        groupsd[mirrord["name"]].append(path)
+
+    entries = []
+    for name in names:
+        kept = []
+        for path in sorted(groupsd[name], key=len):
+            for keptpath in kept:
+                if path == keptpath or path.startswith(keptpath.rstrip("/")+"/"):
+                    dropped.append({"path": path, "reason": "covered by %s" % (keptpath,)})
+                    break
+            else:
+                kept.append(path)
+        kept.sort()
+
+        if len(kept) == 1:
+            entries.append({"name": name, "mirrorpath": kept[0], "files": None, "covers": kept})
+            continue
+
+        # common ancestor directory (by components)
+        common = os.path.dirname(os.path.commonprefix([path.rstrip("/")+"/" for path in kept]))
+        entries.append({
+            "name": name,
+            "mirrorpath": common or "/",
+            "files": [path[len(common):].lstrip("/") for path in kept],
+            "covers": kept,
+        })
+    return entries, dropped
+
+def confirm(prompt):
+    """Ask for confirmation. When not interactive (e.g., executing a
+    plan confirmed up front), answer "y".
+    """
+    if not globls.interactive:
+        print "%sy (non-interactive)" % (prompt,)
+        return "y"
+    return raw_input(prompt)
 
-        if globls.safemode:
-            if not srcuserhostpath.endswith("/"):
-                print "warning: srcuserhostpath (%s) does not end with '/'" % (srcuserhostpath,)
-                reply = raw_input("continue (y/n)? ")
-                if reply not in ["y"]:
-                    return
+def do_mirror(mirrorname, mirrorpath, mirrors):
+    """Mirror mirrorpath to the destinations of its mirror. All
+    confirmations are collected before any transfer is started.
+    Transfers are run up to the allowed number in parallel.
 
-        if globls.thisusername != srcuser:
-            print "warning: you (%s) do not match source user (%s)" % (globls.thisusername, srcuser)
-            reply = raw_input("continue (y/n)? ")
-            if not globls.yes and reply not in ["y"]:
-                return
+    Return list of transfer dicts.
+    """
+    transfers = prepare_transfers(mirrorname, mirrorpath, mirrors)
+    if not transfers:
+        return []
 
-        if globls.thishostname != srchost:
-            print "warning: this host (%s) does not match source host (%s)" % (globls.thishostname, srchost)
-            reply = raw_input("continue (y/n)? ")
-            if not globls.yes and reply not in ["y"]:
-                return
+    if globls.dry:
+        for transferd in transfers:
+            print "running ..."
+            print " ".join(transferd["cmdargs"])
+        return transfers
+
+    nworkers = get_max_parallel(transfers[0]["mirrord"])
+    register_bandwidth(transfers, nworkers)
+    check_health(transfers)
+    if nworkers > 1:
+        for transferd in transfers:
+            transferd["prefix"] = "[%s] " % (transferd["dstuserhostpath"],)
+    mirrord = transfers[0]["mirrord"]
+    if mirrord.get("batch", globls.defaultsd.get("batch", False)):
+        run_batched(transfers, nworkers)
+    else:
+        run_fanout(transfers, nworkers)
+    save_run_stats(transfers)
+    save_metrics(transfers)
+
+    show_summary(transfers)
+    if globls.showtimings:
+        show_timings(transfers)
+    return transfers
+
+def do_verify(mirrorname, mirrorpath, mirrors):
+    """Verify the destinations of mirrorpath against the source by
+    checksums ("verify_hash": md5, sha1 (default), sha256). Source
+    checksums come from a per-mirror cache, so only new and changed
+    files are hashed ("verify_jobs" threads, default one per CPU).
+    A sample of files ("verify_sample" rate, or --verify-sample;
+    default 1, i.e., all) is checked on each destination. Mismatches
+    are reported and, with --verify-fix or "verify_resync", re-synced
+    (with --checksum, only those files).
+
+    Return list of transfer dicts.
+    """
+    transfers = prepare_transfers(mirrorname, mirrorpath, mirrors)
+    if not transfers or globls.dry:
+        return transfers
+    if not os.path.isdir(mirrorpath):
+        print "error: can only verify directories (%s)" % (mirrorpath,)
+        return transfers
+    check_health(transfers)
+
+    mirrord = transfers[0]["mirrord"]
+    hashname = mirrord.get("verify_hash", globls.defaultsd.get("verify_hash", "sha1"))
+    if hashname not in verify.HASHES:
+        print "error: unsupported verify_hash (%s)" % (hashname,)
+        return transfers
+    rate = globls.verifysample
+    if rate == None:
+        rate = float(mirrord.get("verify_sample", globls.defaultsd.get("verify_sample", 1)))
+    nworkers = int(globls.defaultsd.get("verify_jobs", multiprocessing.cpu_count()))
+
+    _, _, srcroot = userhostpath_split(mirrord["source"])
+    relprefix = mirrorpath[len(srcroot):].lstrip("/")
+    cachepath = os.path.join(VERIFY_DIRPATH, "%s.%s.cache" % (transfers[0]["name"], hashname))
+    with _scans_mutex:
+        cached = verify.load_cache(cachepath)
+        relpaths, nhashed = verify.update_cache(cached, mirrorpath, relprefix,
+            transfers[0]["excludes"], hashname, nworkers)
+        try:
+            verify.save_cache(cachepath, cached)
+        except:
+            logger.error("cannot save checksum cache (%s)" % (cachepath,))
+    selected = verify.sample(relpaths, rate, time.strftime("%Y%m%d"))
+    print "verify: files=%s hashed=%s checking=%s" % (len(relpaths), nhashed, len(selected))
+    logger.info("verify (%s) files=%s hashed=%s checking=%s" % (mirrorpath, len(relpaths), nhashed, len(selected)))
+
+    run_pool(lambda transferd: verify_transfer(transferd, cached, selected, relprefix, hashname),
+        transfers, get_max_parallel(mirrord))
+
+    print "verify summary:"
+    for transferd in transfers:
+        verifyd = transferd.get("verify")
+        if transferd["status"] == "unhealthy":
+            print "    skipped %s (unhealthy: %s)" % (transferd["dstuserhostpath"], transferd["health"])
+        elif verifyd == None:
+            print "    failed  %s (cannot verify)" % (transferd["dstuserhostpath"],)
+        elif not verifyd["mismatches"]:
+            print "    ok      %s (%s files)" % (transferd["dstuserhostpath"], verifyd["checked"])
+        else:
+            print "    mismatch %s (%s of %s files%s)" % (transferd["dstuserhostpath"],
+                len(verifyd["mismatches"]), verifyd["checked"],
+                verifyd.get("resync") and "; re-sync %s" % (verifyd["resync"],) or "")
+    return transfers
+
+def do_watch(mirrorname, mirrorpaths, mirrors):
+    """Watch mirror paths and push changes in batches. After a burst
+    of changes has been quiet for "watch_debounce" seconds (or
+    "watch_max_delay" has passed since the first change), changed
+    paths are coalesced per mirror path and sent to each destination
+    with --files-from. A full sync is done at startup and after events
+    are lost (inotify queue overflow). Changes are kept per
+    destination: those to destinations whose lock is held (e.g., by a
+    manual run), which are unhealthy, or which fail are retried with
+    the next batch; the other destinations are not synced again.
+    """
+    debounce = float(globls.defaultsd.get("watch_debounce", 5))
+    maxdelay = float(globls.defaultsd.get("watch_max_delay", 60))
+
+    templatesd = {}
+    for mirrorpath in mirrorpaths:
+        if not os.path.isdir(mirrorpath):
+            print "warning: skipping path (%s); can only watch directories" % (mirrorpath,)
+            continue
+        transfers = prepare_transfers(mirrorname, mirrorpath, mirrors)
+        if transfers:
+            templatesd[mirrorpath] = transfers
+    if not templatesd:
+        return
 
-        # use only srcpath part
-        cmdargs.append(srcpath)
+    # longest first so that nested mirror paths match first
+    watchpaths = sorted(templatesd.keys(), key=len, reverse=True)
 
-        # process for each destination
-        sep = None
-        for dstuserhostpath in bestmirrord.get("destinations"):
-            if sep != None:
-                print sep
-            else:
-                sep = ""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    watcherd = watch.open_watcher()
+    for mirrorpath in watchpaths:
+        watch.add_tree(watcherd, mirrorpath)
+    logger.info("watch starting paths=%s" % " ".join(watchpaths))
+    print "info: watching %s path(s)" % len(watchpaths)
 
-            # provide dstuser if needed
-            dstuser, dsthost, dstpath = userhostpath_split(dstuserhostpath)
-            if dstuser == None:
-                dstuser = globls.thisusername
+    # (mirrorpath, dstuserhostpath) -> set of changed relpaths, or None
+    # for full sync
+    pendingd = {}
+    for mirrorpath in watchpaths:
+        for transferd in templatesd[mirrorpath]:
+            pendingd[(mirrorpath, transferd["dstuserhostpath"])] = None
+    first = last = time.time()
 
-            # provide/ update dstpath
-            if dstpath == None:
-                dstpath = mirrorpath
+    try:
+        while True:
+            now = time.time()
+            if pendingd:
+                timeout = max(0, min(last+debounce, first+maxdelay)-now)
             else:
-                if relpath:
-                    dstpath = os.path.join(dstpath, relpath)
-
-            # rebuild
-            dstuserhostpath = "%s@%s:%s" % (dstuser, dsthost, dstpath)
+                timeout = None
+
+            events = watch.read_events(watcherd, timeout)
+            now = time.time()
+            for path, mask in events:
+                if path == None:
+                    logger.info("watch: events lost; full sync scheduled")
+                    if not pendingd:
+                        first = now
+                    for mirrorpath in watchpaths:
+                        for transferd in templatesd[mirrorpath]:
+                            pendingd[(mirrorpath, transferd["dstuserhostpath"])] = None
+                    continue
+                for mirrorpath in watchpaths:
+                    if path == mirrorpath or path.startswith(mirrorpath+"/"):
+                        break
+                else:
+                    continue
 
-            if globls.destinations and dsthost not in globls.destinations:
-                if globls.verbose:
-                    print "verbose: skipping destination (%s)" % (dsthost,)
+                if not pendingd:
+                    first = now
+                changed = []
+                if path != mirrorpath:
+                    changed.append(path[len(mirrorpath)+1:])
+                if mask & watch.IN_ISDIR and mask & (watch.IN_CREATE|watch.IN_MOVED_TO):
+                    # new directory: watch it and pick up what it holds
+                    for dirpath in watch.add_tree(watcherd, path):
+                        for name in os.listdir(dirpath):
+                            changed.append(os.path.join(dirpath, name)[len(mirrorpath)+1:])
+                for transferd in templatesd[mirrorpath]:
+                    key = (mirrorpath, transferd["dstuserhostpath"])
+                    if key in pendingd and pendingd[key] == None:
+                        continue
+                    pendingd.setdefault(key, set()).update(changed)
+            if events:
+                last = now
+
+            if pendingd and (now-last >= debounce or now-first >= maxdelay):
+                pendingd = flush_watch(templatesd, pendingd)
+                first = last = time.time()
+    except KeyboardInterrupt:
+        print "info: stopping"
+    finally:
+        watch.close_watcher(watcherd)
+        logger.info("watch stopped")
+
+def execute_plan(planpath, mirrors):
+    """Run the transfers of a plan (see make_plan) without asking for
+    confirmation.
+    """
+    pland = json.load(open(planpath))
+    if pland.get("version") != PLAN_VERSION:
+        raise RmirrException("unsupported plan version (%s)" % (pland.get("version"),))
+    globls.allowdelete = pland["options"]["delete"]
+    globls.dryrsync = pland["options"]["dry_rsync"]
+    globls.interactive = False
+    globls.yes = True
+
+    transfers = []
+    for entryd in pland["entries"]:
+        if transfers:
+            print
+        # only prepare (and show) the destinations of the plan
+        globls.destinations = [userhostpath_split(dstuserhostpath)[1] for dstuserhostpath in entryd["destinations"]]
+        for transferd in prepare_transfers(entryd["name"], entryd["mirrorpath"], mirrors):
+            if transferd["dstuserhostpath"] not in entryd["destinations"]:
+                # another destination on a planned host
                 continue
+            if entryd["files"] != None:
+                # listed directories are synced whole
+                transferd["cmdargs"] = transferd["cmdargs"][:1]+["-r"]+transferd["cmdargs"][1:]
+                transferd["filesfrom"] = entryd["files"]
+            transfers.append(transferd)
+    if not transfers:
+        return transfers
+    return run_prepared(transfers, "plan (%s)" % (os.path.basename(planpath),))
+
+def expire_health():
+    """Forget health probe results (see check_health).
+    """
+    with _health_mutex:
+        _healthd.clear()
 
-            xcmdargs = cmdargs[:]
-            xcmdargs.append(dstuserhostpath)
-            print "name:             %s" % name
-            print "comment:          %s" % comment
-            print "sync from:        %s" % (srcuserhostpath,)
-            print "sync to:          %s" % (dstuserhostpath,)
-            print "excludes:         %s" % " ".join(excludes)
-            print "uselock:          %s" % str(globls.uselock and "yes" or "no")
-            print "email recipients: %s" % " ".join(email_recipients)
+def find_mirror(mirrorpath, mirrors):
+    """Find mirror with the longest source path matching mirrorpath.
+    Use the index when searching all configured mirrors.
+    """
+    started = time.time()
+    try:
+        if globls.mirrorindex != None and mirrors is globls.mirrors:
+            bestsrcpath, i = mirrorindex.find(globls.mirrorindex, mirrorpath)
             if globls.debug:
-                print xcmdargs
+                print "debug: mirrorpath (%s) bestsrcpath (%s) (indexed)" % (mirrorpath, bestsrcpath)
+            if i == None:
+                return "", None
+            return bestsrcpath, mirrors[i]
 
-            if not globls.yes:
-                reply = raw_input("execute (y/n/q)? ")
-                if reply == "q":
-                    print "quitting"
-                    sys.exit(0)
-                if reply not in ["y"]:
-                    print "skipped"
-                    continue
+        bestmirrord = None
+        bestsrcpath = ""
+        for mirrord in mirrors:
+            srcuserhostpath = mirrord["source"]
+            _, _, srcpath = userhostpath_split(srcuserhostpath)
 
-            print "running ..."
-            if globls.dry:
-                print " ".join(xcmdargs)
-            else:
-                try:
-                    lockfd = None
-                    repf = None
-
-                    logger.info("starting")
-                    logger.info("name=%s" % name)
-                    logger.info("comment=%s" % comment)
-                    logger.info("from=%s" % srcuserhostpath)
-                    logger.info("to=%s" % dstuserhostpath)
-                    logger.info("excludes=%s" % " ".join(excludes))
-                    logger.info("uselock=%s" % str(globls.uselock and "yes" or "no"))
-                    logger.info("email recipients=%s" % " ".join(email_recipients))
-
-                    if globls.uselock:
-                        try:
-                            lockfd = os.open(os.path.join(LOCKS_DIRPATH, name), os.O_CREAT|os.O_WRONLY)
-                            fcntl.lockf(lockfd, fcntl.LOCK_EX|fcntl.LOCK_NB)
-                            logger.info("obtained lock")
-                        except:
-                            print "error: cannot get lock"
-                            raise RmirrException("cannot get lock")
-                    else:
-                        logger.info("bypassing lock")
-                        print "info: bypassing lock"
-
-                    try:
-                        repf, report_path  = open_report()
-                        logger.info("report=%s" % report_path)
-
-                        logger.info("command=%s" % " ".join(xcmdargs))
-                        p = subprocess.Popen(xcmdargs,
-                            stdout=repf, stderr=subprocess.STDOUT,
-                            shell=False, close_fds=True)
-
-                        if globls.showreport:
-                            with open(report_path) as showf:
-                                while p.returncode == None:
-                                    p.poll()
-                                    s = showf.read()
-                                    sys.stdout.write(s)
-                                    if s == "":
-                                        time.sleep(0.5)
-                        else:
-                            p.wait()
-
-                        if p.returncode != 0:
-                            print "warning: non-zero exit value (%s)" % (p.returncode,)
-
-                        if globls.mailreport:
-                            try:
-                                subject = "rmirr report for %s (%s)" % (name, os.path.basename(report_path))
-                                sendreport(email_recipients, subject,
-                                    name, srcuserhostpath, dstuserhostpath, excludes, report_path)
-                            except:
-                                #traceback.print_exc()
-                                logger.error("failed to send report")
-                                print "error: failed to send report"
-                    except:
-                        raise RmirrException("mirror failure")
-                except RmirrException as e:
-                    logger.info(e)
-                finally:
-                    if lockfd != None:
-                        os.close(lockfd)
-                    if repf != None:
-                        repf.close()
-                    logger.info("done")
+            if mirrorpath == srcpath or mirrorpath.startswith(srcpath+"/"):
+                if len(srcpath) > len(bestsrcpath):
+                    bestsrcpath = srcpath
+                    bestmirrord = mirrord
 
-def find_mirror(mirrorpath, mirrors):
-    bestmirrord = None
-    bestsrcpath = ""
-    for mirrord in mirrors:
-        srcuserhostpath = mirrord["source"]
-        _, _, srcpath = userhostpath_split(srcuserhostpath)
+            if globls.debug:
+                print "debug: mirrorpath (%s) srcpath (%s) bestsrcpath (%s)" \
+                    % (mirrorpath, srcpath, bestsrcpath)
+        return bestsrcpath, bestmirrord
+    finally:
+        add_timing(globls.timingsd, "resolve", started)
+
+def flush_watch(templatesd, pendingd):
+    """Push pending changes ((mirrorpath, dstuserhostpath) -> relpaths
+    or None; see do_watch) to their destinations. Destinations are
+    probed and the source is scanned (see plan_manifest) afresh.
+    Return pending changes which could not be pushed.
+    """
+    expire_health()
+    with _scans_mutex:
+        # changes since the last batch (or lost in an overflow) are
+        # only seen by a new scan
+        _scansd.clear()
+    remainingd = {}
+    for mirrorpath in sorted(set([mirrorpath for mirrorpath, _ in pendingd])):
+        transfers = []
+        copiesd = {}
+        for templated in templatesd[mirrorpath]:
+            key = (mirrorpath, templated["dstuserhostpath"])
+            if key not in pendingd:
+                continue
+            relpaths = pendingd[key]
+            transferd = copiesd[id(templated)] = dict(templated)
+            transferd.update({
+                "filesfrom": relpaths != None and sorted(relpaths) or None,
+                "report_path": None,
+                "returncode": None,
+                "stats": None,
+                "status": "pending",
+                "unchanged": False,
+            })
+            transfers.append(transferd)
+        for transferd in transfers:
+            if transferd["relay"]:
+                # a relay without changes of its own is up to date
+                transferd["relay"] = copiesd.get(id(transferd["relay"]))
+
+        if globls.dry:
+            for transferd in transfers:
+                print " ".join(transferd["cmdargs"])
+            continue
+
+        nworkers = get_max_parallel(transfers[0]["mirrord"])
+        register_bandwidth(transfers, nworkers)
+        check_health(transfers)
+        logger.info("watch: pushing (%s) destinations=%s" % (mirrorpath, len(transfers)))
+        run_fanout(transfers, nworkers)
+        save_run_stats(transfers)
+        save_metrics(transfers)
+        show_summary(transfers, "watch summary")
+
+        for transferd in transfers:
+            if transferd["status"] != "ok":
+                remainingd[(mirrorpath, transferd["dstuserhostpath"])] = pendingd[(mirrorpath, transferd["dstuserhostpath"])]
+    send_digests()
+    prune_reports()
+    return remainingd
+
+def format_timings(timingsd, phases):
+    """Format timings as "phase=seconds ..." in the order of phases.
+    """
+    phases = [phase for phase in phases if phase in timingsd]
+    return " ".join(["%s=%.3f" % (phase, timingsd[phase]) for phase in phases])
 
-        if mirrorpath == srcpath or mirrorpath.startswith(srcpath+"/"):
-            if len(srcpath) > len(bestsrcpath):
-                bestsrcpath = srcpath
-                bestmirrord = mirrord
+def get_bwlink(transferd):
+    """Return (link, budget, windows) for a transfer. budget is in
+    MB/s (None for no limit); windows is a list of "HH:MM-HH:MM".
 
-        if globls.debug:
-            print "debug: mirrorpath (%s) srcpath (%s) bestsrcpath (%s)" \
-                % (mirrorpath, srcpath, bestsrcpath)
-    return bestsrcpath, bestmirrord
+    Destination hosts listed under a "links" entry in "defaults"
+    share that link's "bwlimit". Otherwise, each destination host has
+    its own budget of "bwlimit" from the mirror or "defaults".
+    Windows come from the mirror, then the link, then "defaults".
+    """
+    mirrord = transferd["mirrord"]
+    dsthost = transferd["dsthost"]
+    defaultsd = globls.defaultsd
+
+    link = "host:%s" % (dsthost,)
+    budget = mirrord.get("bwlimit", defaultsd.get("bwlimit"))
+    windows = defaultsd.get("windows")
+    for linkname, linkd in sorted(defaultsd.get("links", {}).items()):
+        if dsthost in linkd.get("hosts", []):
+            link = "link:%s" % (linkname,)
+            budget = linkd.get("bwlimit")
+            windows = linkd.get("windows", windows)
+            break
+    windows = mirrord.get("windows", windows)
+    return link, budget, windows
+
+def get_compression(mirrord, dsthost):
+    """Return compression setting (see compress) for a destination:
+    from "destination_compress" (by host) or "compress" of the mirror
+    or "defaults". Default is "zlib". "auto" is resolved from past
+    runs to the destination; an incompressible link is probed again
+    with compression after "compress_reprobe_days" (default 7).
+    """
+    defaultsd = globls.defaultsd
+    setting = mirrord.get("destination_compress", {}).get(dsthost,
+        mirrord.get("compress", defaultsd.get("compress", "zlib")))
+    if setting == "auto":
+        linkstatsd = load_json_file(LINKSTATS_FILEPATH)
+        linkstatd = linkstatsd.get("%s:%s" % (mirrord.get("name"), dsthost))
+        reprobe = float(defaultsd.get("compress_reprobe_days", 7))*86400
+        setting = compress.choose_auto(linkstatd, compress.get_supported(), reprobe)
+        if globls.verbose:
+            print "verbose: auto compression for (%s) is (%s)" % (dsthost, setting)
+    return setting
 
 def get_datetimestamp():
     return datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
 
+def get_duration_key(transferd):
+    return "%s:%s" % (transferd["dsthost"], transferd["mirrorpath"])
+
+def get_itemized(transferd):
+    """Return the sorted list of changes (itemized) rsync would make
+    for the transfer, using a dry run. Return None on failure.
+    """
+    cmdargs = transferd["cmdargs"]
+    rshcmd = get_rsh(transferd, transferd["dstuser"], transferd["dsthost"])
+    if rshcmd:
+        cmdargs = cmdargs[:1]+["-e", rshcmd]+cmdargs[1:]
+    cmdargs = cmdargs[:-2]+["--dry-run", "--out-format=ITEM %i %n%L"]+cmdargs[-2:]
+    try:
+        p = subprocess.Popen(cmdargs, stdout=subprocess.PIPE, stderr=open(os.devnull, "w"), close_fds=True)
+        out = p.communicate()[0]
+    except:
+        return None
+    if p.returncode != 0:
+        return None
+    return sorted([line for line in out.splitlines() if line.startswith("ITEM ")])
+
+def get_lock_key(transferd):
+    return (transferd["name"], transferd["dsthost"], transferd["mirrorpath"])
+
+def get_manifest_path(transferd):
+    key = "%s\0%s\0%s" % (transferd["name"], transferd["mirrorpath"], transferd["dstuserhostpath"])
+    return os.path.join(MANIFESTS_DIRPATH, "%s.manifest" % hashlib.sha1(key).hexdigest())
+
+def get_max_parallel(mirrord):
+    """Return the number of transfers which may run in parallel for
+    a mirror: the global jobs setting capped by max_parallel.
+    """
+    nworkers = globls.jobs
+    max_parallel = mirrord.get("max_parallel", globls.defaultsd.get("max_parallel"))
+    if max_parallel:
+        nworkers = min(nworkers, int(max_parallel))
+    return max(1, nworkers)
+
 def get_mirror(mirrorname):
     """Get mirror served by mirrorname.
     """
+    if globls.mirrorindex != None:
+        i = mirrorindex.get(globls.mirrorindex, mirrorname)
+        if i == None:
+            return None
+        return globls.mirrors[i]
+
     try:
         for mirrord in globls.mirrors:
             if mirrord["name"] == mirrorname:
@@ -287,6 +690,174 @@ def get_mirror(mirrorname):
     except:
         pass
 
+def get_relay_cmdargs(transferd, cmdargs):
+    """Return command which runs rsync (cmdargs, for the source) on
+    the relay host to sync the relay's copy to the destination.
+    """
+    relayd = transferd["relay"]
+
+    relaysrcpath = relayd["dstpath"]
+    if transferd["srcpath"].endswith("/"):
+        relaysrcpath += "/"
+    remoteargs = cmdargs[:-2]+[relaysrcpath, transferd["dstuserhostpath"]]
+
+    rshcmd = get_rsh(transferd, relayd["dstuser"], relayd["dsthost"]) \
+        or os.environ.get("RSYNC_RSH", "ssh")
+    return shlex.split(rshcmd)+["%s@%s" % (relayd["dstuser"], relayd["dsthost"]),
+        " ".join([pipes.quote(arg) for arg in remoteargs])]
+
+def get_report_summary(transferd):
+    """Return mail text summarizing the report of the transfer: stats,
+    and the first and last lines ("report_mail_head" and
+    "report_mail_tail" in defaults, default 100 each). The report is
+    streamed, not loaded whole.
+    """
+    report_path = transferd["report_path"]
+    statsd = transferd["stats"]
+    nhead = int(globls.defaultsd.get("report_mail_head", 100))
+    ntail = int(globls.defaultsd.get("report_mail_tail", 100))
+    headlines, taillines, nlines, nbytes = reportstore.summarize(report_path, nhead, ntail)
+    parts = [
+        "Name:        %s\n" % transferd["name"],
+        "From:        %s\n" % transferd["srcuserhostpath"],
+        "To:          %s\n" % transferd["dstuserhostpath"],
+        "Excludes:    %s\n" % " ".join(transferd["excludes"]),
+        "Report path: %s\n" % report_path,
+        "Report size: %s lines, %s bytes\n" % (nlines, nbytes),
+        "\n",
+    ]
+    if statsd:
+        parts.append("Stats:\n")
+        keys = []
+        for _, key in rsyncstats.LABELS+[(None, "speedup")]:
+            if key in statsd and key not in keys:
+                parts.append("    %-20s %s\n" % (key, statsd[key]))
+                keys.append(key)
+        parts.append("\n")
+    parts.append("Report:\n")
+    parts.extend(headlines)
+    if nlines > len(headlines)+len(taillines):
+        parts.append("... (%s lines omitted) ...\n" % (nlines-len(headlines)-len(taillines),))
+    parts.extend(taillines)
+    return "".join(parts)
+
+def get_retry_delay(policyd, attempt):
+    """Return seconds to wait before retrying after attempt:
+    exponential backoff, capped, with random jitter.
+    """
+    delay = min(policyd["backoff_max"], policyd["backoff"]*2**(attempt-1))
+    return delay*(1-policyd["jitter"]*random.random())
+
+def get_retry_policy(transferd):
+    """Return retry policy for the transfer from "retry" of the mirror
+    or defaults:
+        "max_attempts" (default 1, i.e., no retry; --max-attempts
+            overrides),
+        "backoff" (seconds before the first retry, doubled for each
+            following one; default 30),
+        "backoff_max" (default 600),
+        "jitter" (fraction of the delay randomly taken off; default
+            0.5),
+        "exit_codes" (retryable rsync exit values; default 10, 12,
+            23, 30, 35),
+        "partial_dir" (for --partial-dir; default ".rsync-partial";
+            null for --partial).
+    Batch replays are not retried (see run_batched).
+    """
+    retryd = transferd["mirrord"].get("retry", globls.defaultsd.get("retry", {}))
+    policyd = {
+        "max_attempts": int(retryd.get("max_attempts", 1)),
+        "backoff": float(retryd.get("backoff", 30)),
+        "backoff_max": float(retryd.get("backoff_max", 600)),
+        "jitter": float(retryd.get("jitter", 0.5)),
+        "exit_codes": retryd.get("exit_codes", RETRY_EXIT_CODES),
+        "partial_dir": retryd.get("partial_dir", ".rsync-partial"),
+    }
+    if globls.maxattempts != None:
+        policyd["max_attempts"] = globls.maxattempts
+    if transferd.get("batch_read"):
+        policyd["max_attempts"] = 1
+    return policyd
+
+def get_rsh(transferd, user, host):
+    """Return remote shell command for user@host which uses a shared
+    SSH master connection (see sshmux). Return None if disabled
+    ("ssh_multiplex" set to false) or the master cannot be started.
+    """
+    mirrord = transferd["mirrord"]
+    if not mirrord.get("ssh_multiplex", globls.defaultsd.get("ssh_multiplex", True)):
+        return None
+
+    userhost = "%s@%s" % (user, host)
+    rshcmd = sshmux.get_rsh(SSH_DIRPATH, userhost, os.environ.get("RSYNC_RSH", "ssh"))
+    if rshcmd == None:
+        log_transfer(transferd, "cannot start ssh master to (%s); not multiplexing" % (userhost,))
+    return rshcmd
+
+def get_shard_plan(transferd):
+    """Return list of shards (lists of unit paths relative to the
+    mirror path) for the transfer, or None if not sharded. A mirror
+    opts in with "shards" (number of concurrent rsyncs). Directory
+    weights come from a scan ("shard_depth" levels deep, default 3)
+    saved under SHARDS_DIRPATH and reused for "shard_rescan" seconds
+    (default 1 day).
+    """
+    mirrord = transferd["mirrord"]
+    mirrorpath = transferd["mirrorpath"]
+    nshards = int(mirrord.get("shards", globls.defaultsd.get("shards", 0)))
+    if nshards < 2 or not os.path.isdir(mirrorpath):
+        return None
+
+    with _shards_mutex:
+        shards = _shardsd.get(mirrorpath)
+        if shards == None:
+            now = time.time()
+            maxdepth = int(mirrord.get("shard_depth", globls.defaultsd.get("shard_depth", 3)))
+            rescan = mirrord.get("shard_rescan", globls.defaultsd.get("shard_rescan", 86400))
+            weightspath = os.path.join(SHARDS_DIRPATH, "%s.json" % hashlib.sha1(mirrorpath).hexdigest())
+            weightsd = shard.load_weights(weightspath, rescan, now)
+            if weightsd == None:
+                log_transfer(transferd, "shards: scanning (%s)" % (mirrorpath,))
+                weightsd = shard.scan(mirrorpath, maxdepth)
+                try:
+                    shard.save_weights(weightspath, weightsd, now)
+                except:
+                    logger.error("cannot save shard weights (%s)" % (weightspath,))
+            shards = _shardsd[mirrorpath] = shard.plan(weightsd, nshards)
+    if len(shards) < 2:
+        return None
+    return shards
+
+def get_stall_policy(transferd):
+    """Return stall policy for the transfer: "timeout" (seconds without
+    progress; None to not check), "max_runtime" (seconds; None for no
+    limit) and "grace" (seconds).
+    """
+    mirrord = transferd["mirrord"]
+    stalld = mirrord.get("stall", globls.defaultsd.get("stall", {}))
+    timeout = str(stalld.get("timeout", "off"))
+    if globls.stalltimeout != None:
+        timeout = globls.stalltimeout
+    if timeout == "auto":
+        maxidle = load_json_file(IDLE_FILEPATH).get(get_duration_key(transferd))
+        if maxidle == None:
+            timeout = parse_duration(str(stalld.get("default", 1800)))
+        else:
+            timeout = max(parse_duration(str(stalld.get("min", 300))), float(stalld.get("factor", 4))*maxidle)
+    elif timeout == "off":
+        timeout = None
+    else:
+        timeout = parse_duration(timeout) or None
+
+    maxruntime = globls.maxruntime
+    if maxruntime == None:
+        maxruntime = parse_duration(str(mirrord.get("max_runtime", globls.defaultsd.get("max_runtime", 0))))
+    return {
+        "timeout": timeout,
+        "max_runtime": maxruntime or None,
+        "grace": float(stalld.get("grace", 10)),
+    }
+
 def load_conf(confpath, normalize):
     """Load configuration file. Ensure that settings are normalized.
     """
@@ -302,9 +873,9 @@ def load_conf(confpath, normalize):
         for mirrord in mirrors:
             mirrord["source"] = userhostpath_normalize(mirrord["source"])
 
-        destinations = mirrord["destinations"]
-        for i, userhostpath in enumerate(destinations):
-             destinations[i] = userhostpath_normalize(userhostpath)
+            destinations = mirrord.get("destinations", [])
+            for i, userhostpath in enumerate(destinations):
+                destinations[i] = userhostpath_normalize(userhostpath)
 
     # validate
     for mirrord in mirrors:
@@ -315,6 +886,109 @@ def load_conf(confpath, normalize):
 
     return conf
 
+def load_conf_cached(confpath):
+    """Load normalized configuration and mirror index, using the
+    compiled cache under CONFCACHE_DIRPATH when it is current. The
+    cache is rebuilt when the configuration file changes.
+
+    Return (conf, index).
+    """
+    realpath = os.path.realpath(confpath)
+    st = os.stat(realpath)
+    key = [CONFCACHE_VERSION, realpath, st.st_mtime, st.st_size, os.path.expanduser("~")]
+    cachepath = os.path.join(CONFCACHE_DIRPATH, "%s.pickle" % hashlib.sha1(realpath).hexdigest())
+
+    if globls.confcache:
+        try:
+            with open(cachepath, "rb") as f:
+                cached = cPickle.load(f)
+            if cached["key"] == key:
+                return cached["conf"], cached["index"]
+        except:
+            pass
+
+    conf = load_conf(realpath, True)
+    index = mirrorindex.build(conf.get("mirrors", []), userhostpath_split)
+
+    if globls.confcache:
+        try:
+            if not os.path.exists(CONFCACHE_DIRPATH):
+                os.mkdir(CONFCACHE_DIRPATH)
+            fd, tmppath = tempfile.mkstemp(dir=CONFCACHE_DIRPATH)
+            with os.fdopen(fd, "wb") as f:
+                cPickle.dump({"key": key, "conf": conf, "index": index}, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmppath, cachepath)
+        except:
+            logger.error("cannot save configuration cache")
+    return conf, index
+
+def load_json_file(path):
+    """Load dict from JSON file. Return empty dict on failure.
+    """
+    try:
+        return json.load(open(path))
+    except:
+        return {}
+
+def log_transfer(transferd, msg, level=logging.INFO):
+    """Log to history with the transfer destination as tag.
+    """
+    logger.log(level, "[%s] %s" % (transferd["dsthost"], msg))
+
+def make_plan(planpath, mirrorname, mirrorpaths, mirrors):
+    """Coalesce mirror paths (see coalesce_paths), expand destinations
+    (-d applies) and, once confirmed, save the plan as JSON to planpath
+    ("-" for stdout) for --execute-plan.
+    """
+    entries, dropped = coalesce_paths(mirrorname, mirrorpaths, mirrors)
+
+    # expand destinations; checks are shown but not asked
+    interactive, yes = globls.interactive, globls.yes
+    globls.interactive, globls.yes = False, True
+    stdout = sys.stdout
+    if planpath == "-":
+        sys.stdout = sys.stderr
+    try:
+        for entryd in entries:
+            transfers = prepare_transfers(entryd["name"], entryd["mirrorpath"], mirrors)
+            entryd["destinations"] = [transferd["dstuserhostpath"] for transferd in transfers]
+            print
+    finally:
+        globls.interactive, globls.yes = interactive, yes
+        sys.stdout = stdout
+    entries = [entryd for entryd in entries if entryd["destinations"]]
+
+    out = planpath == "-" and sys.stderr or sys.stdout
+    out.write("plan:\n")
+    for entryd in entries:
+        out.write("    %s %s%s\n" % (entryd["name"], entryd["mirrorpath"],
+            entryd["files"] != None and " (files: %s)" % " ".join(entryd["files"]) or ""))
+        for dstuserhostpath in entryd["destinations"]:
+            out.write("        -> %s\n" % (dstuserhostpath,))
+    for droppedd in dropped:
+        out.write("    dropped %s (%s)\n" % (droppedd["path"], droppedd["reason"]))
+    if not globls.yes:
+        out.write("confirm plan (y/n)? ")
+        out.flush()
+        if sys.stdin.readline().strip() not in ["y"]:
+            out.write("plan not saved\n")
+            return None
+
+    pland = {
+        "version": PLAN_VERSION,
+        "created": time.time(),
+        "options": {"delete": globls.allowdelete, "dry_rsync": globls.dryrsync},
+        "entries": entries,
+        "dropped": dropped,
+    }
+    if planpath == "-":
+        json.dump(pland, sys.stdout, indent=1, sort_keys=True)
+        print
+    else:
+        with open(planpath, "w") as f:
+            json.dump(pland, f, indent=1, sort_keys=True)
+    return pland
+
 def open_report():
     """Open new report file returning file object and path.
     """
@@ -323,27 +997,1127 @@ def open_report():
     f = os.fdopen(fd, "w")
     return (f, path)
 
-def sendreport(recipients, subject, name, srcuserhostpath, dstuserhostpath, excludes, report_path):
-    sender = "%s@%s" % (whoami(), socket.getfqdn())
+def parse_duration(s):
+    """Parse duration (<n>[smhd]; default seconds). Return seconds.
+    """
+    unitsd = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if s and s[-1] in unitsd:
+        return float(s[:-1])*unitsd[s[-1]]
+    return float(s)
+
+def plan_fanout(transfers, mirrord):
+    """Assign relays to transfers according to the mirror topology.
+
+    With "fanout": "tree", the first "fanout_width" (default 2)
+    destinations are synced from the source and each further one from
+    an earlier destination (a tree of that width). "relay_via" maps
+    destination hosts to the (destination) host to relay through.
+    """
+    fanout = mirrord.get("fanout")
+    if fanout == "tree":
+        width = max(1, int(mirrord.get("fanout_width", 2)))
+        for i, transferd in enumerate(transfers):
+            if i >= width:
+                transferd["relay"] = transfers[(i-width)//width]
+
+    byhostd = dict([(transferd["dsthost"], transferd) for transferd in transfers])
+    for dsthost, relayhost in mirrord.get("relay_via", {}).items():
+        transferd = byhostd.get(dsthost)
+        relayd = byhostd.get(relayhost)
+        if transferd == None or relayd == None:
+            continue
+        # refuse cycles
+        d = relayd
+        while d != None and d is not transferd:
+            d = d["relay"]
+        if d is transferd:
+            print "warning: ignoring relay (%s) for (%s); cycle" % (relayhost, dsthost)
+            continue
+        transferd["relay"] = relayd
+
+    relayed = [transferd for transferd in transfers if transferd["relay"]]
+    if relayed:
+        print "fanout plan:"
+        for transferd in transfers:
+            print "    %s <- %s" % (transferd["dsthost"], transferd["relay"] and transferd["relay"]["dsthost"] or "source")
+        logger.info("fanout name=%s plan=%s" % (mirrord.get("name"),
+            " ".join(["%s<-%s" % (transferd["dsthost"], transferd["relay"] and transferd["relay"]["dsthost"] or "source") for transferd in transfers])))
+
+def plan_manifest(transferd):
+    """Compare the source tree against the manifest of the last
+    successful sync to the destination. Return None if manifests are
+    not in use, else a dict with the mode: "skip" (no changes),
+    "files" (only changed paths, via --files-from), or "full".
+
+    A full sync is done when there is no manifest, deleted files are
+    to be propagated, or the last full sync is older than
+    "manifest_full_sweep" seconds (default 1 day).
+    """
+    mirrord = transferd["mirrord"]
+    mirrorpath = transferd["mirrorpath"]
+    if not mirrord.get("manifest", globls.defaultsd.get("manifest", False)) \
+        or not os.path.isdir(mirrorpath):
+        return None
+
+    with _scans_mutex:
+        entries = _scansd.get(mirrorpath)
+        if entries == None:
+            entries = _scansd[mirrorpath] = manifest.scan(mirrorpath)
+
+    now = time.time()
+    full_sweep = mirrord.get("manifest_full_sweep", globls.defaultsd.get("manifest_full_sweep", 86400))
+    planned = {"mode": "full", "entries": entries, "changed": None, "full_sweep": now}
 
-    if recipients:
+    manifestd = manifest.load(get_manifest_path(transferd))
+    if globls.fullsync or manifestd == None or now-manifestd["full_sweep"] > full_sweep:
+        return planned
+
+    changed, deleted = manifest.diff(manifestd["entries"], entries)
+    if deleted and globls.allowdelete:
+        return planned
+
+    planned["full_sweep"] = manifestd["full_sweep"]
+    planned["changed"] = changed
+    if not changed:
+        planned["mode"] = "skip"
+    else:
+        planned["mode"] = "files"
+    return planned
+
+def prepare_transfers(mirrorname, mirrorpath, mirrors):
+    """Resolve the mirror for mirrorpath, validate, and return a list
+    of confirmed transfer dicts, one per selected destination.
+    """
+    transfers = []
+
+    if mirrorname:
+        mirrord = get_mirror(mirrorname)
+        if not mirrord:
+            sys.stderr.write("error: cannot find mirror name\n")
+            return transfers
+        mirrors = [mirrord]
+
+    bestsrcpath, bestmirrord = find_mirror(mirrorpath, mirrors)
+    if bestsrcpath == "":
+        sys.stderr.write("error: no match\n")
+        return transfers
+
+    if globls.debug:
+        print "debug: bestsrcpath (%s)" % (bestsrcpath,)
+        print "debug: bestmirrord (%s)" % (bestmirrord,)
+
+    cmdargs = ["rsync", "-av", "--stats"]
+
+    # name
+    name = bestmirrord.get("name", None)
+    comment = bestmirrord.get("comment", None)
+
+    if globls.mailto:
+        email_recipients = globls.mailto
+    else:
+        email_recipients = bestmirrord.get("email_recipients", globls.defaultsd.get("email_recipients", None))
+        if type(email_recipients) != types.ListType:
+            email_recipients = []
+
+    # excludes
+    excludes = bestmirrord.get("excludes", [])
+    for s in excludes:
+        cmdargs.append("--exclude=%s" % s)
+
+    # compression (per destination, below)
+    skipsuffixes = bestmirrord.get("skip_compress", globls.defaultsd.get("skip_compress", []))
+
+    # itemize
+    if globls.itemize or bestmirrord.get("itemize_changes", False):
+        cmdargs.append("--itemize-changes")
+
+    # delete
+    if globls.allowdelete:
+        cmdargs.append("--delete")
+
+    # dry run
+    if globls.dryrsync:
+        cmdargs.append("--dry-run")
+
+    # validate source
+    relpath = mirrorpath[len(bestsrcpath)+1:]
+    if globls.safemode:
+        if mirrorpath != bestsrcpath:
+            if mirrorpath[len(bestsrcpath)] != "/" or relpath.startswith("/"):
+                print "warning: unexpected values for bestsrcpath (%s) and relpath (%s)" % (bestsrcpath, relpath)
+                reply = confirm("continue (y/n)? ")
+                if reply not in ["y"]:
+                    return transfers
+
+    srcuserhostpath = bestmirrord["source"]
+    srcuser, srchost, srcpath = userhostpath_split(srcuserhostpath)
+
+    srcpath = mirrorpath
+    if not os.path.exists(mirrorpath):
+        print "warning: skipping path (%s); does not exist on source" % (mirrorpath,)
+        return transfers
+
+    if os.path.isdir(mirrorpath):
+        srcpath += "/"
+    srcuserhostpath = "%s@%s:%s" % (globls.thisusername, globls.thishostname, srcpath)
+    if globls.debug:
+        print "debug: new srcuserhostpath (%s)" % (srcuserhostpath,)
+
+    if globls.safemode:
+        if not srcuserhostpath.endswith("/"):
+            print "warning: srcuserhostpath (%s) does not end with '/'" % (srcuserhostpath,)
+            reply = confirm("continue (y/n)? ")
+            if reply not in ["y"]:
+                return transfers
+
+    if globls.thisusername != srcuser:
+        print "warning: you (%s) do not match source user (%s)" % (globls.thisusername, srcuser)
+        reply = confirm("continue (y/n)? ")
+        if not globls.yes and reply not in ["y"]:
+            return transfers
+
+    if globls.thishostname != srchost:
+        print "warning: this host (%s) does not match source host (%s)" % (globls.thishostname, srchost)
+        reply = confirm("continue (y/n)? ")
+        if not globls.yes and reply not in ["y"]:
+            return transfers
+
+    # use only srcpath part
+    cmdargs.append(srcpath)
+
+    # collect for each destination
+    sep = None
+    for dstuserhostpath in bestmirrord.get("destinations"):
+        if sep != None:
+            print sep
+        else:
+            sep = ""
+
+        # provide dstuser if needed
+        dstuser, dsthost, dstpath = userhostpath_split(dstuserhostpath)
+        if dstuser == None:
+            dstuser = globls.thisusername
+
+        # provide/ update dstpath
+        if dstpath == None:
+            dstpath = mirrorpath
+        else:
+            if relpath:
+                dstpath = os.path.join(dstpath, relpath)
+
+        # rebuild
+        dstuserhostpath = "%s@%s:%s" % (dstuser, dsthost, dstpath)
+
+        if globls.destinations and dsthost not in globls.destinations:
+            if globls.verbose:
+                print "verbose: skipping destination (%s)" % (dsthost,)
+            continue
+
+        if globls.skipsyncedwithin != None:
+            try:
+                synced = rundb.get_last_synced(RUNDB_FILEPATH, name, mirrorpath, dsthost)
+            except:
+                logger.error("cannot query run database")
+                synced = None
+            if synced != None and time.time()-synced < globls.skipsyncedwithin:
+                print "skipping destination (%s); synced %ds ago" % (dsthost, time.time()-synced)
+                logger.info("[%s] skipping (%s); synced %ds ago" % (dsthost, mirrorpath, time.time()-synced))
+                continue
+
+        compression = get_compression(bestmirrord, dsthost)
+        xcmdargs = cmdargs[:1]+compress.get_args(compression, skipsuffixes, compress.get_supported())+cmdargs[1:]
+        xcmdargs.append(dstuserhostpath)
+        print "name:             %s" % name
+        print "comment:          %s" % comment
+        print "sync from:        %s" % (srcuserhostpath,)
+        print "sync to:          %s" % (dstuserhostpath,)
+        print "excludes:         %s" % " ".join(excludes)
+        print "compression:      %s" % (compression,)
+        print "uselock:          %s" % str(globls.uselock and "yes" or "no")
+        print "email recipients: %s" % " ".join(email_recipients)
+        if globls.debug:
+            print xcmdargs
+
+        if not globls.yes:
+            reply = confirm("execute (y/n/q)? ")
+            if reply == "q":
+                print "quitting"
+                sys.exit(0)
+            if reply not in ["y"]:
+                print "skipped"
+                continue
+
+        transfers.append({
+            "cmdargs": xcmdargs,
+            "comment": comment,
+            "compression": compression,
+            "dsthost": dsthost,
+            "dstpath": dstpath,
+            "dstuser": dstuser,
+            "dstuserhostpath": dstuserhostpath,
+            "email_recipients": email_recipients,
+            "excludes": excludes,
+            "mirrord": bestmirrord,
+            "mirrorpath": mirrorpath,
+            "name": name,
+            "prefix": None,
+            "relay": None,
+            "report_path": None,
+            "returncode": None,
+            "srcdev": os.stat(mirrorpath).st_dev,
+            "srcpath": srcpath,
+            "srcuserhostpath": srcuserhostpath,
+            "stats": None,
+            "status": "pending",
+        })
+
+    for transferd in transfers:
+        link, budget, windows = get_bwlink(transferd)
+        transferd["bwlink"] = budget and link or None
+        transferd["bwbudget"] = budget and int(float(budget)*1000000/1024) or None
+        transferd["windows"] = bwsched.parse_windows(windows)
+
+    plan_fanout(transfers, bestmirrord)
+    return transfers
+
+def prune_batches(maxbytes):
+    """Remove oldest files from the batch spool until it holds at most
+    maxbytes.
+    """
+    entries = []
+    for name in os.listdir(BATCHES_DIRPATH):
+        path = os.path.join(BATCHES_DIRPATH, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    total = sum([size for _, size, _ in entries])
+    for _, size, path in entries:
+        if total <= maxbytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def prune_reports():
+    """Prune the report store according to "report_retention" in
+    defaults: "max_age_days" (default 90), "max_count" (default 10000)
+    and "max_mb" (default 2048). A null limit is not applied.
+    """
+    retentiond = globls.defaultsd.get("report_retention", {})
+    maxage = retentiond.get("max_age_days", 90)
+    maxcount = retentiond.get("max_count", 10000)
+    maxmb = retentiond.get("max_mb", 2048)
+    try:
+        nremoved = reportstore.prune(REPORTS_DIRPATH,
+            maxage != None and float(maxage)*86400 or None,
+            maxcount,
+            maxmb != None and int(float(maxmb)*1000000) or None)
+        if nremoved:
+            logger.info("pruned %s reports" % (nremoved,))
+    except:
+        logger.error("cannot prune reports")
+
+def register_bandwidth(transfers, nworkers):
+    """Register transfers about to run, up to nworkers at a time, with
+    their bandwidth links (see bwsched). run_transfer() releases or
+    unregisters them.
+    """
+    group = bwsched.new_group()
+    for transferd in transfers:
+        transferd["bwgroup"] = group
+        if transferd["bwlink"]:
+            bwsched.register(transferd["bwlink"], transferd["bwbudget"], group, nworkers)
+
+def release_lock(transferd):
+    """Release lock for the transfer.
+    """
+    if not globls.uselock:
+        return
+    lockmgr.release(LOCKS_DIRPATH, get_lock_key(transferd))
+
+def run_batched(transfers, nworkers):
+    """Run transfers computing the changes only once: the first
+    destination synced from the source is the reference and is synced
+    with --write-batch; the batch is then replayed (--read-batch) to
+    each destination which, by a dry run before, needed exactly the
+    same changes as the reference. Other destinations, and those
+    whose replay fails, are synced normally.
+
+    Batch files are kept in BATCHES_DIRPATH, which is pruned to
+    "batch_spool_max" MB (default 10240) and removed after use.
+    """
+    # not unhealthy ones: the dry runs would go to them, too
+    direct = [transferd for transferd in transfers \
+        if transferd["relay"] == None and transferd["status"] == "pending"]
+    if len(direct) < 2:
+        run_fanout(transfers, nworkers)
+        return
+
+    refd, others = direct[0], direct[1:]
+    itemizeds = run_pool(get_itemized, [refd]+others, nworkers)
+    refitemized, itemizeds = itemizeds[0], itemizeds[1:]
+    if refitemized == None:
+        log_transfer(refd, "batch: cannot get reference changes; not batching")
+        run_fanout(transfers, nworkers)
+        return
+
+    prune_batches(int(globls.defaultsd.get("batch_spool_max", 10240))*1000000)
+    fd, batchpath = tempfile.mkstemp(prefix="%s-" % get_datetimestamp(), suffix=".batch", dir=BATCHES_DIRPATH)
+    os.close(fd)
+    try:
+        refd["batch_write"] = batchpath
+        run_transfer(refd)
+
+        if refd["status"] == "ok":
+            for transferd, itemized in zip(others, itemizeds):
+                if itemized == refitemized:
+                    transferd["batch_read"] = batchpath
+                else:
+                    log_transfer(transferd, "batch: not in sync with reference (%s); syncing normally" % (refd["dsthost"],))
+        run_fanout([transferd for transferd in transfers if transferd is not refd], nworkers)
+
+        retries = [transferd for transferd in others if transferd.get("batch_read") and transferd["status"] != "ok"]
+        for transferd in retries:
+            log_transfer(transferd, "batch: replay failed; syncing normally")
+            transferd["batch_read"] = None
+        register_bandwidth(retries, nworkers)
+        run_pool(run_transfer, retries, nworkers)
+    finally:
+        for path in [batchpath, batchpath+".sh"]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def run_fanout(transfers, nworkers):
+    """Run transfers in waves, so that transfers relayed through
+    another destination start once that destination is done.
+    """
+    remaining = list(transfers)
+    while remaining:
+        ready = [transferd for transferd in remaining
+            if transferd["relay"] == None or transferd["relay"]["status"] not in ["pending", "running"]]
+        if not ready:
+            ready = remaining
+        remaining = [transferd for transferd in remaining if transferd not in ready]
+        run_pool(run_transfer, ready, nworkers)
+
+def run_pool(fn, items, nworkers):
+    """Call fn for each item using up to nworkers threads. Results
+    are returned in the order of items.
+    """
+    if nworkers <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+
+    q = Queue.Queue()
+    for i, item in enumerate(items):
+        q.put((i, item))
+    results = [None]*len(items)
+
+    def worker():
+        while True:
+            try:
+                i, item = q.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = fn(item)
+            except:
+                if globls.debug:
+                    traceback.print_exc()
+
+    threads = []
+    for _ in range(min(nworkers, len(items))):
+        th = threading.Thread(target=worker)
+        th.daemon = True
+        th.start()
+        threads.append(th)
+    for th in threads:
+        # join with timeout so that signals are handled
+        while th.is_alive():
+            th.join(1)
+    return results
+
+def run_prepared(transfers, title):
+    """Run prepared transfers (up to --suite-jobs concurrently),
+    slowest (based on past durations) first, and show a combined
+    summary.
+    """
+    if globls.dry:
+        for transferd in transfers:
+            print "running ..."
+            print " ".join(transferd["cmdargs"])
+        return transfers
+
+    register_bandwidth(transfers, globls.suitejobs)
+    check_health(transfers)
+
+    # unknown durations first, then longest first
+    durationsd = load_json_file(DURATIONS_FILEPATH)
+    for transferd in transfers:
+        transferd["expected"] = durationsd.get(get_duration_key(transferd))
+    transfers.sort(key=lambda transferd: (transferd["expected"] != None, -(transferd["expected"] or 0)))
+
+    logger.info("%s starting transfers=%s" % (title, len(transfers)))
+    for transferd in transfers:
+        transferd["prefix"] = "[%s] " % (transferd["dstuserhostpath"],)
+    run_scheduled(transfers, globls.suitejobs)
+    save_run_stats(transfers)
+    save_metrics(transfers)
+
+    show_summary(transfers, "%s summary" % (title,))
+    if globls.showtimings:
+        show_timings(transfers)
+    return transfers
+
+def run_rsync(transferd, cmdargs, repf):
+    """Run rsync command with output to the report (and console, if
+    showreport). Return exit value (STALL_EXIT_CODE if terminated; see
+    wait_rsyncs).
+    """
+    if globls.showreport:
+        p = subprocess.Popen(cmdargs,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            shell=False, close_fds=True)
+        teed = {"lock": threading.Lock(), "detached": False}
+        th = threading.Thread(target=tee_output, args=(p.stdout, repf, transferd["prefix"], teed))
+        th.daemon = True
+        th.start()
+    else:
+        p = subprocess.Popen(cmdargs,
+            stdout=repf, stderr=subprocess.STDOUT,
+            shell=False, close_fds=True)
+        th = None
+    exited = wait_rsyncs(transferd, [p], [repf])
+    if th:
+        th.join(not exited and transferd["stall"]["grace"] or None)
+        if th.is_alive():
+            # output still open (abandoned rsync or a child of it): the
+            # report is closed by the caller, so the tee must stop
+            # writing to it
+            with teed["lock"]:
+                teed["detached"] = True
+    if not exited:
+        repf.write("\nrmirr: terminated (%s)\n" % (transferd["terminated"],))
+        repf.flush()
+        return STALL_EXIT_CODE
+    return p.returncode
+
+def run_scheduled(transfers, nworkers):
+    """Run transfers using up to nworkers threads. Transfers are taken
+    in order, skipping over those which would exceed the per
+    destination host, source filesystem, or mirror ("max_parallel")
+    limits. --jobs does not apply.
+    """
+    cond = threading.Condition()
+    pending = list(transfers)
+    usedd = {}
+
+    def get_slots(transferd):
+        mirrord = transferd["mirrord"]
+        max_parallel = mirrord.get("max_parallel", globls.defaultsd.get("max_parallel"))
+        return [
+            (("host", transferd["dsthost"]), globls.hostjobs),
+            (("fs", transferd["srcdev"]), globls.fsjobs),
+            (("mirror", transferd["name"]), max_parallel and int(max_parallel) or nworkers),
+        ]
+
+    def take():
+        with cond:
+            while pending:
+                for transferd in pending:
+                    relayd = transferd["relay"]
+                    if relayd and relayd["status"] in ["pending", "running"]:
+                        continue
+                    slots = get_slots(transferd)
+                    if all(usedd.get(key, 0) < limit for key, limit in slots):
+                        pending.remove(transferd)
+                        for key, _ in slots:
+                            usedd[key] = usedd.get(key, 0)+1
+                        return transferd
+                cond.wait()
+            return None
+
+    def worker():
+        while True:
+            transferd = take()
+            if transferd == None:
+                return
+            try:
+                run_transfer(transferd)
+            except:
+                transferd["status"] = "failed"
+                if globls.debug:
+                    traceback.print_exc()
+            finally:
+                with cond:
+                    for key, _ in get_slots(transferd):
+                        usedd[key] -= 1
+                    cond.notify_all()
+
+    threads = []
+    for _ in range(min(nworkers, len(transfers))):
+        th = threading.Thread(target=worker)
+        th.daemon = True
+        th.start()
+        threads.append(th)
+    for th in threads:
+        while th.is_alive():
+            th.join(1)
+
+def run_shards(transferd, cmdargs, shards, repf):
+    """Run concurrent rsyncs for the shards of the transfer, plus a
+    root pass for everything outside the shard units (which also
+    deletes, with --delete, what is not in the source outside the
+    units; units are protected). The bandwidth limit is divided among
+    them. Their outputs are appended to the report followed by the
+    merged stats.
+
+    Return exit value: the first non-zero, if any (STALL_EXIT_CODE if
+    terminated; see wait_rsyncs).
+    """
+    units = sum(shards, [])
+    parts = [("root", shard.get_root_filter_args(units))]
+    for i, shardunits in enumerate(shards):
+        parts.append(("%s/%s" % (i+1, len(shards)), shard.get_filter_args(shardunits)))
+
+    for i, arg in enumerate(cmdargs):
+        if arg.startswith("--bwlimit="):
+            cmdargs = cmdargs[:i]+["--bwlimit=%d" % max(1, int(arg[10:])//len(parts))]+cmdargs[i+1:]
+            break
+
+    prefix = transferd["prefix"] or ""
+    partfiles = []
+    procs = []
+    try:
+        for partname, filterargs in parts:
+            partf = tempfile.TemporaryFile(dir=RMIRR_DIRPATH)
+            partfiles.append(partf)
+            partcmdargs = cmdargs[:-2]+filterargs+cmdargs[-2:]
+            log_transfer(transferd, "shard %s command=%s" % (partname, " ".join(partcmdargs)))
+            p = subprocess.Popen(partcmdargs,
+                stdout=partf, stderr=subprocess.STDOUT,
+                shell=False, close_fds=True)
+            procs.append(p)
+
+        returncode = 0
+        if not wait_rsyncs(transferd, procs, partfiles):
+            repf.write("rmirr: shards terminated (%s)\n\n" % (transferd["terminated"],))
+            returncode = STALL_EXIT_CODE
+        stats = []
+        for (partname, _), partf, p in zip(parts, partfiles, procs):
+            p.poll()
+            log_transfer(transferd, "shard %s exit=%s" % (partname, p.returncode))
+            if returncode == 0:
+                returncode = p.returncode
+            repf.write("rmirr: shard %s exit=%s\n\n" % (partname, p.returncode))
+            repf.flush()
+            partf.seek(0)
+            if globls.showreport:
+                tee_output(os.fdopen(os.dup(partf.fileno()), "rb"), repf, "%s[shard %s] " % (prefix, partname))
+            else:
+                shutil.copyfileobj(partf, repf)
+            repf.write("\n")
+
+            # stats are at the end
+            partf.seek(0, os.SEEK_END)
+            partf.seek(max(0, partf.tell()-65536))
+            stats.append(rsyncstats.parse(partf.read()))
+    finally:
+        stall.terminate([p for p in procs if p.poll() == None], 1)
+        for partf in partfiles:
+            partf.close()
+
+    repf.write("rmirr: merged stats (%s shards and root)\n\n" % (len(shards),))
+    repf.write(rsyncstats.format(rsyncstats.merge(stats)))
+    repf.flush()
+    return returncode
+
+def run_suite(suitename, mirrorname, mirrorpaths, mirrors):
+    """Run all transfers of a suite concurrently, slowest (based on
+    past durations) first, and show a combined summary.
+    """
+    transfers = []
+    for mirrorpath in mirrorpaths:
+        if transfers:
+            print
+        transfers.extend(prepare_transfers(mirrorname, mirrorpath, mirrors))
+    if not transfers:
+        return transfers
+    return run_prepared(transfers, "suite (%s)" % (suitename,))
+
+def run_transfer(transferd):
+    """Run a single prepared transfer (rsync to one destination).
+    Status and returncode are recorded in transferd.
+    """
+    name = transferd["name"]
+    xcmdargs = transferd["cmdargs"]
+    srcuserhostpath = transferd["srcuserhostpath"]
+    dstuserhostpath = transferd["dstuserhostpath"]
+    excludes = transferd["excludes"]
+    email_recipients = transferd["email_recipients"]
+
+    if transferd["status"] == "unhealthy":
+        if transferd["bwlink"]:
+            bwsched.unregister(transferd["bwlink"], transferd["bwgroup"])
+        return transferd
+
+    # single write so that parallel transfers do not interleave
+    sys.stdout.write("running (%s) ...\n" % (dstuserhostpath,))
+    transferd["status"] = "running"
+    transferd["started"] = time.time()
+    transferd["timings"] = timingsd = {}
+    try:
+        repf = None
+        planned = None
+        filesfrom_path = None
+        bwshare = None
+        locked = False
+
+        log_transfer(transferd, "starting")
+        log_transfer(transferd, "name=%s" % name)
+        log_transfer(transferd, "comment=%s" % transferd["comment"])
+        log_transfer(transferd, "from=%s" % srcuserhostpath)
+        log_transfer(transferd, "to=%s" % dstuserhostpath)
+        log_transfer(transferd, "excludes=%s" % " ".join(excludes))
+        log_transfer(transferd, "uselock=%s" % str(globls.uselock and "yes" or "no"))
+        log_transfer(transferd, "email recipients=%s" % " ".join(email_recipients))
+
+        try:
+            # wait for the window before locking, not holding the lock
+            windows = transferd["windows"]
+            if windows:
+                now = datetime.datetime.now()
+                waitmins = bwsched.minutes_until_window(windows, now.hour*60+now.minute)
+                if waitmins and not globls.windowwait:
+                    sys.stdout.write("info: outside transfer window (%s); deferring\n" % (dstuserhostpath,))
+                    log_transfer(transferd, "outside transfer window; deferred")
+                    transferd["status"] = "deferred"
+                    return transferd
+                elif waitmins:
+                    sys.stdout.write("info: outside transfer window (%s); waiting %s minutes\n" % (dstuserhostpath, waitmins))
+                    log_transfer(transferd, "outside transfer window; waiting %s minutes" % (waitmins,))
+                    started = time.time()
+                    time.sleep(waitmins*60-now.second)
+                    add_timing(timingsd, "wait", started)
+
+            started = time.time()
+            if not acquire_lock(transferd):
+                transferd["status"] = "failed"
+                return transferd
+            locked = True
+            add_timing(timingsd, "lock", started)
+
+            relayd = transferd["relay"]
+            if relayd and relayd["status"] != "ok":
+                sys.stdout.write("warning: relay (%s) failed; syncing (%s) from source\n" \
+                    % (relayd["dsthost"], dstuserhostpath))
+                log_transfer(transferd, "relay (%s) failed; syncing from source" % (relayd["dsthost"],))
+                relayd = transferd["relay"] = None
+
+            filesfrom = transferd.get("filesfrom")
+            if relayd:
+                # the whole tree is synced from the relay
+                filesfrom = None
+            elif transferd.get("batch_write") or transferd.get("batch_read"):
+                # batches apply to the whole tree
+                filesfrom = None
+            elif filesfrom == None:
+                started = time.time()
+                planned = plan_manifest(transferd)
+                add_timing(timingsd, "plan", started)
+            if planned:
+                if planned["mode"] == "skip":
+                    sys.stdout.write("info: no changes since last sync (%s); skipping\n" % (dstuserhostpath,))
+                    log_transfer(transferd, "manifest: no changes; skipping")
+                    transferd["status"] = "ok"
+                    transferd["unchanged"] = True
+                    return transferd
+                elif planned["mode"] == "files":
+                    log_transfer(transferd, "manifest: changed=%s" % len(planned["changed"]))
+                    filesfrom = planned["changed"]
+                else:
+                    log_transfer(transferd, "manifest: full sync")
+
+            shards = None
+            if filesfrom == None and not relayd \
+                and not transferd.get("batch_write") and not transferd.get("batch_read"):
+                shards = get_shard_plan(transferd)
+                if shards:
+                    log_transfer(transferd, "shards=%s units=%s" % (len(shards), sum(map(len, shards))))
+
+            if transferd["bwlink"]:
+                bwshare = bwsched.acquire(transferd["bwlink"], transferd["bwgroup"])
+                log_transfer(transferd, "bwlimit=%s link=%s" % (bwshare, transferd["bwlink"]))
+                xcmdargs = xcmdargs[:1]+["--bwlimit=%d" % bwshare]+xcmdargs[1:]
+
+            policyd = get_retry_policy(transferd)
+            if policyd["max_attempts"] > 1:
+                # keep interrupted files to resume them
+                if policyd["partial_dir"]:
+                    xcmdargs = xcmdargs[:1]+["--partial-dir=%s" % policyd["partial_dir"]]+xcmdargs[1:]
+                else:
+                    xcmdargs = xcmdargs[:1]+["--partial"]+xcmdargs[1:]
+
+            if filesfrom != None:
+                fd, filesfrom_path = tempfile.mkstemp(suffix=".files", dir=RMIRR_DIRPATH)
+                with os.fdopen(fd, "w") as f:
+                    for relpath in filesfrom:
+                        f.write("%s\n" % relpath)
+                missingarg = globls.allowdelete and "--delete-missing-args" or "--ignore-missing-args"
+                xcmdargs = xcmdargs[:-2]+["--files-from=%s" % filesfrom_path, missingarg]+xcmdargs[-2:]
+
+            repf, report_path  = open_report()
+            transferd["report_path"] = report_path
+            log_transfer(transferd, "report=%s" % report_path)
+
+            started = time.time()
+            if relayd:
+                xcmdargs = get_relay_cmdargs(transferd, xcmdargs)
+                repf.write("rmirr: relayed via %s\n\n" % (relayd["dstuserhostpath"],))
+                repf.flush()
+                log_transfer(transferd, "relay via=%s" % (relayd["dstuserhostpath"],))
+            else:
+                rshcmd = get_rsh(transferd, transferd["dstuser"], transferd["dsthost"])
+                if rshcmd:
+                    xcmdargs = xcmdargs[:1]+["-e", rshcmd]+xcmdargs[1:]
+                if transferd.get("batch_write"):
+                    xcmdargs = xcmdargs[:-2]+["--write-batch=%s" % transferd["batch_write"]]+xcmdargs[-2:]
+                    log_transfer(transferd, "batch write=%s" % (transferd["batch_write"],))
+                elif transferd.get("batch_read"):
+                    # the batch replaces the source
+                    xcmdargs = xcmdargs[:-2]+["--read-batch=%s" % transferd["batch_read"]]+xcmdargs[-1:]
+                    log_transfer(transferd, "batch read=%s" % (transferd["batch_read"],))
+            add_timing(timingsd, "ssh", started)
+
+            log_transfer(transferd, "command=%s" % " ".join(xcmdargs))
+            transferd["stall"] = get_stall_policy(transferd)
+            if transferd["stall"]["max_runtime"]:
+                transferd["deadline"] = time.time()+transferd["stall"]["max_runtime"]
+            log_transfer(transferd, "stall timeout=%s max_runtime=%s" \
+                % (transferd["stall"]["timeout"], transferd["stall"]["max_runtime"]))
+            transferd["attempts"] = []
+            while True:
+                attemptd = {"attempt": len(transferd["attempts"])+1, "started": time.time()}
+                transferd["terminated"] = None
+                if policyd["max_attempts"] > 1:
+                    repf.write("rmirr: attempt %s of %s\n\n" % (attemptd["attempt"], policyd["max_attempts"]))
+                    repf.flush()
+                if shards:
+                    returncode = run_shards(transferd, xcmdargs, shards, repf)
+                else:
+                    returncode = run_rsync(transferd, xcmdargs, repf)
+                attemptd["ended"] = time.time()
+                attemptd["returncode"] = returncode
+                attemptd["terminated"] = transferd["terminated"]
+                transferd["attempts"].append(attemptd)
+                log_transfer(transferd, "attempt=%s exit=%s" % (attemptd["attempt"], returncode))
+
+                if returncode == 0 \
+                    or attemptd["attempt"] >= policyd["max_attempts"] \
+                    or returncode not in policyd["exit_codes"] \
+                    or transferd["terminated"] == "deadline":
+                    break
+                delay = get_retry_delay(policyd, attemptd["attempt"])
+                if transferd.get("deadline") and time.time()+delay >= transferd["deadline"]:
+                    log_transfer(transferd, "no time left for a retry before max runtime")
+                    break
+                sys.stdout.write("warning: non-zero exit value (%s) for (%s); retrying in %ds\n" % (returncode, dstuserhostpath, delay))
+                log_transfer(transferd, "retrying in %ds" % (delay,))
+                repf.write("\nrmirr: exit %s; retrying in %ds\n\n" % (returncode, delay))
+                repf.flush()
+                started = time.time()
+                time.sleep(delay)
+                add_timing(timingsd, "wait", started)
+
+            transferd["returncode"] = returncode
+            if returncode != 0:
+                sys.stdout.write("warning: non-zero exit value (%s) for (%s)\n" % (returncode, dstuserhostpath))
+                transferd["status"] = "failed"
+            else:
+                transferd["status"] = "ok"
+            log_transfer(transferd, "exit=%s attempts=%s" % (returncode, len(transferd["attempts"])))
+
+            repf.close()
+            repf = None
+            started = time.time()
+            save_run_record(transferd)
+            add_timing(timingsd, "report", started)
+            set_rsync_timings(transferd)
+
+            if planned and transferd["status"] == "ok" and not globls.dryrsync:
+                update_manifest(transferd, planned)
+
+            if globls.mailreport:
+                try:
+                    started = time.time()
+                    subject = "rmirr report for %s (%s)" % (name, os.path.basename(transferd["report_path"]))
+                    sendreport(email_recipients, subject, transferd)
+                    add_timing(timingsd, "mail", started)
+                except:
+                    #traceback.print_exc()
+                    log_transfer(transferd, "failed to send report", logging.ERROR)
+                    print "error: failed to send report"
+        except:
+            transferd["status"] = "failed"
+            raise RmirrException("mirror failure")
+    except RmirrException as e:
+        log_transfer(transferd, e)
+    finally:
+        if repf != None:
+            repf.close()
+        if locked:
+            release_lock(transferd)
+        if bwshare != None:
+            bwsched.release(transferd["bwlink"], transferd["bwgroup"], bwshare)
+        elif transferd["bwlink"]:
+            bwsched.unregister(transferd["bwlink"], transferd["bwgroup"])
+        if filesfrom_path != None:
+            try:
+                os.remove(filesfrom_path)
+            except:
+                pass
+        transferd["ended"] = time.time()
+        log_transfer(transferd, "timings %s" % (format_timings(timingsd, TIMING_PHASES),))
+        save_run_db(transferd)
+        log_transfer(transferd, "done")
+    return transferd
+
+def save_metrics(transfers):
+    """Update the Prometheus textfile ("metrics_textfile" in defaults,
+    or --metrics-file) with completed transfers, labelled by mirror
+    name and destination host.
+    """
+    path = globls.metricspath or globls.defaultsd.get("metrics_textfile")
+    if not path or globls.dryrsync:
+        return
+
+    setd = {}
+    incd = {}
+    for transferd in transfers:
+        if transferd["status"] not in ["ok", "failed"] or not transferd.get("ended"):
+            continue
+        labelsd = {"mirror": transferd["name"], "destination": transferd["dsthost"]}
+        statsd = transferd.get("stats") or {}
+        failed = transferd["status"] == "failed"
+        setd[metrics.get_key("rmirr_bytes_transferred", **labelsd)] = statsd.get("bytes_sent", 0)+statsd.get("bytes_received", 0)
+        setd[metrics.get_key("rmirr_files_changed", **labelsd)] = statsd.get("files_transferred", 0)
+        setd[metrics.get_key("rmirr_last_run_success", **labelsd)] = not failed and 1 or 0
+        setd[metrics.get_key("rmirr_last_run_timestamp_seconds", **labelsd)] = transferd["ended"]
+        setd[metrics.get_key("rmirr_lock_wait_seconds", **labelsd)] = transferd.get("lock_wait") or 0
+        setd[metrics.get_key("rmirr_run_duration_seconds", **labelsd)] = transferd["ended"]-transferd["started"]
+        for phase in TIMING_PHASES:
+            setd[metrics.get_key("rmirr_phase_duration_seconds", phase=phase, **labelsd)] = transferd["timings"].get(phase, 0)
+        key = metrics.get_key("rmirr_failures_total", **labelsd)
+        incd[key] = incd.get(key, 0)+(failed and 1 or 0)
+        key = metrics.get_key("rmirr_runs_total", **labelsd)
+        incd[key] = incd.get(key, 0)+1
+    if not setd:
+        return
+    try:
+        metrics.update(os.path.expanduser(path), setd, incd)
+    except:
+        logger.error("cannot update metrics (%s)" % (path,))
+
+def save_run_db(transferd):
+    """Add completed (ok or failed) transfer to the run database.
+    """
+    if transferd["status"] not in ["ok", "failed"]:
+        return
+    try:
+        rundb.add_run(RUNDB_FILEPATH, {
+            "name": transferd["name"],
+            "mirrorpath": transferd["mirrorpath"],
+            "srcuserhostpath": transferd["srcuserhostpath"],
+            "dsthost": transferd["dsthost"],
+            "dstuserhostpath": transferd["dstuserhostpath"],
+            "started": transferd["started"],
+            "ended": transferd["ended"],
+            "duration": round(transferd["ended"]-transferd["started"], 3),
+            "returncode": transferd["returncode"],
+            "attempts": len(transferd.get("attempts", [])),
+            "lock_wait": transferd.get("lock_wait"),
+            "status": transferd["status"],
+            "timings": transferd.get("timings"),
+            "unchanged": bool(transferd.get("unchanged")),
+            "dryrun": globls.dryrsync,
+            # only some files (--files-from) of mirrorpath were synced
+            "partial": transferd.get("filesfrom") != None,
+            "report_path": transferd["report_path"],
+            "stats": transferd["stats"],
+        })
+    except:
+        log_transfer(transferd, "cannot save run to database", logging.ERROR)
+
+def save_run_record(transferd):
+    """Parse rsync stats from the report and save a machine-readable
+    run record next to it (.json). A summary goes to the history.
+    """
+    report_path = transferd["report_path"]
+    try:
+        statsd = rsyncstats.parse_file(report_path)
+    except:
+        statsd = {}
+    transferd["stats"] = statsd
+
+    # compress finished report
+    method = globls.defaultsd.get("report_compress", "gzip")
+    try:
+        report_path = reportstore.compress(report_path, method)
+        transferd["report_path"] = report_path
+    except:
+        log_transfer(transferd, "cannot compress report (%s)" % (report_path,), logging.ERROR)
+
+    duration = time.time()-transferd["started"]
+    recordd = {
+        "name": transferd["name"],
+        "mirrorpath": transferd["mirrorpath"],
+        "from": transferd["srcuserhostpath"],
+        "to": transferd["dstuserhostpath"],
+        "dsthost": transferd["dsthost"],
+        "started": transferd["started"],
+        "duration": round(duration, 3),
+        "returncode": transferd["returncode"],
+        "attempts": transferd.get("attempts", []),
+        "lock_wait": transferd.get("lock_wait"),
+        "report_path": report_path,
+        "stats": statsd,
+    }
+    if duration > 0 and "bytes_sent" in statsd:
+        recordd["mb_per_sec"] = round((statsd["bytes_sent"]+statsd.get("bytes_received", 0))/duration/1000000.0, 3)
+
+    try:
+        record_path = "%s.json" % reportstore.get_stem(report_path)
+        with open(record_path, "w") as f:
+            json.dump(recordd, f, indent=1, sort_keys=True)
+        transferd["record_path"] = record_path
+    except:
+        log_transfer(transferd, "cannot save run record", logging.ERROR)
+
+    try:
+        reportstore.add(REPORTS_DIRPATH, {
+            "dsthost": transferd["dsthost"],
+            "name": transferd["name"],
+            "record_path": transferd.get("record_path"),
+            "report_path": report_path,
+            "returncode": transferd["returncode"],
+            "size": os.path.getsize(report_path),
+            "started": transferd["started"],
+        })
+    except:
+        log_transfer(transferd, "cannot index report", logging.ERROR)
+
+    log_transfer(transferd, "stats files=%s transferred=%s sent=%s received=%s literal=%s matched=%s speedup=%s duration=%s mb_per_sec=%s" \
+        % (statsd.get("files"), statsd.get("files_transferred"),
+            statsd.get("bytes_sent"), statsd.get("bytes_received"),
+            statsd.get("literal_data"), statsd.get("matched_data"),
+            statsd.get("speedup"), recordd["duration"], recordd.get("mb_per_sec")))
+    return recordd
+
+def save_run_stats(transfers):
+    """Update durations, idle (longest time without progress; see
+    get_stall_policy) and link statistics files with completed
+    transfers.
+    """
+    durationsd = load_json_file(DURATIONS_FILEPATH)
+    idled = load_json_file(IDLE_FILEPATH)
+    linkstatsd = load_json_file(LINKSTATS_FILEPATH)
+    for transferd in transfers:
+        if transferd["status"] != "ok" or not transferd.get("ended") or transferd.get("unchanged"):
+            continue
+        duration = transferd["ended"]-transferd["started"]
+        durationsd[get_duration_key(transferd)] = round(duration, 3)
+
+        # decay so that the stall timeout follows the link down, too
+        if "max_idle" in transferd:
+            key = get_duration_key(transferd)
+            idled[key] = round(max(transferd["max_idle"], 0.75*idled.get(key, 0)), 3)
+
+        # only transfers moving real data say something about the link
+        statsd = transferd["stats"] or {}
+        literal = statsd.get("literal_data", 0)
+        if literal >= LINKSTATS_MIN_BYTES and duration > 0 and not transferd["relay"]:
+            key = "%s:%s" % (transferd["name"], transferd["dsthost"])
+            linkstatd = linkstatsd.setdefault(key, {})
+            linkstatd["mb_per_sec"] = round((statsd.get("bytes_sent", 0)+statsd.get("bytes_received", 0))/duration/1000000.0, 3)
+            if transferd["compression"] not in [None, False, "off", "none"]:
+                linkstatd["ratio"] = round(float(statsd.get("bytes_sent", 0))/literal, 3)
+                linkstatd["ratio_time"] = int(transferd["ended"])
+
+    for path, d in [(DURATIONS_FILEPATH, durationsd), (IDLE_FILEPATH, idled), (LINKSTATS_FILEPATH, linkstatsd)]:
+        try:
+            fd, tmppath = tempfile.mkstemp(dir=RMIRR_DIRPATH)
+            with os.fdopen(fd, "w") as f:
+                json.dump(d, f)
+            os.rename(tmppath, path)
+        except:
+            logger.error("cannot save (%s)" % (path,))
+
+def send_digests():
+    """Queue one message per set of recipients with the report
+    summaries collected since the last call.
+    """
+    with _digest_mutex:
+        digests = sorted(_digestd.items())
+        _digestd.clear()
+
+    sender = "%s@%s" % (whoami(), socket.getfqdn())
+    for recipients, items in digests:
+        nok = len([status for status, _ in items if status == "ok"])
         parts = [
             "From: %s\r\n" % sender,
             "To: %s\r\n" % ", ".join(recipients),
-            "Subject: %s\r\n" % subject,
+            "Subject: rmirr digest: %s reports (ok %s, failed %s)\r\n" % (len(items), nok, len(items)-nok),
             "\r\n",
-            "Name:        %s\n" % name,
-            "From:        %s\n" % srcuserhostpath,
-            "To:          %s\n" % dstuserhostpath,
-            "Excludes:    %s\n" % " ".join(excludes),
-            "Report path: %s\n" % report_path,
-            "\n",
-            "Report:\n",
-            open(report_path, "r").read(),
         ]
-        server = smtplib.SMTP("localhost")
-        server.sendmail(sender, recipients, "".join(parts))
-        server.quit()
+        for status, body in items:
+            parts.append("=" * 72+"\n")
+            parts.append("Status:      %s\n" % (status,))
+            parts.append(body)
+            parts.append("\n")
+        mailer.send(globls.defaultsd.get("smtp_host", "localhost"), int(globls.defaultsd.get("smtp_port", 25)),
+            sender, list(recipients), "".join(parts))
+        logger.info("digest queued for (%s) reports=%s" % (", ".join(recipients), len(items)))
+
+def sendreport(recipients, subject, transferd):
+    """Mail a summary of the report of the transfer (see
+    get_report_summary). With --mail-digest (or "mail_digest"), the
+    summary is added to the digest for the recipients instead (see
+    send_digests). Mail is sent in the background (see mailer).
+    """
+    if not recipients:
+        return
+    body = get_report_summary(transferd)
+    if globls.maildigest:
+        with _digest_mutex:
+            _digestd.setdefault(tuple(sorted(recipients)), []).append((transferd["status"], body))
+        return
+
+    sender = "%s@%s" % (whoami(), socket.getfqdn())
+    headers = [
+        "From: %s\r\n" % sender,
+        "To: %s\r\n" % ", ".join(recipients),
+        "Subject: %s\r\n" % subject,
+        "\r\n",
+    ]
+    mailer.send(globls.defaultsd.get("smtp_host", "localhost"), int(globls.defaultsd.get("smtp_port", 25)),
+        sender, recipients, "".join(headers)+body)
+
+def set_rsync_timings(transferd):
+    """Split the time spent running rsync (all attempts) into building
+    and sending the file list ("filelist", from rsync's stats) and the
+    rest ("transfer").
+    """
+    statsd = transferd.get("stats") or {}
+    rsynctime = sum([attemptd["ended"]-attemptd["started"] for attemptd in transferd["attempts"]])
+    filelist = min(rsynctime, statsd.get("file_list_gen_time", 0)+statsd.get("file_list_xfer_time", 0))
+    transferd["timings"]["filelist"] = round(filelist, 3)
+    transferd["timings"]["transfer"] = round(rsynctime-filelist, 3)
 
 def setup():
     """Setup. Includes working paths.
@@ -354,6 +2128,16 @@ def setup():
         os.mkdir(LOCKS_DIRPATH)
     if not os.path.exists(REPORTS_DIRPATH):
         os.mkdir(REPORTS_DIRPATH)
+    if not os.path.exists(MANIFESTS_DIRPATH):
+        os.mkdir(MANIFESTS_DIRPATH)
+    if not os.path.exists(BATCHES_DIRPATH):
+        os.mkdir(BATCHES_DIRPATH, 0700)
+    if not os.path.exists(SHARDS_DIRPATH):
+        os.mkdir(SHARDS_DIRPATH)
+    if not os.path.exists(SSH_DIRPATH):
+        os.mkdir(SSH_DIRPATH, 0700)
+    if not os.path.exists(VERIFY_DIRPATH):
+        os.mkdir(VERIFY_DIRPATH)
 
     setup_logger()
 
@@ -365,6 +2149,29 @@ def setup_logger():
         level=logging.NOTSET)
     logger = logging.getLogger()
 
+def show_history(mirrorname, dsthosts, since, status, limit):
+    """List runs from the run database, newest first.
+    """
+    print "%-19s  %-20s %-20s %-9s %-4s %-3s %8s %10s %12s  %s" \
+        % ("started", "name", "destination", "status", "exit", "try", "wait", "duration", "sent", "path")
+    if globls.showtimings:
+        print "%21s%s" % ("", " ".join(["%8s" % phase for phase in TIMING_PHASES]))
+    for rund in rundb.query(RUNDB_FILEPATH, mirrorname, dsthosts, since, status, limit):
+        status = rund["status"]
+        if rund["unchanged"]:
+            status = "unchanged"
+        elif rund["dryrun"]:
+            status += "/dry"
+        elif rund["partial"]:
+            status += "/part"
+        print "%-19s  %-20s %-20s %-9s %-4s %-3s %8.1f %10.1f %12s  %s" % (
+            time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(rund["started"])),
+            rund["name"], rund["dsthost"], status, rund["returncode"], rund["attempts"] or "-",
+            rund["lock_wait"] or 0,
+            rund["duration"] or 0, rund["bytes_sent"], rund["mirrorpath"])
+        if globls.showtimings and rund["timings"]:
+            print "%21s%s" % ("", " ".join(["%8.3f" % rund["timings"].get(phase, 0) for phase in TIMING_PHASES]))
+
 def show_list(suitesd, mirrors):
     sep = None
 
@@ -392,6 +2199,100 @@ def show_list(suitesd, mirrors):
         print "destinations:     %s" % ", ".join(mirrord.get("destinations",[]))
         print "email recipients: %s" % " ".join(mirrord.get("email_recipients", []))
 
+def show_reports(mirrorname, dsthosts):
+    """List indexed reports, oldest first.
+    """
+    for dsthost in dsthosts or [None]:
+        for entryd in reportstore.find(REPORTS_DIRPATH, mirrorname, dsthost):
+            print "%s  %-20s %-20s exit=%-4s %10s  %s" % (
+                time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(entryd.get("started", 0))),
+                entryd.get("name"), entryd.get("dsthost"), entryd.get("returncode"),
+                entryd.get("size"), entryd.get("report_path"))
+
+def show_summary(transfers, title="summary"):
+    """Show per-destination outcome of transfers.
+    """
+    print "%s:" % (title,)
+    for transferd in transfers:
+        if transferd["status"] == "ok" and transferd.get("unchanged"):
+            print "    ok      %s (unchanged)" % (transferd["dstuserhostpath"],)
+        elif transferd["status"] == "ok" and transferd["relay"]:
+            print "    ok      %s (via %s)" % (transferd["dstuserhostpath"], transferd["relay"]["dsthost"])
+        elif transferd["status"] == "ok":
+            print "    ok      %s" % (transferd["dstuserhostpath"],)
+        elif transferd["status"] == "deferred":
+            print "    deferred %s (outside transfer window)" % (transferd["dstuserhostpath"],)
+        elif transferd["status"] == "unhealthy":
+            print "    skipped %s (unhealthy: %s)" % (transferd["dstuserhostpath"], transferd["health"])
+        elif transferd.get("terminated") == "stalled":
+            print "    failed  %s (exit %s, stalled)" % (transferd["dstuserhostpath"], transferd["returncode"])
+        elif transferd.get("terminated") == "deadline":
+            print "    failed  %s (exit %s, max runtime exceeded)" % (transferd["dstuserhostpath"], transferd["returncode"])
+        else:
+            print "    failed  %s (exit %s)" % (transferd["dstuserhostpath"], transferd["returncode"])
+    nok = len([transferd for transferd in transfers if transferd["status"] == "ok"])
+    ndeferred = len([transferd for transferd in transfers if transferd["status"] == "deferred"])
+    nunhealthy = len([transferd for transferd in transfers if transferd["status"] == "unhealthy"])
+    logger.info("%s name=%s ok=%s failed=%s deferred=%s unhealthy=%s" \
+        % (title, transfers[0]["name"], nok, len(transfers)-nok-ndeferred-nunhealthy, ndeferred, nunhealthy))
+
+def show_timings(transfers):
+    """Show time spent per phase for each transfer.
+    """
+    print "timings:"
+    print "    %-40s %s %8s" % ("destination", " ".join(["%8s" % phase for phase in TIMING_PHASES]), "total")
+    for transferd in transfers:
+        timingsd = transferd.get("timings")
+        if timingsd == None:
+            continue
+        total = (transferd.get("ended") or time.time())-transferd["started"]
+        print "    %-40s %s %8.3f" % (transferd["dstuserhostpath"],
+            " ".join(["%8.3f" % timingsd.get(phase, 0) for phase in TIMING_PHASES]), total)
+
+def tee_output(pipef, repf, prefix, teed=None):
+    """Copy output from pipef to the report file and the console as
+    it arrives (blocking reads, no polling). If prefix is set, console
+    output is written in whole lines, each with the prefix, so that
+    parallel transfers do not interleave. If teed is given, report
+    writes are made under teed["lock"], and stop once teed["detached"]
+    is set.
+    """
+    fd = pipef.fileno()
+    partial = ""
+    while True:
+        s = os.read(fd, 65536)
+        if s == "":
+            break
+        if teed == None:
+            repf.write(s)
+        else:
+            with teed["lock"]:
+                if not teed["detached"]:
+                    repf.write(s)
+        if prefix == None:
+            sys.stdout.write(s)
+            sys.stdout.flush()
+        else:
+            lines = (partial+s).split("\n")
+            partial = lines.pop()
+            if lines:
+                with _console_lock:
+                    sys.stdout.write("".join(["%s%s\n" % (prefix, line) for line in lines]))
+                    sys.stdout.flush()
+    if partial:
+        with _console_lock:
+            sys.stdout.write("%s%s\n" % (prefix, partial))
+            sys.stdout.flush()
+    pipef.close()
+
+def update_manifest(transferd, planned):
+    """Record the source tree as synced to the destination.
+    """
+    try:
+        manifest.save(get_manifest_path(transferd), planned["entries"], planned["full_sweep"])
+    except:
+        log_transfer(transferd, "cannot save manifest", logging.ERROR)
+
 def userhostpath_join(user, host, path):
     """Join user, host, and path components.
     """
@@ -424,6 +2325,97 @@ def userhostpath_split(userhostpath):
         host, path = rest, None
     return user, host, path
 
+def verify_transfer(transferd, cached, relpaths, relprefix, hashname):
+    """Check the destination of the transfer against cached source
+    checksums of relpaths (relative to the mirror source). Results
+    go to a report and transferd["verify"].
+    """
+    if transferd["status"] == "unhealthy":
+        return
+    mirrord = transferd["mirrord"]
+    dstrelpaths = [relpath[len(relprefix):].lstrip("/") for relpath in relpaths]
+    userhost = "%s@%s" % (transferd["dstuser"], transferd["dsthost"])
+    rshargs = shlex.split(get_rsh(transferd, transferd["dstuser"], transferd["dsthost"]) \
+        or os.environ.get("RSYNC_RSH", "ssh"))
+    log_transfer(transferd, "verify: checking=%s hash=%s" % (len(relpaths), hashname))
+    try:
+        remoted = verify.get_remote_digests(rshargs, userhost, transferd["dstpath"], dstrelpaths, hashname)
+    except:
+        log_transfer(transferd, "verify: cannot get remote checksums", logging.ERROR)
+        return
+    remoted = dict([(relpath, remoted[dstrelpath]) \
+        for relpath, dstrelpath in zip(relpaths, dstrelpaths) if dstrelpath in remoted])
+    mismatches = verify.compare(cached, relpaths, remoted)
+    verifyd = transferd["verify"] = {"checked": len(relpaths), "mismatches": mismatches}
+    log_transfer(transferd, "verify: checked=%s mismatches=%s" % (len(relpaths), len(mismatches)))
+
+    repf, report_path = open_report()
+    try:
+        repf.write("rmirr: verify %s -> %s\n" % (transferd["srcuserhostpath"], transferd["dstuserhostpath"]))
+        repf.write("hash=%s checked=%s mismatches=%s\n\n" % (hashname, len(relpaths), len(mismatches)))
+        for relpath, reason in mismatches:
+            repf.write("MISMATCH %-8s %s\n" % (reason, relpath))
+    finally:
+        repf.close()
+    try:
+        report_path = reportstore.compress(report_path, globls.defaultsd.get("report_compress", "gzip"))
+        reportstore.add(REPORTS_DIRPATH, {
+            "dsthost": transferd["dsthost"],
+            "name": transferd["name"],
+            "report_path": report_path,
+            "returncode": len(mismatches) and 1 or 0,
+            "size": os.path.getsize(report_path),
+            "started": time.time(),
+            "verify": True,
+        })
+    except:
+        log_transfer(transferd, "cannot store report", logging.ERROR)
+    verifyd["report_path"] = report_path
+    log_transfer(transferd, "verify: report=%s" % (report_path,))
+
+    if mismatches and (globls.verifyfix or mirrord.get("verify_resync", globls.defaultsd.get("verify_resync", False))):
+        # only mismatched files, compared by checksum
+        resyncd = dict(transferd)
+        resyncd.update({
+            "cmdargs": transferd["cmdargs"][:1]+["--checksum"]+transferd["cmdargs"][1:],
+            "filesfrom": [relpath[len(relprefix):].lstrip("/") for relpath, _ in mismatches],
+            "relay": None,
+            "report_path": None,
+            "returncode": None,
+            "stats": None,
+            "status": "pending",
+        })
+        log_transfer(transferd, "verify: re-syncing %s files" % (len(mismatches),))
+        register_bandwidth([resyncd], 1)
+        run_transfer(resyncd)
+        verifyd["resync"] = resyncd["status"]
+
+def wait_rsyncs(transferd, procs, files):
+    """Wait for the rsyncs (writing to files) of the transfer. If one
+    makes no progress for the stall timeout, or the maximum runtime
+    is reached, all are terminated and the reason is recorded
+    ("terminated"). The longest time without progress of runs which
+    were not terminated is recorded ("max_idle"). Return True if all
+    exited on their own.
+    """
+    policyd = transferd["stall"]
+    reason, maxidle = stall.wait(procs, files, policyd["timeout"], transferd.get("deadline"))
+    if reason == None:
+        if maxidle != None:
+            transferd["max_idle"] = round(max(transferd.get("max_idle", 0), maxidle), 3)
+        return True
+
+    if reason == "stalled":
+        msg = "no progress for %ds" % (policyd["timeout"],)
+    else:
+        msg = "maximum runtime (%ds) reached" % (policyd["max_runtime"],)
+    transferd["terminated"] = reason
+    sys.stdout.write("warning: %s (%s); terminating\n" % (msg, transferd["dstuserhostpath"]))
+    log_transfer(transferd, "%s; terminating" % (msg,), logging.WARNING)
+    if not stall.terminate(procs, policyd["grace"]):
+        log_transfer(transferd, "rsync did not exit; abandoning it", logging.ERROR)
+    return False
+
 def whoami():
     try:
         return pwd.getpwuid(os.getuid()).pw_name
@@ -436,18 +2428,30 @@ def print_usage():
 usage: %(progname)s [<options>] [-n <name>] -p <path>
        %(progname)s [<options>] [-n <name>] -s <suitename>
        %(progname)s [<options>] -n <name>
+       %(progname)s [<options>] [-n <name>] (-p <path>|-s <suitename>) --plan <path>
+       %(progname)s [<options>] --execute-plan <path>
+       %(progname)s --history [-n <name>] [-d <hostname>[,...]] [--since <duration>]
+                [--status <status>] [--limit <n>] [--timings]
        %(progname)s -l
+       %(progname)s --reports [-n <name>] [-d <hostname>[,...]]
 
 Mirror file objects which can be specified by <path> (for which a
 mirror is selected), <suite> (representing one or more paths), or
 <name> (a mirror configuration).
 
 Where:
+--history
+        List past runs (newest first) from the run database. Filter
+        by mirror name, destinations, --since (e.g., 90m, 12h, 7d),
+        --status (ok, failed), and --limit (default 20) the number.
+        With --timings, show time spent per phase.
 -l      List mirror configurations.
 -n <name>
         Mirror name.
 -p <path>
         Mirror path.
+--reports
+        List stored reports (optionally, of a mirror and destinations).
 -s <suitename>
         Alias for one or more paths.
 
@@ -463,19 +2467,117 @@ Options:
 --dry   Dry run. Do not execute.
 --dry-rsync
         Dry run for rsync.
+--execute-plan <path>
+        Run the transfers of a plan made with --plan, without asking
+        for confirmation. --delete and --dry-rsync are taken from the
+        plan.
+--fs-jobs <n>
+        With --suite-jobs, run up to <n> transfers in parallel from the
+        same source filesystem. Default is 2.
+--full
+        Do a full sync even if a manifest shows few or no changes.
+--host-jobs <n>
+        With --suite-jobs, run up to <n> transfers in parallel to the
+        same destination host. Default is 2.
+--itemize
+        Have rsync itemize changes in the report. A mirror may set
+        "itemize_changes" to always do so.
+--jobs <n>
+        Run up to <n> destination transfers in parallel. A mirror
+        may set "max_parallel" to cap this further.
+--lock-wait <duration>
+        Wait up to <duration> (e.g., 90s, 10m) for a lock held by
+        another run instead of failing at once. Locks are per mirror,
+        destination and path; transfers of non-overlapping paths or to
+        other destinations do not wait.
+--max-attempts <n>
+        Make up to <n> attempts for transfers failing with a retryable
+        exit value (see "retry" below).
+--max-runtime <duration>
+        Terminate transfers (rsync) running longer than <duration>
+        (e.g., 6h; 0 for no limit). Also "max_runtime" in the mirror
+        or "defaults".
+--mail-digest
+        Mail reports as one digest per set of recipients at the end of
+        the run (implies --mailreport). Also "mail_digest" in
+        "defaults" (which applies when reports are mailed).
 --mailto <emailaddr>[,...]
         Set/override recipients when mailing report.
 --mailreport
         Mail report.
+--metrics-file <path>
+        Update Prometheus textfile metrics at <path> (also
+        "metrics_textfile" in "defaults"); see below.
+--no-conf-cache
+        Do not use the compiled configuration cache.
+--no-health-check
+        Do not probe destinations (reachability, rsync, free space)
+        before transferring.
 --nolock
         Do not use/require lock to run.
+--plan <path>
+        Resolve the path(s) to mirrors and destinations (-d applies),
+        drop paths covered by an ancestor path, merge other paths of a
+        mirror into one rsync (--files-from), and, once confirmed, save
+        the plan as JSON to <path> ("-" for stdout).
 --safeoff
         Disable safemode.
 --showreport
         Show report on console.
+--skip-if-synced-within <duration>
+        Skip destinations to which the path (or an ancestor) was
+        successfully synced within <duration> (e.g., 30m, 6h, 1d).
+--stall-timeout (<duration>|auto|off)
+        Terminate (and retry, see "retry" below) rsyncs making no
+        progress for <duration> (see "stall" below).
+--suite-jobs <n>
+        Run up to <n> transfers of a suite in parallel, limited by
+        --host-jobs, --fs-jobs and "max_parallel" of the mirror (but
+        not --jobs). Transfers which took longest in past runs are
+        started first.
+--timings
+        Show time spent per phase (lock, plan, ssh, filelist,
+        transfer, wait, report, mail) for each transfer, and for the run
+        (conf, resolve, health, mail).
 --verbose
         Enable verbosity.
--y      Do not ask for confirmation before executing.""" % d
+--verify
+        Verify destinations against the source by checksums (source
+        checksums are cached under ~/.rmirr/verify) instead of syncing.
+--verify-fix
+        With --verify, re-sync mismatched files.
+--verify-sample <rate>
+        With --verify, check a sample (0 < <rate> <= 1) of files.
+--watch
+        Watch path(s) for changes (using inotify) and mirror changes
+        in batches until interrupted. "watch_debounce" (default 5)
+        and "watch_max_delay" (default 60) in "defaults" set the
+        batching in seconds.
+--window-wait
+        Wait for transfers outside their transfer window rather than
+        deferring them.
+-y      Do not ask for confirmation before executing.
+
+Reports are kept under ~/.rmirr/reports, compressed ("report_compress"
+in "defaults": "gzip" (default), "zstd", or "off") and pruned at each
+run by "report_retention" ("max_age_days", "max_count", "max_mb").
+
+Failed transfers are retried per destination according to "retry" (in
+the mirror or "defaults"): "max_attempts", "backoff", "backoff_max",
+"jitter", "exit_codes" and "partial_dir". Interrupted files are kept
+(--partial-dir) and resumed.
+
+An rsync makes progress while its output grows or it reads or writes
+data. "stall" (in the mirror or "defaults") sets "timeout" (a duration,
+"off" (default), or "auto": "factor" (default 4) times the longest time
+without progress in recent successful runs, at least "min" (default
+300) or "default" (default 1800) without history) and "grace" (default
+10; seconds between SIGTERM and SIGKILL).
+
+Metrics (per mirror and destination: run duration, bytes transferred,
+files changed, failures, lock wait, phase durations) are written in
+the Prometheus textfile format for the node_exporter textfile
+collector (the path should end with .prom).""" % d
 
 def main():
     progpath = os.path.realpath(sys.argv[0])
@@ -490,7 +2592,14 @@ def main():
         confpath = os.path.join(os.path.expanduser("~/.rmirr"), "rmirr.json")
         mirrorname = None
         mirrorpath = None
+        executeplanpath = None
+        historylimit = 20
+        historysince = None
+        historystatus = None
+        planpath = None
+        showhistory = False
         showlist = False
+        showreports = False
         suitename = None
 
         while args:
@@ -510,28 +2619,101 @@ def main():
                 globls.dry = True
             elif arg == "--dry-rsync":
                 globls.dryrsync = True
+            elif arg == "--execute-plan" and args:
+                executeplanpath = args.pop(0)
+            elif arg == "--fs-jobs" and args:
+                globls.fsjobs = int(args.pop(0))
+                if globls.fsjobs < 1:
+                    raise Exception()
+            elif arg == "--full":
+                globls.fullsync = True
+            elif arg == "--host-jobs" and args:
+                globls.hostjobs = int(args.pop(0))
+                if globls.hostjobs < 1:
+                    raise Exception()
+            elif arg == "--history":
+                showhistory = True
+            elif arg == "--itemize":
+                globls.itemize = True
+            elif arg == "--jobs" and args:
+                globls.jobs = int(args.pop(0))
+                if globls.jobs < 1:
+                    raise Exception()
+            elif arg == "--lock-wait" and args:
+                globls.lockwait = parse_duration(args.pop(0))
             elif arg == "-l":
                 showlist = True
+            elif arg == "--limit" and args:
+                historylimit = int(args.pop(0))
+            elif arg == "--max-attempts" and args:
+                globls.maxattempts = int(args.pop(0))
+                if globls.maxattempts < 1:
+                    raise Exception()
+            elif arg == "--max-runtime" and args:
+                globls.maxruntime = parse_duration(args.pop(0))
+            elif arg == "--mail-digest":
+                globls.mailreport = True
+                globls.maildigest = True
             elif arg == "--mailto" and args:
                 globls.mailto = args.pop(0).split(",")
             elif arg == "--mailreport":
                 globls.mailreport = True
+            elif arg == "--metrics-file" and args:
+                globls.metricspath = args.pop(0)
             elif arg == "-n" and args:
                 mirrorname = args.pop(0)
+            elif arg == "--no-conf-cache":
+                globls.confcache = False
+            elif arg == "--no-health-check":
+                globls.healthcheck = False
             elif arg == "--nolock":
                 globls.uselock = False
             elif arg == "-p" and args:
                 mirrorpath = os.path.normpath(args.pop(0))
                 suitename = None
+            elif arg == "--plan" and args:
+                planpath = args.pop(0)
+            elif arg == "--reports":
+                showreports = True
             elif arg == "-s" and args:
                 suitename = args.pop(0)
                 mirrorpath = None
             elif arg == "--safeoff":
                 globls.safemode = False
+            elif arg == "--since" and args:
+                historysince = time.time()-parse_duration(args.pop(0))
+            elif arg == "--skip-if-synced-within" and args:
+                globls.skipsyncedwithin = parse_duration(args.pop(0))
+            elif arg == "--status" and args:
+                historystatus = args.pop(0)
             elif arg == "--showreport":
                 globls.showreport = True
+            elif arg == "--stall-timeout" and args:
+                globls.stalltimeout = args.pop(0)
+                if globls.stalltimeout not in ["auto", "off"]:
+                    parse_duration(globls.stalltimeout)
+            elif arg == "--suite-jobs" and args:
+                globls.suitejobs = int(args.pop(0))
+                if globls.suitejobs < 1:
+                    raise Exception()
+            elif arg == "--timings":
+                globls.showtimings = True
             elif arg == "--verbose":
                 globls.verbose = True
+            elif arg == "--verify":
+                globls.verify = True
+            elif arg == "--verify-fix":
+                globls.verify = True
+                globls.verifyfix = True
+            elif arg == "--verify-sample" and args:
+                globls.verify = True
+                globls.verifysample = float(args.pop(0))
+                if not 0 < globls.verifysample <= 1:
+                    raise Exception()
+            elif arg == "--watch":
+                globls.watch = True
+            elif arg == "--window-wait":
+                globls.windowwait = True
             elif arg == "-y":
                 globls.yes = True
             else:
@@ -541,7 +2723,7 @@ def main():
             sys.stderr.write("error: cannot find configuration file (%s)\n" % confpath)
             sys.exit(1)
 
-        if not showlist:
+        if not executeplanpath and not showhistory and not showlist and not showreports:
             if not mirrorname and not mirrorpath and not suitename:
                 raise Exception()
     except SystemExit:
@@ -558,11 +2740,17 @@ def main():
         sys.exit(1)
 
     try:
-        normalize = not showlist
-        globls.conf = load_conf(confpath, normalize)
+        started = time.time()
+        if showhistory or showlist:
+            globls.conf = load_conf(confpath, False)
+        else:
+            globls.conf, globls.mirrorindex = load_conf_cached(confpath)
         globls.defaultsd = globls.conf.get("defaults", {})
         globls.mirrors = globls.conf.get("mirrors", [])
         globls.suitesd = globls.conf.get("suites", {})
+        if globls.defaultsd.get("mail_digest", False):
+            globls.maildigest = True
+        add_timing(globls.timingsd, "conf", started)
     except:
         #traceback.print_exc()
         sys.stderr.write("error: bad/missing configuration file\n")
@@ -570,18 +2758,59 @@ def main():
 
     if showlist:
         show_list(globls.suitesd, globls.mirrors)
+    elif showhistory:
+        show_history(mirrorname, globls.destinations, historysince, historystatus, historylimit)
+    elif showreports:
+        show_reports(mirrorname, globls.destinations)
+    elif executeplanpath:
+        prune_reports()
+        try:
+            execute_plan(executeplanpath, globls.mirrors)
+        except (IOError, ValueError, KeyError, RmirrException) as e:
+            sys.stderr.write("error: bad/missing plan (%s)\n" % (e,))
+            sys.exit(1)
     else:
+        prune_reports()
         if suitename:
             mirrorpaths = globls.suitesd.get(suitename)
             if mirrorpaths == None:
                 sys.stderr.write("error: cannot find suite\n")
                 sys.exit(1)
             mirrorpaths = map(os.path.expanduser, mirrorpaths)
-        else:
+        elif mirrorpath:
             mirrorpaths = [mirrorpath]
-
-        for mirrorpath in mirrorpaths:
-            do_mirror(mirrorname, mirrorpath, globls.mirrors)
+        else:
+            # whole mirror by name
+            mirrord = get_mirror(mirrorname)
+            if mirrord == None:
+                sys.stderr.write("error: cannot find mirror name\n")
+                sys.exit(1)
+            _, _, srcpath = userhostpath_split(mirrord["source"])
+            mirrorpaths = [srcpath]
+
+        if planpath:
+            make_plan(planpath, mirrorname, mirrorpaths, globls.mirrors)
+        elif globls.verify:
+            for mirrorpath in mirrorpaths:
+                do_verify(mirrorname, mirrorpath, globls.mirrors)
+        elif globls.watch:
+            do_watch(mirrorname, mirrorpaths, globls.mirrors)
+        elif suitename and globls.suitejobs > 1:
+            run_suite(suitename, mirrorname, mirrorpaths, globls.mirrors)
+        else:
+            for mirrorpath in mirrorpaths:
+                do_mirror(mirrorname, mirrorpath, globls.mirrors)
+
+    # deliver digests and queued mail before exiting
+    started = time.time()
+    send_digests()
+    mailer.close()
+    add_timing(globls.timingsd, "mail", started)
+
+    if not showlist and not showhistory and not showreports:
+        logger.info("run timings %s" % (format_timings(globls.timingsd, RUN_TIMING_PHASES),))
+        if globls.showtimings:
+            print "run timings: %s" % (format_timings(globls.timingsd, RUN_TIMING_PHASES),)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,103 @@
+#! /usr/bin/env python2
+#
+# rsyncstats.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Parse rsync --stats output.
+"""
+
+import os
+import re
+
+# rsync --stats line labels to record keys
+LABELS = [
+    ("Number of files", "files"),
+    ("Number of created files", "files_created"),
+    ("Number of deleted files", "files_deleted"),
+    ("Number of regular files transferred", "files_transferred"),
+    ("Number of files transferred", "files_transferred"),
+    ("Total file size", "total_size"),
+    ("Total transferred file size", "transferred_size"),
+    ("Literal data", "literal_data"),
+    ("Matched data", "matched_data"),
+    ("File list size", "file_list_size"),
+    ("File list generation time", "file_list_gen_time"),
+    ("File list transfer time", "file_list_xfer_time"),
+    ("Total bytes sent", "bytes_sent"),
+    ("Total bytes received", "bytes_received"),
+]
+
+LINE_RE = re.compile(r"^(%s): ([0-9,.]+)" % "|".join([re.escape(label) for label, _ in LABELS]), re.M)
+SPEEDUP_RE = re.compile(r"speedup is ([0-9,.]+)")
+
+def _number(s):
+    s = s.replace(",", "")
+    if "." in s:
+        return float(s)
+    return int(s)
+
+def format(statsd):
+    """Format stats as rsync does (so that parse() reads them back).
+    """
+    lines = []
+    keys = []
+    for label, key in LABELS:
+        if key in statsd and key not in keys:
+            lines.append("%s: %s" % (label, statsd[key]))
+            keys.append(key)
+    if "speedup" in statsd:
+        lines.append("total size is %s  speedup is %s" % (statsd.get("total_size", 0), statsd["speedup"]))
+    return "\n".join(lines)+"\n"
+
+def merge(stats):
+    """Merge stats of several rsyncs of parts of a tree: counts and
+    sizes are summed and speedup is recomputed.
+    """
+    mergedd = {}
+    for statsd in stats:
+        for key, value in statsd.items():
+            if key != "speedup":
+                mergedd[key] = mergedd.get(key, 0)+value
+    wire = mergedd.get("bytes_sent", 0)+mergedd.get("bytes_received", 0)
+    if wire and "total_size" in mergedd:
+        mergedd["speedup"] = round(float(mergedd["total_size"])/wire, 2)
+    return mergedd
+
+def parse(text):
+    """Parse stats from rsync output text. Return dict (empty if no
+    stats were found).
+    """
+    labelsd = dict(LABELS)
+    statsd = {}
+    for m in LINE_RE.finditer(text):
+        statsd[labelsd[m.group(1)]] = _number(m.group(2).rstrip("."))
+    m = SPEEDUP_RE.search(text)
+    if m:
+        statsd["speedup"] = _number(m.group(1).rstrip("."))
+    return statsd
+
+def parse_file(path, tailsize=65536):
+    """Parse stats from the end of an rsync output file.
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell()-tailsize))
+        return parse(f.read())
@@ -0,0 +1,198 @@
+#! /usr/bin/env python2
+#
+# rundb.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Run history database (SQLite).
+
+One row per transfer run (mirror path to one destination). A
+connection is opened per operation so that the database can be used
+from transfer threads and concurrent rmirr processes.
+"""
+
+import json
+import sqlite3
+
+BUSY_TIMEOUT = 30
+SCHEMA_VERSION = 5
+
+COLUMNS = [
+    "name",
+    "mirrorpath",
+    "srcuserhostpath",
+    "dsthost",
+    "dstuserhostpath",
+    "started",
+    "ended",
+    "duration",
+    "returncode",
+    "attempts",
+    "lock_wait",
+    "status",
+    "unchanged",
+    "dryrun",
+    "partial",
+    "report_path",
+    "files_transferred",
+    "bytes_sent",
+    "bytes_received",
+    "stats",
+    "timings",
+]
+
+# (version, statements) to upgrade to each version
+MIGRATIONS = [
+    (1, [
+        """CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            mirrorpath TEXT,
+            srcuserhostpath TEXT,
+            dsthost TEXT,
+            dstuserhostpath TEXT,
+            started REAL,
+            ended REAL,
+            duration REAL,
+            returncode INTEGER,
+            status TEXT,
+            unchanged INTEGER,
+            dryrun INTEGER,
+            report_path TEXT,
+            files_transferred INTEGER,
+            bytes_sent INTEGER,
+            bytes_received INTEGER,
+            stats TEXT)""",
+        "CREATE INDEX IF NOT EXISTS runs_name_dsthost_started ON runs (name, dsthost, started)",
+        "CREATE INDEX IF NOT EXISTS runs_dsthost_started ON runs (dsthost, started)",
+        "CREATE INDEX IF NOT EXISTS runs_started ON runs (started)",
+    ]),
+    (2, [
+        "ALTER TABLE runs ADD COLUMN attempts INTEGER",
+    ]),
+    (3, [
+        "ALTER TABLE runs ADD COLUMN lock_wait REAL",
+    ]),
+    (4, [
+        "ALTER TABLE runs ADD COLUMN timings TEXT",
+    ]),
+    (5, [
+        "ALTER TABLE runs ADD COLUMN partial INTEGER",
+    ]),
+]
+
+_initialized = set()
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    if path not in _initialized:
+        if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            # upgrade under an exclusive transaction (DDL included)
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                for migversion, sqls in MIGRATIONS:
+                    if version < migversion:
+                        for sql in sqls:
+                            conn.execute(sql)
+                conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+            conn.isolation_level = ""
+        _initialized.add(path)
+    return conn
+
+def add_run(path, rund):
+    """Add run (dict with COLUMNS keys; "stats" and "timings" are
+    dicts). Return run id.
+    """
+    rund = dict(rund)
+    statsd = rund.get("stats") or {}
+    for key in ["files_transferred", "bytes_sent", "bytes_received"]:
+        rund.setdefault(key, statsd.get(key))
+    rund["stats"] = json.dumps(statsd, sort_keys=True)
+    rund["timings"] = json.dumps(rund.get("timings") or {}, sort_keys=True)
+
+    conn = _connect(path)
+    try:
+        with conn:
+            cur = conn.execute("INSERT INTO runs (%s) VALUES (%s)" \
+                % (", ".join(COLUMNS), ", ".join(["?"]*len(COLUMNS))),
+                [rund.get(key) for key in COLUMNS])
+            return cur.lastrowid
+    finally:
+        conn.close()
+
+def get_last_synced(path, name, mirrorpath, dsthost):
+    """Return end time of the last successful (not dry, not partial)
+    run of name to dsthost which covered mirrorpath (same or ancestor
+    path), or None.
+    """
+    conn = _connect(path)
+    try:
+        row = conn.execute("""SELECT MAX(ended) FROM runs
+            WHERE name = ? AND dsthost = ? AND status = 'ok' AND NOT dryrun AND NOT COALESCE(partial, 0)
+                AND (mirrorpath = ? OR SUBSTR(?, 1, LENGTH(mirrorpath)+1) = mirrorpath || '/')""",
+            [name, dsthost, mirrorpath, mirrorpath]).fetchone()
+        return row[0]
+    finally:
+        conn.close()
+
+def query(path, name=None, dsthosts=None, since=None, status=None, limit=None):
+    """Return runs (dicts, newest first) matching the given filters:
+    mirror name, list of destination hosts, start time (seconds since
+    epoch), and status.
+    """
+    wheres = []
+    params = []
+    if name != None:
+        wheres.append("name = ?")
+        params.append(name)
+    if dsthosts:
+        wheres.append("dsthost IN (%s)" % ", ".join(["?"]*len(dsthosts)))
+        params.extend(dsthosts)
+    if since != None:
+        wheres.append("started >= ?")
+        params.append(since)
+    if status != None:
+        wheres.append("status = ?")
+        params.append(status)
+    sql = "SELECT * FROM runs"
+    if wheres:
+        sql += " WHERE "+" AND ".join(wheres)
+    sql += " ORDER BY started DESC"
+    if limit:
+        sql += " LIMIT %d" % int(limit)
+
+    conn = _connect(path)
+    try:
+        runs = []
+        for row in conn.execute(sql, params):
+            rund = dict(zip(row.keys(), row))
+            rund["stats"] = json.loads(rund["stats"] or "{}")
+            rund["timings"] = json.loads(rund["timings"] or "{}")
+            runs.append(rund)
+        return runs
+    finally:
+        conn.close()
@@ -0,0 +1,156 @@
+#! /usr/bin/env python2
+#
+# shard.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Split a source tree into size-balanced shards for parallel rsyncs.
+
+Units are top-level directories, or deeper ones where a directory
+weighs more than its share. Units are assigned to shards, heaviest
+first, to the lightest shard. Each shard is synced with filter rules
+selecting its units; a root pass syncs everything else (files beside
+units, and deletions of entries which are not units) and, excluding
+the units, protects them from deletion.
+"""
+
+import json
+import os
+import os.path
+import tempfile
+
+# per-file overhead, in bytes, for weighing units
+FILE_COST = 64*1024
+
+def _escape(relpath):
+    """Escape wildcard characters for rsync filter patterns.
+    """
+    for c in "\\*?[":
+        relpath = relpath.replace(c, "\\"+c)
+    return relpath
+
+def get_filter_args(units):
+    """Return rsync filter arguments selecting only units (and their
+    parent directories, non-recursively).
+    """
+    args = []
+    parents = []
+    for unit in units:
+        comps = unit.split("/")
+        for i in range(1, len(comps)):
+            parent = "/".join(comps[:i])
+            if parent not in parents:
+                parents.append(parent)
+                args.append("--include=/%s/" % (_escape(parent),))
+        args.append("--include=/%s/***" % (_escape(unit),))
+    args.append("--exclude=*")
+    return args
+
+def get_root_filter_args(units):
+    """Return rsync filter arguments excluding (and so protecting from
+    deletion) all units.
+    """
+    return ["--exclude=/%s" % (_escape(unit),) for unit in units]
+
+def get_weight(weightsd, relpath):
+    nbytes, nfiles = weightsd.get(relpath, (0, 0))
+    return nbytes+nfiles*FILE_COST
+
+def load_weights(path, maxage, now):
+    """Load weights saved within maxage seconds. Return dict or None.
+    """
+    try:
+        d = json.load(open(path))
+        if now-d["scanned"] <= maxage:
+            return d["weights"]
+    except:
+        pass
+    return None
+
+def plan(weightsd, nshards):
+    """Return list of shards (lists of unit relative paths) from the
+    directory weights.
+    """
+    units = [relpath for relpath in weightsd if relpath and "/" not in relpath]
+    if not units:
+        return []
+    total = sum([get_weight(weightsd, unit) for unit in units])
+    target = float(total)/nshards
+
+    # split heavy units into their subdirectories
+    while True:
+        units.sort(key=lambda unit: -get_weight(weightsd, unit))
+        unit = units[0]
+        if get_weight(weightsd, unit) <= target:
+            break
+        children = [relpath for relpath in weightsd \
+            if relpath.startswith(unit+"/") and "/" not in relpath[len(unit)+1:]]
+        if not children:
+            break
+        units = units[1:]+children
+
+    shards = [[] for _ in range(min(nshards, len(units)))]
+    loads = [0]*len(shards)
+    for unit in units:
+        i = loads.index(min(loads))
+        shards[i].append(unit)
+        loads[i] += get_weight(weightsd, unit)
+    for units in shards:
+        units.sort()
+    return shards
+
+def save_weights(path, weightsd, now):
+    """Save weights atomically.
+    """
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"scanned": now, "weights": weightsd}, f)
+        os.rename(tmppath, path)
+    except:
+        os.remove(tmppath)
+        raise
+
+def scan(rootpath, maxdepth):
+    """Weigh directories under rootpath down to maxdepth levels. Each
+    weighs everything below it (files below maxdepth count for their
+    ancestor at maxdepth).
+
+    Return dict of relative path -> [bytes, files] ("" is the root).
+    """
+    weightsd = {"": [0, 0]}
+    prefixlen = len(rootpath.rstrip("/"))+1
+    for dirpath, dirnames, filenames in os.walk(rootpath):
+        reldirpath = dirpath[prefixlen:]
+        comps = reldirpath and reldirpath.split("/") or []
+        ancestors = [""]+["/".join(comps[:i]) for i in range(1, min(len(comps), maxdepth)+1)]
+        if len(comps) <= maxdepth:
+            weightsd.setdefault(reldirpath, [0, 0])
+        nbytes = 0
+        for name in filenames:
+            try:
+                nbytes += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+        for ancestor in ancestors:
+            weightl = weightsd[ancestor]
+            weightl[0] += nbytes
+            weightl[1] += len(filenames)
+    return weightsd
@@ -0,0 +1,104 @@
+#! /usr/bin/env python2
+#
+# sshmux.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Shared SSH master connections (ControlMaster), one per destination
+user@host, for the duration of an invocation.
+
+Control paths are private to the process, so that other rmirr
+processes never use (or close) its masters. Masters also exit after
+PERSIST seconds without clients, in case the process dies without
+closing them.
+"""
+
+import atexit
+import hashlib
+import os
+import os.path
+import shlex
+import subprocess
+import threading
+
+PERSIST = 600
+
+# userhost -> control path (None if the master could not be started)
+_mastersd = {}
+# userhost -> lock serializing master startup
+_startlocksd = {}
+_mutex = threading.Lock()
+_rsh = None
+_token = "%s.%s" % (os.getpid(), os.urandom(8).encode("hex"))
+
+def close_all():
+    """Close all master connections.
+    """
+    with _mutex:
+        items = _mastersd.items()
+        _mastersd.clear()
+    for userhost, controlpath in items:
+        if controlpath == None:
+            continue
+        try:
+            subprocess.call(shlex.split(_rsh)+["-o", "ControlPath=%s" % controlpath, "-O", "exit", userhost],
+                stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT, close_fds=True)
+        except:
+            pass
+
+def get_control_path(dirpath, userhost):
+    # short, fixed length name keeps within the unix socket path limit
+    return os.path.join(dirpath, hashlib.sha1("%s:%s" % (_token, userhost)).hexdigest()[:16])
+
+def get_rsh(dirpath, userhost, rsh):
+    """Return remote shell command for rsync -e which goes through the
+    master connection for userhost, starting the master if needed.
+    Return None if the master could not be started.
+    """
+    global _rsh
+
+    with _mutex:
+        if _rsh == None:
+            _rsh = rsh
+            atexit.register(close_all)
+        startlock = _startlocksd.setdefault(userhost, threading.Lock())
+
+    with startlock:
+        if userhost not in _mastersd:
+            _mastersd[userhost] = start_master(dirpath, userhost, rsh)
+        controlpath = _mastersd[userhost]
+    if controlpath == None:
+        return None
+    return "%s -o ControlMaster=no -o ControlPath=%s" % (rsh, controlpath)
+
+def start_master(dirpath, userhost, rsh):
+    """Start master connection in the background. Return control path
+    or None on failure.
+    """
+    controlpath = get_control_path(dirpath, userhost)
+    cmdargs = shlex.split(rsh)+["-o", "ControlMaster=yes", "-o", "ControlPath=%s" % controlpath,
+        "-o", "ControlPersist=%d" % PERSIST, "-N", "-f", userhost]
+    try:
+        devnull = open(os.devnull, "r+")
+        if subprocess.call(cmdargs, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True) == 0:
+            return controlpath
+    except:
+        pass
+    return None
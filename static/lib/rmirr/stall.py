@@ -0,0 +1,117 @@
+#! /usr/bin/env python2
+#
+# stall.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Stall detection for running processes.
+
+A process makes progress while its output file grows or it reads or
+writes (rchar/wchar in /proc/<pid>/io, where available). Processes
+which make no progress for too long, or run past a deadline, are
+terminated.
+"""
+
+import os
+import time
+
+POLL_MAX = 5.0
+POLL_MIN = 0.05
+
+def get_progress(p, f):
+    """Return progress signature of process p writing to file f.
+    """
+    sig = [os.fstat(f.fileno()).st_size]
+    try:
+        with open("/proc/%d/io" % p.pid) as iof:
+            for line in iof:
+                if line.startswith("rchar:") or line.startswith("wchar:"):
+                    sig.append(int(line.split()[1]))
+    except (IOError, ValueError):
+        pass
+    return tuple(sig)
+
+def terminate(procs, grace):
+    """Terminate running processes: SIGTERM, then SIGKILL after grace
+    seconds. Return True if all exited (processes in uninterruptible
+    sleep, e.g., on a hung NFS mount, may not).
+    """
+    for sig in ["terminate", "kill"]:
+        for p in procs:
+            if p.poll() == None:
+                try:
+                    getattr(p, sig)()
+                except OSError:
+                    pass
+        deadline = time.time()+grace
+        while time.time() < deadline:
+            if not [p for p in procs if p.poll() == None]:
+                return True
+            time.sleep(0.1)
+    return not [p for p in procs if p.poll() == None]
+
+def wait(procs, files, timeout, deadline):
+    """Wait for processes (writing to the corresponding files) while
+    watching their progress. timeout is the number of seconds a
+    process may make no progress, deadline the time (seconds since
+    epoch) by which all must have exited (None for no limit).
+
+    Return (reason, maxidle): reason is None (all exited), "stalled"
+    or "deadline"; maxidle is the longest time (seconds) a process
+    was seen making no progress (None if not watched: without timeout
+    and deadline, this just blocks until all have exited).
+    """
+    if not timeout and deadline == None:
+        for p in procs:
+            p.wait()
+        return None, None
+
+    now = time.time()
+    sigs = [None]*len(procs)
+    sinces = [now]*len(procs)
+    maxidle = 0
+    delay = POLL_MIN
+    while True:
+        now = time.time()
+        running = False
+        for i, p in enumerate(procs):
+            if p.poll() != None:
+                continue
+            running = True
+            sig = get_progress(p, files[i])
+            if sig != sigs[i]:
+                sigs[i] = sig
+                sinces[i] = now
+            idle = now-sinces[i]
+            maxidle = max(maxidle, idle)
+            if timeout and idle >= timeout:
+                return "stalled", maxidle
+        if not running:
+            return None, maxidle
+        if deadline != None and now >= deadline:
+            return "deadline", maxidle
+
+        # poll quickly at first so that short runs are not delayed
+        delay = min(delay*2, POLL_MAX)
+        if timeout:
+            delay = min(delay, timeout/4.0)
+        if deadline != None:
+            delay = min(delay, max(POLL_MIN, deadline-now))
+        time.sleep(delay)
@@ -0,0 +1,199 @@
+#! /usr/bin/env python2
+#
+# verify.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Verify destinations against the source by checksums.
+
+Source checksums are kept in a cache (relative path -> (size, mtime,
+inode, digest)), so only new or changed files are hashed. Destination
+checksums are computed remotely (<hash>sum via the remote shell).
+"""
+
+import fnmatch
+import hashlib
+import marshal
+import os
+import os.path
+import pipes
+import stat
+import subprocess
+import tempfile
+import threading
+
+CHUNK_SIZE = 1024*1024
+HASHES = ["md5", "sha1", "sha256"]
+
+def compare(cached, relpaths, remoted):
+    """Compare cached source digests of relpaths with remote digests.
+    Return list of (relpath, reason) mismatches.
+    """
+    mismatches = []
+    for relpath in relpaths:
+        digest = remoted.get(relpath)
+        if digest == None:
+            mismatches.append((relpath, "missing"))
+        elif digest != cached[relpath][3]:
+            mismatches.append((relpath, "differs"))
+    return mismatches
+
+def get_remote_digests(rshargs, userhost, dstpath, relpaths, hashname):
+    """Return dict of relative path -> digest computed under dstpath on
+    userhost. Files which cannot be read are missing from the dict.
+    Raise an exception if the checksums cannot be computed at all.
+    """
+    script = "cd %s && xargs -0 %ssum --" % (pipes.quote(dstpath), hashname)
+    p = subprocess.Popen(rshargs+[userhost, script],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=open(os.devnull, "w"),
+        close_fds=True)
+    out = p.communicate("".join(["%s\0" % relpath for relpath in relpaths]))[0]
+    # xargs exits with 123 if some files could not be read
+    if p.returncode not in [0, 123]:
+        raise Exception("cannot compute checksums on %s (exit %s)" % (userhost, p.returncode))
+
+    remoted = {}
+    for line in out.splitlines():
+        # names with special characters are escaped (line starts with \)
+        escaped = line.startswith("\\")
+        if escaped:
+            line = line[1:]
+        digest, _, relpath = line.partition("  ")
+        if escaped:
+            relpath = relpath.replace("\\n", "\n").replace("\\\\", "\\")
+        remoted[relpath] = digest
+    return remoted
+
+def hash_file(path, hashname):
+    h = hashlib.new(hashname)
+    with open(path, "rb") as f:
+        while True:
+            s = f.read(CHUNK_SIZE)
+            if not s:
+                break
+            h.update(s)
+    return h.hexdigest()
+
+def is_excluded(relpath, excludes):
+    """Return True if relpath (or a parent) matches an exclude pattern
+    (rsync-like: patterns with a leading "/" are anchored; others
+    match a name, or the trailing components if they contain "/").
+    """
+    comps = relpath.split("/")
+    for pattern in excludes:
+        anchored = pattern.startswith("/")
+        pattern = pattern.strip("/")
+        ncomps = pattern.count("/")+1
+        for i in range(len(comps)):
+            if anchored:
+                if i+1 == ncomps and fnmatch.fnmatchcase("/".join(comps[:i+1]), pattern):
+                    return True
+            elif i+1 >= ncomps and fnmatch.fnmatchcase("/".join(comps[i+1-ncomps:i+1]), pattern):
+                return True
+    return False
+
+def load_cache(path):
+    try:
+        with open(path, "rb") as f:
+            return marshal.load(f)
+    except:
+        return {}
+
+def sample(relpaths, rate, seed):
+    """Return the relpaths selected (deterministically for a seed) at
+    rate (0 to 1).
+    """
+    if rate >= 1:
+        return list(relpaths)
+    limit = int(rate*0xffffffff)
+    return [relpath for relpath in relpaths \
+        if int(hashlib.md5("%s:%s" % (seed, relpath)).hexdigest()[:8], 16) <= limit]
+
+def save_cache(path, cached):
+    """Save cache atomically.
+    """
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump(cached, f)
+        os.rename(tmppath, path)
+    except:
+        os.remove(tmppath)
+        raise
+
+def update_cache(cached, rootpath, relprefix, excludes, hashname, nworkers):
+    """Scan regular files under rootpath (relprefix is its path
+    relative to the cache root) and hash those new or changed since
+    cached, using nworkers threads (hashing releases the GIL). Entries
+    under relprefix for files gone are removed.
+
+    Return (relpaths of files scanned, number hashed).
+    """
+    relpaths = []
+    tohash = []
+    for dirpath, dirnames, filenames in os.walk(rootpath):
+        reldirpath = os.path.join(relprefix, dirpath[len(rootpath):].lstrip("/"))
+        dirnames[:] = [name for name in dirnames if not is_excluded(os.path.join(reldirpath, name), excludes)]
+        for name in filenames:
+            relpath = os.path.join(reldirpath, name)
+            if is_excluded(relpath, excludes):
+                continue
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            relpaths.append(relpath)
+            key = (st.st_size, st.st_mtime, st.st_ino)
+            entry = cached.get(relpath)
+            if entry == None or entry[:3] != key:
+                tohash.append((relpath, key))
+
+    seen = set(relpaths)
+    for relpath in cached.keys():
+        if (not relprefix or relpath.startswith(relprefix+"/")) and relpath not in seen:
+            del cached[relpath]
+
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not tohash:
+                    return
+                relpath, key = tohash.pop()
+            try:
+                digest = hash_file(os.path.join(rootpath, relpath[len(relprefix):].lstrip("/")), hashname)
+            except (IOError, OSError):
+                continue
+            with lock:
+                cached[relpath] = key+(digest,)
+
+    nhashed = len(tohash)
+    threads = [threading.Thread(target=worker) for _ in range(max(1, nworkers))]
+    for th in threads:
+        th.daemon = True
+        th.start()
+    for th in threads:
+        while th.is_alive():
+            th.join(1)
+    relpaths = [relpath for relpath in relpaths if relpath in cached]
+    return relpaths, nhashed
@@ -0,0 +1,137 @@
+#! /usr/bin/env python2
+#
+# watch.py
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Recursive directory watching using Linux inotify (via ctypes).
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import os.path
+import select
+import struct
+import sys
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY|IN_ATTRIB|IN_CLOSE_WRITE|IN_MOVED_FROM|IN_MOVED_TO \
+    |IN_CREATE|IN_DELETE|IN_DELETE_SELF|IN_MOVE_SELF
+
+EVENT_FMT = "iIII"
+EVENT_SIZE = struct.calcsize(EVENT_FMT)
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc == None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc
+
+def add_tree(watcherd, rootpath):
+    """Watch rootpath and all directories under it. Return list of
+    directories added.
+    """
+    added = []
+    for dirpath, dirnames, _ in os.walk(rootpath):
+        if add_watch(watcherd, dirpath):
+            added.append(dirpath)
+    return added
+
+def add_watch(watcherd, path):
+    """Watch a single directory. Return True on success.
+    """
+    if isinstance(path, unicode):
+        # ctypes would pass unicode as wchar_t *
+        path = path.encode(sys.getfilesystemencoding() or "utf-8")
+    wd = _get_libc().inotify_add_watch(watcherd["fd"], path, WATCH_MASK)
+    if wd < 0:
+        return False
+    watcherd["wds"][wd] = path
+    return True
+
+def close_watcher(watcherd):
+    if watcherd["fd"] != None:
+        os.close(watcherd["fd"])
+        watcherd["fd"] = None
+
+def open_watcher():
+    """Return new watcher dict.
+    """
+    fd = _get_libc().inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+    if fd < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return {"fd": fd, "wds": {}}
+
+def read_events(watcherd, timeout):
+    """Wait up to timeout seconds (None for no limit) for events.
+    Return list of (path, mask). A path of None with IN_Q_OVERFLOW set
+    means events were lost.
+    """
+    fd = watcherd["fd"]
+    r, _, _ = select.select([fd], [], [], timeout)
+    if not r:
+        return []
+
+    events = []
+    while True:
+        try:
+            buf = os.read(fd, 65536)
+        except OSError as e:
+            if e.errno in [errno.EAGAIN, errno.EINTR]:
+                break
+            raise
+        if not buf:
+            break
+        i = 0
+        while i+EVENT_SIZE <= len(buf):
+            wd, mask, _, namelen = struct.unpack_from(EVENT_FMT, buf, i)
+            name = buf[i+EVENT_SIZE:i+EVENT_SIZE+namelen].rstrip("\0")
+            i += EVENT_SIZE+namelen
+
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            dirpath = watcherd["wds"].get(wd)
+            if mask & IN_IGNORED:
+                watcherd["wds"].pop(wd, None)
+                continue
+            if dirpath == None:
+                continue
+            events.append((name and os.path.join(dirpath, name) or dirpath, mask))
+    return events
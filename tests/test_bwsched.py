@@ -0,0 +1,120 @@
+#! /usr/bin/env python2
+#
+# test_bwsched.py
+
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+import os
+import os.path
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "lib", "rmirr"))
+
+import bwsched
+
+class SharesTest(unittest.TestCase):
+
+    def setUp(self):
+        bwsched._linksd.clear()
+        self.group = bwsched.new_group()
+
+    def test_even_shares(self):
+        for i in range(4):
+            bwsched.register("wan", 1000, self.group, 4)
+        self.assertEqual([bwsched.acquire("wan", self.group) for i in range(4)], [250, 250, 250, 250])
+
+    def test_freed_capacity_to_later(self):
+        for i in range(3):
+            bwsched.register("wan", 900, self.group, 3)
+        first = bwsched.acquire("wan", self.group)
+        second = bwsched.acquire("wan", self.group)
+        bwsched.release("wan", self.group, first)
+        self.assertEqual(bwsched.acquire("wan", self.group), 600)
+
+    def test_serial(self):
+        for i in range(4):
+            bwsched.register("wan", 1000, self.group, 1)
+        shares = []
+        for i in range(4):
+            share = bwsched.acquire("wan", self.group)
+            shares.append(share)
+            bwsched.release("wan", self.group, share)
+        self.assertEqual(shares, [1000, 1000, 1000, 1000])
+        self.assertEqual(bwsched._linksd["wan"]["groups"], {})
+
+    def test_groups_share_link(self):
+        other = bwsched.new_group()
+        for i in range(3):
+            bwsched.register("wan", 1000, self.group, 1)
+        for i in range(3):
+            bwsched.register("wan", 1000, other, 2)
+        self.assertEqual(bwsched.acquire("wan", self.group), 333)
+        self.assertEqual(bwsched.acquire("wan", other), 333)
+
+    def test_unregister(self):
+        bwsched.register("wan", 1000, self.group, 2)
+        bwsched.register("wan", 1000, self.group, 2)
+        bwsched.unregister("wan", self.group)
+        self.assertEqual(bwsched.acquire("wan", self.group), 1000)
+
+    def test_links_independent(self):
+        bwsched.register("wan", 1000, self.group, 2)
+        bwsched.register("lan", 10, self.group, 2)
+        self.assertEqual(bwsched.acquire("lan", self.group), 10)
+        self.assertEqual(bwsched.acquire("wan", self.group), 1000)
+
+    def test_waits_for_capacity(self):
+        bwsched.register("wan", 100, self.group, 2)
+        share = bwsched.acquire("wan", self.group)
+        bwsched.register("wan", 100, self.group, 2)
+        shares = []
+        th = threading.Thread(target=lambda: shares.append(bwsched.acquire("wan", self.group)))
+        th.start()
+        time.sleep(0.1)
+        self.assertEqual(shares, [])
+        bwsched.release("wan", self.group, share)
+        th.join(5)
+        self.assertEqual(shares, [100])
+
+class WindowsTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(bwsched.parse_windows(["01:30-06:00", "22:00-02:00"]), [(90, 360), (1320, 120)])
+        self.assertEqual(bwsched.parse_windows(None), [])
+
+    def test_in_window(self):
+        windows = bwsched.parse_windows(["01:30-06:00", "22:00-02:00"])
+        self.assertTrue(bwsched.in_window([], 0))
+        self.assertTrue(bwsched.in_window(windows, 90))
+        self.assertFalse(bwsched.in_window(windows, 360))
+        self.assertTrue(bwsched.in_window(windows, 1439))
+        self.assertTrue(bwsched.in_window(windows, 60))
+
+    def test_minutes_until_window(self):
+        windows = bwsched.parse_windows(["01:30-06:00"])
+        self.assertEqual(bwsched.minutes_until_window(windows, 100), 0)
+        self.assertEqual(bwsched.minutes_until_window(windows, 60), 30)
+        self.assertEqual(bwsched.minutes_until_window(windows, 1380), 150)
+
+if __name__ == "__main__":
+    unittest.main()
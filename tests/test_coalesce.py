@@ -0,0 +1,79 @@
+#! /usr/bin/env python2
+#
+# test_coalesce.py
+
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+import os
+import os.path
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "lib", "rmirr"))
+
+import globls
+import rmirr
+
+MIRRORS = [
+    {"name": "data", "source": "localhost:/data", "destinations": ["h1:/data"]},
+    {"name": "proj", "source": "localhost:/data/proj", "destinations": ["h2:/proj"]},
+]
+
+class CoalescePathsTest(unittest.TestCase):
+
+    def setUp(self):
+        globls.mirrors = MIRRORS
+        globls.mirrorindex = None
+
+    def test_covered_paths_dropped(self):
+        entries, dropped = rmirr.coalesce_paths(None, ["/data/a/x", "/data/a", "/data/a/"], MIRRORS)
+        self.assertEqual(entries, [{"name": "data", "mirrorpath": "/data/a", "files": None, "covers": ["/data/a"]}])
+        self.assertEqual(dropped, [
+            {"path": "/data/a", "reason": "covered by /data/a"},
+            {"path": "/data/a/x", "reason": "covered by /data/a"},
+        ])
+
+    def test_siblings_merged(self):
+        entries, dropped = rmirr.coalesce_paths(None, ["/data/a/y", "/data/a/x/1", "/data/b"], MIRRORS)
+        self.assertEqual(dropped, [])
+        self.assertEqual(entries, [{
+            "name": "data",
+            "mirrorpath": "/data",
+            "files": ["a/x/1", "a/y", "b"],
+            "covers": ["/data/a/x/1", "/data/a/y", "/data/b"],
+        }])
+
+    def test_common_prefix_by_component(self):
+        entries, _ = rmirr.coalesce_paths(None, ["/data/ab", "/data/ac"], MIRRORS)
+        self.assertEqual(entries[0]["mirrorpath"], "/data")
+        self.assertEqual(entries[0]["files"], ["ab", "ac"])
+
+    def test_grouped_by_mirror(self):
+        entries, dropped = rmirr.coalesce_paths(None, ["/data/proj/x", "/data/a", "/other"], MIRRORS)
+        self.assertEqual([(d["name"], d["mirrorpath"]) for d in entries],
+            [("proj", "/data/proj/x"), ("data", "/data/a")])
+        self.assertEqual(dropped, [{"path": "/other", "reason": "no matching mirror"}])
+
+    def test_named_mirror(self):
+        entries, _ = rmirr.coalesce_paths("data", ["/data/proj/x"], MIRRORS)
+        self.assertEqual(entries[0]["name"], "data")
+
+if __name__ == "__main__":
+    unittest.main()
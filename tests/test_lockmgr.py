@@ -0,0 +1,147 @@
+#! /usr/bin/env python2
+#
+# test_lockmgr.py
+
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+LIB_DIRPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "lib", "rmirr")
+sys.path.insert(0, LIB_DIRPATH)
+
+import lockmgr
+
+# holds a lock until stdin is closed
+HOLDER = """
+import sys
+sys.path.insert(0, %r)
+import lockmgr
+lockmgr.acquire(%r, (%r, %r, %r), 0)
+sys.stdout.write("held\\n")
+sys.stdout.flush()
+sys.stdin.read()
+"""
+
+class LockmgrTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for key in lockmgr._heldd.keys():
+            lockmgr._heldd[key][2] = 1
+            lockmgr.release(self.dirpath, key)
+        shutil.rmtree(self.dirpath)
+
+    def start_holder(self, key):
+        p = subprocess.Popen([sys.executable, "-c", HOLDER % ((LIB_DIRPATH, self.dirpath)+key)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.assertEqual(p.stdout.readline(), "held\n")
+        return p
+
+    def test_overlaps(self):
+        self.assertTrue(lockmgr.overlaps(("m", "h", "/a"), ("m", "h", "/a/b")))
+        self.assertTrue(lockmgr.overlaps(("m", "h", "/a/b/"), ("m", "h", "/a")))
+        self.assertFalse(lockmgr.overlaps(("m", "h", "/a"), ("m", "h", "/ab")))
+        self.assertFalse(lockmgr.overlaps(("m", "h", "/a"), ("m", "h2", "/a")))
+        self.assertFalse(lockmgr.overlaps(("m", "h", "/a"), ("m2", "h", "/a")))
+
+    def test_reentrant(self):
+        key = ("m", "h", "/a")
+        self.assertNotEqual(lockmgr.acquire(self.dirpath, key, 0), None)
+        self.assertNotEqual(lockmgr.acquire(self.dirpath, key, 0), None)
+        lockmgr.release(self.dirpath, key)
+        self.assertTrue(key in lockmgr._heldd)
+        lockmgr.release(self.dirpath, key)
+        self.assertFalse(key in lockmgr._heldd)
+        self.assertEqual(os.listdir(os.path.join(self.dirpath, "held")), [])
+
+    def test_own_entries_not_conflicts(self):
+        lockmgr.acquire(self.dirpath, ("m", "h", "/a"), 0)
+        tablefd = lockmgr._lock_table(self.dirpath)
+        try:
+            self.assertEqual(lockmgr.get_conflicts(self.dirpath, ("m", "h", "/a/b")), [])
+        finally:
+            os.close(tablefd)
+
+    def test_overlapping_serialized_in_process(self):
+        events = []
+        lockmgr.acquire(self.dirpath, ("m", "h", "/a"), 0)
+
+        def nested():
+            lockmgr.acquire(self.dirpath, ("m", "h", "/a/b"), None)
+            events.append("nested")
+            lockmgr.release(self.dirpath, ("m", "h", "/a/b"))
+
+        th = threading.Thread(target=nested)
+        th.start()
+        time.sleep(0.2)
+        events.append("released")
+        lockmgr.release(self.dirpath, ("m", "h", "/a"))
+        th.join(5)
+        self.assertEqual(events, ["released", "nested"])
+
+    def test_wait_timeout_in_process(self):
+        lockmgr.acquire(self.dirpath, ("m", "h", "/a"), 0)
+        results = []
+
+        def nested():
+            t0 = time.time()
+            results.append(lockmgr.acquire(self.dirpath, ("m", "h", "/a/b"), 0.3))
+            results.append(time.time()-t0)
+
+        th = threading.Thread(target=nested)
+        th.start()
+        th.join(5)
+        lockmgr.release(self.dirpath, ("m", "h", "/a"))
+        self.assertEqual(results[0], None)
+        self.assertTrue(results[1] >= 0.3)
+
+    def test_other_process_conflicts(self):
+        p = self.start_holder(("m", "h", "/a"))
+        try:
+            self.assertEqual(lockmgr.acquire(self.dirpath, ("m", "h", "/a/b"), 0), None)
+            self.assertNotEqual(lockmgr.acquire(self.dirpath, ("m", "h", "/c"), 0), None)
+        finally:
+            p.stdin.close()
+            p.wait()
+        # holder gone: its entry is stale
+        self.assertNotEqual(lockmgr.acquire(self.dirpath, ("m", "h", "/a/b"), 0), None)
+
+    def test_wait_timeout(self):
+        p = self.start_holder(("m", "h", "/a"))
+        try:
+            t0 = time.time()
+            self.assertEqual(lockmgr.acquire(self.dirpath, ("m", "h", "/a"), 0.3), None)
+            self.assertTrue(time.time()-t0 >= 0.3)
+        finally:
+            p.stdin.close()
+            p.wait()
+
+if __name__ == "__main__":
+    unittest.main()
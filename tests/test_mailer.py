@@ -0,0 +1,96 @@
+#! /usr/bin/env python2
+#
+# test_mailer.py
+
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+import asyncore
+import os
+import os.path
+import smtpd
+import socket
+import StringIO
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "lib", "rmirr"))
+
+import mailer
+
+class StandInServer(smtpd.SMTPServer):
+    """Collects messages and counts connections.
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.nconnections = 0
+
+    def handle_accept(self):
+        self.nconnections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+def get_free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class MailerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.thread = threading.Thread(target=asyncore.loop, kwargs={"timeout": 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        mailer.close()
+        self.server.close()
+        self.thread.join(5)
+
+    def test_send_reuses_connection(self):
+        mailer.send("127.0.0.1", self.server.port, "rmirr@a", ["x@b"], "Subject: 1\n\none\n")
+        mailer.send("127.0.0.1", self.server.port, "rmirr@a", ["x@b", "y@b"], "Subject: 2\n\ntwo\n")
+        mailer.close(10)
+        self.assertEqual([(m[0], m[1]) for m in self.server.messages],
+            [("rmirr@a", ["x@b"]), ("rmirr@a", ["x@b", "y@b"])])
+        self.assertTrue("one" in self.server.messages[0][2])
+        self.assertEqual(self.server.nconnections, 1)
+
+    def test_send_failure_printed(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            mailer.send("127.0.0.1", get_free_port(), "rmirr@a", ["x@b"], "Subject: 1\n\none\n")
+            mailer.close(10)
+            out = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue(out.startswith("error: failed to send mail to (x@b)"))
+
+if __name__ == "__main__":
+    unittest.main()
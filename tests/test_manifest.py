@@ -0,0 +1,92 @@
+#! /usr/bin/env python2
+#
+# test_manifest.py
+
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "lib", "rmirr"))
+
+import manifest
+
+class DiffTest(unittest.TestCase):
+
+    def test_diff(self):
+        old = {"a": (1, 1.0, 1), "b": (2, 2.0, 2), "c": (3, 3.0, 3)}
+        new = {"a": (1, 1.0, 1), "b": (2, 2.5, 2), "d": (4, 4.0, 4)}
+        self.assertEqual(manifest.diff(old, new), (["b", "d"], ["c"]))
+
+    def test_diff_inode(self):
+        # replaced (e.g., renamed over) with same size and mtime
+        self.assertEqual(manifest.diff({"a": (1, 1.0, 1)}, {"a": (1, 1.0, 2)}), (["a"], []))
+
+    def test_diff_empty(self):
+        self.assertEqual(manifest.diff({}, {"a": (1, 1.0, 1)}), (["a"], []))
+        self.assertEqual(manifest.diff({"a": (1, 1.0, 1)}, {}), ([], ["a"]))
+
+class ScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_scan(self):
+        os.makedirs(os.path.join(self.dirpath, "src", "d"))
+        open(os.path.join(self.dirpath, "src", "d", "f"), "w").write("abc")
+        os.symlink("d/f", os.path.join(self.dirpath, "src", "l"))
+        entries = manifest.scan(os.path.join(self.dirpath, "src")+"/")
+        self.assertEqual(sorted(entries.keys()), ["d", "d/f", "l"])
+        self.assertEqual(entries["d/f"][0], 3)
+        self.assertEqual(entries["d/f"][2], os.lstat(os.path.join(self.dirpath, "src", "d", "f")).st_ino)
+
+    def test_scan_sees_changes(self):
+        path = os.path.join(self.dirpath, "f")
+        open(path, "w").write("abc")
+        os.utime(path, (1000, 1000))
+        before = manifest.scan(self.dirpath)
+        open(path, "w").write("abd")
+        os.utime(path, (1000, 1000))
+        self.assertEqual(manifest.diff(before, manifest.scan(self.dirpath)), ([], []))
+        os.utime(path, (2000, 2000))
+        self.assertEqual(manifest.diff(before, manifest.scan(self.dirpath)), (["f"], []))
+
+    def test_save_load(self):
+        path = os.path.join(self.dirpath, "manifest")
+        entries = {"a": (1, 1.5, 7)}
+        manifest.save(path, entries, 1234)
+        self.assertEqual(manifest.load(path), {"entries": entries, "full_sweep": 1234})
+        self.assertEqual(os.listdir(self.dirpath), ["manifest"])
+
+    def test_load_missing(self):
+        self.assertEqual(manifest.load(os.path.join(self.dirpath, "nope")), None)
+        path = os.path.join(self.dirpath, "bad")
+        open(path, "w").write("not marshal")
+        self.assertEqual(manifest.load(path), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+#! /usr/bin/env python2
+#
+# test_mirrorindex.py
+
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+import os
+import os.path
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "lib", "rmirr"))
+
+import globls
+import mirrorindex
+import rmirr
+
+MIRRORS = [
+    {"name": "data", "source": "localhost:/data", "destinations": []},
+    {"name": "proj", "source": "localhost:/data/proj", "destinations": []},
+    {"name": "data", "source": "localhost:/other", "destinations": []},
+    {"name": "proj2", "source": "localhost:/data/proj", "destinations": []},
+]
+
+class MirrorIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = mirrorindex.build(MIRRORS, rmirr.userhostpath_split)
+
+    def test_get(self):
+        self.assertEqual(mirrorindex.get(self.index, "proj"), 1)
+        self.assertEqual(mirrorindex.get(self.index, "data"), 0)
+        self.assertEqual(mirrorindex.get(self.index, "nope"), None)
+
+    def test_find_longest_prefix(self):
+        self.assertEqual(mirrorindex.find(self.index, "/data/proj/x/y"), ("/data/proj", 1))
+        self.assertEqual(mirrorindex.find(self.index, "/data/proj"), ("/data/proj", 1))
+        self.assertEqual(mirrorindex.find(self.index, "/data/project"), ("/data", 0))
+        self.assertEqual(mirrorindex.find(self.index, "/other/z"), ("/other", 2))
+
+    def test_find_none(self):
+        index = mirrorindex.build(MIRRORS[:1], rmirr.userhostpath_split)
+        self.assertEqual(mirrorindex.find(index, "/tmp"), ("", None))
+
+    def test_matches_linear_search(self):
+        globls.mirrorindex = None
+        for path in ["/data/proj/x", "/data/projx", "/data", "/other", "/tmp/a"]:
+            srcpath, i = mirrorindex.find(self.index, path)
+            self.assertEqual(rmirr.find_mirror(path, MIRRORS)[1], i != None and MIRRORS[i] or None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+#! /usr/bin/env python2
+#
+# test_reportstore.py
+
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+import gzip
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "lib", "rmirr"))
+
+import reportstore
+
+class ReportstoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def make_report(self, name, nlines, age=0):
+        path = os.path.join(self.dirpath, name+".txt")
+        with open(path, "w") as f:
+            for i in range(nlines):
+                f.write("line %d\n" % i)
+        mtime = time.time()-age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_compress_gzip(self):
+        path = self.make_report("r1", 10)
+        newpath = reportstore.compress(path, "gzip")
+        self.assertEqual(newpath, path+".gz")
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(gzip.open(newpath).read().splitlines()[-1], "line 9")
+
+    def test_compress_off(self):
+        path = self.make_report("r1", 1)
+        self.assertEqual(reportstore.compress(path, "off"), path)
+        self.assertTrue(os.path.exists(path))
+        self.assertRaises(Exception, reportstore.compress, path, "lzma")
+
+    def test_get_stem(self):
+        self.assertEqual(reportstore.get_stem("/r/a.txt.gz"), "/r/a")
+        self.assertEqual(reportstore.get_stem("/r/a.json"), "/r/a")
+        self.assertEqual(reportstore.get_stem("/r/a.txt.zst"), "/r/a")
+
+    def test_summarize(self):
+        path = reportstore.compress(self.make_report("r1", 10), "gzip")
+        head, tail, nlines, nbytes = reportstore.summarize(path, 2, 3)
+        self.assertEqual(head, ["line 0\n", "line 1\n"])
+        self.assertEqual(tail, ["line 7\n", "line 8\n", "line 9\n"])
+        self.assertEqual((nlines, nbytes), (10, 70))
+
+    def test_summarize_short(self):
+        head, tail, nlines, _ = reportstore.summarize(self.make_report("r1", 3), 2, 3)
+        self.assertEqual((head, tail, nlines), (["line 0\n", "line 1\n"], ["line 2\n"], 3))
+
+    def test_index(self):
+        path1 = self.make_report("r1", 1)
+        path2 = self.make_report("r2", 1)
+        reportstore.add(self.dirpath, {"report_path": path1, "name": "m", "dsthost": "h1"})
+        reportstore.add(self.dirpath, {"report_path": path2, "name": "m", "dsthost": "h2"})
+        reportstore.add(self.dirpath, {"report_path": os.path.join(self.dirpath, "gone.txt"), "name": "m"})
+        self.assertEqual([d["report_path"] for d in reportstore.find(self.dirpath, name="m")], [path1, path2])
+        self.assertEqual([d["report_path"] for d in reportstore.find(self.dirpath, dsthost="h2")], [path2])
+        self.assertEqual([d["report_path"] for d in reportstore.find(self.dirpath, limit=1)], [path2])
+        self.assertEqual(reportstore.find(self.dirpath, name="other"), [])
+
+    def test_prune_count(self):
+        paths = [self.make_report("r%d" % i, 1, age=100-i) for i in range(5)]
+        for path in paths:
+            reportstore.add(self.dirpath, {"report_path": path})
+        # a record goes with its report
+        recordpath = reportstore.get_stem(paths[0])+".json"
+        open(recordpath, "w").write("{}")
+        os.utime(recordpath, (os.path.getmtime(paths[0]),)*2)
+        self.assertEqual(reportstore.prune(self.dirpath, None, 2, None), 3)
+        self.assertEqual(sorted(os.listdir(self.dirpath)),
+            [reportstore.INDEX_FILENAME, reportstore.INDEX_FILENAME+".lock", "r3.txt", "r4.txt"])
+        self.assertEqual([d["report_path"] for d in reportstore.load_index(self.dirpath)], paths[3:])
+
+    def test_prune_age_and_size(self):
+        old = self.make_report("old", 1, age=3600)
+        big = self.make_report("big", 100, age=10)
+        new = self.make_report("new", 1)
+        self.assertEqual(reportstore.prune(self.dirpath, 600, None, None), 1)
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(reportstore.prune(self.dirpath, None, None, 100), 1)
+        self.assertFalse(os.path.exists(big))
+        self.assertTrue(os.path.exists(new))
+        self.assertEqual(reportstore.prune(self.dirpath, None, None, None), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+#! /usr/bin/env python2
+#
+# test_retry.py
+
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+import json
+import os
+import os.path
+import pwd
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+
+LIB_DIRPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "lib", "rmirr")
+sys.path.insert(0, LIB_DIRPATH)
+
+import globls
+import rmirr
+
+# stands in for rsync: logs the destination host, exits with the
+# value named by it ("exit23" -> 23)
+FAKE_RSYNC = """#! /bin/sh
+for arg; do dst="$arg"; done
+case "$dst" in
+*:*) ;;
+*) exit 0;;
+esac
+host="${dst#*@}"
+host="${host%%%%:*}"
+echo "$host" >> "%s"
+case "$host" in
+exit*) exit "${host#exit}";;
+esac
+exit 0
+"""
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        globls.defaultsd = {}
+        globls.maxattempts = None
+
+    def tearDown(self):
+        globls.maxattempts = None
+
+    def get_policy(self, mirrorretryd=None, defaultretryd=None):
+        mirrord = {}
+        if mirrorretryd != None:
+            mirrord["retry"] = mirrorretryd
+        if defaultretryd != None:
+            globls.defaultsd = {"retry": defaultretryd}
+        return rmirr.get_retry_policy({"mirrord": mirrord})
+
+    def test_defaults(self):
+        policyd = self.get_policy()
+        self.assertEqual(policyd["max_attempts"], 1)
+        self.assertEqual(policyd["exit_codes"], rmirr.RETRY_EXIT_CODES)
+        self.assertEqual(policyd["partial_dir"], ".rsync-partial")
+
+    def test_mirror_over_defaults(self):
+        self.assertEqual(self.get_policy(None, {"max_attempts": 4})["max_attempts"], 4)
+        self.assertEqual(self.get_policy({"max_attempts": 2}, {"max_attempts": 4})["max_attempts"], 2)
+
+    def test_max_attempts_option(self):
+        globls.maxattempts = 5
+        self.assertEqual(self.get_policy({"max_attempts": 2})["max_attempts"], 5)
+        globls.maxattempts = 1
+        self.assertEqual(self.get_policy({"max_attempts": 2})["max_attempts"], 1)
+
+    def test_backoff_capped(self):
+        policyd = self.get_policy({"backoff": 10, "backoff_max": 60, "jitter": 0})
+        self.assertEqual([rmirr.get_retry_delay(policyd, attempt) for attempt in range(1, 6)],
+            [10, 20, 40, 60, 60])
+
+    def test_jitter_bounds(self):
+        policyd = self.get_policy({"backoff": 100, "jitter": 0.25})
+        delays = [rmirr.get_retry_delay(policyd, 1) for _ in range(200)]
+        self.assertTrue(min(delays) >= 75)
+        self.assertTrue(max(delays) <= 100)
+        self.assertTrue(max(delays)-min(delays) > 1)
+
+class RetryRunTest(unittest.TestCase):
+    """Runs rmirr with a stand-in rsync.
+    """
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.homepath = os.path.join(self.dirpath, "home")
+        self.srcpath = os.path.join(self.dirpath, "src")
+        self.logpath = os.path.join(self.dirpath, "rsync.log")
+        bindirpath = os.path.join(self.dirpath, "bin")
+        for path in [self.homepath, self.srcpath, bindirpath]:
+            os.mkdir(path)
+        rsyncpath = os.path.join(bindirpath, "rsync")
+        with open(rsyncpath, "w") as f:
+            f.write(FAKE_RSYNC % (self.logpath,))
+        os.chmod(rsyncpath, 0755)
+        self.env = dict(os.environ)
+        self.env.update({"HOME": self.homepath, "PATH": bindirpath+":"+os.environ["PATH"]})
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def run_rmirr(self, destinations, retryd, args=[]):
+        confd = {
+            "mirrors": [{
+                "name": "m",
+                "source": "%s@%s:%s" % (pwd.getpwuid(os.getuid()).pw_name, socket.getfqdn(), self.srcpath),
+                "destinations": destinations,
+                "retry": retryd,
+            }],
+            "defaults": {"health_check": False, "ssh_multiplex": False},
+        }
+        confpath = os.path.join(self.dirpath, "rmirr.json")
+        with open(confpath, "w") as f:
+            json.dump(confd, f)
+        p = subprocess.Popen([sys.executable, os.path.join(LIB_DIRPATH, "rmirr.py"), "-c", confpath, "-y"]
+            +args+["-p", self.srcpath], env=self.env, stdin=open(os.devnull),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out = p.communicate()[0]
+        self.assertEqual(p.returncode, 0, out)
+
+        countsd = dict([(dsthost, 0) for dsthost in destinations])
+        if os.path.exists(self.logpath):
+            for line in open(self.logpath):
+                countsd[line.strip()] += 1
+        return countsd
+
+    def test_only_failed_retried(self):
+        countsd = self.run_rmirr(["ok", "exit23"], {"max_attempts": 3, "backoff": 0})
+        self.assertEqual(countsd, {"ok": 1, "exit23": 3})
+
+    def test_not_retryable(self):
+        countsd = self.run_rmirr(["exit1", "exit23"], {"max_attempts": 3, "backoff": 0, "exit_codes": [23]})
+        self.assertEqual(countsd, {"exit1": 1, "exit23": 3})
+
+    def test_max_attempts_option(self):
+        countsd = self.run_rmirr(["exit23"], {"max_attempts": 3, "backoff": 0}, ["--max-attempts", "2"])
+        self.assertEqual(countsd, {"exit23": 2})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+#! /usr/bin/env python2
+#
+# test_rundb.py
+
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+import os
+import os.path
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "lib", "rmirr"))
+
+import rundb
+
+def make_run(**kwargs):
+    rund = {
+        "name": "m",
+        "mirrorpath": "/data",
+        "dsthost": "h1",
+        "started": 100.0,
+        "ended": 110.0,
+        "status": "ok",
+        "dryrun": False,
+        "stats": {"files_transferred": 3, "bytes_sent": 1000},
+    }
+    rund.update(kwargs)
+    return rund
+
+class RundbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirpath, "runs.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_schema(self):
+        rundb.query(self.path)
+        conn = sqlite3.connect(self.path)
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], rundb.SCHEMA_VERSION)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(runs)")]
+        self.assertEqual([column for column in rundb.COLUMNS if column not in columns], [])
+        conn.close()
+
+    def test_upgrade(self):
+        conn = sqlite3.connect(self.path)
+        for sql in rundb.MIGRATIONS[0][1]:
+            conn.execute(sql)
+        conn.execute("INSERT INTO runs (name, mirrorpath, dsthost, started, ended, status, dryrun) VALUES ('m', '/data', 'h1', 100.0, 110.0, 'ok', 0)")
+        conn.execute("PRAGMA user_version = 1")
+        conn.commit()
+        conn.close()
+        runs = rundb.query(self.path)
+        self.assertEqual([(rund["name"], rund["attempts"], rund["partial"]) for rund in runs], [("m", None, None)])
+        self.assertEqual(rundb.get_last_synced(self.path, "m", "/data/a", "h1"), 110.0)
+        conn = sqlite3.connect(self.path)
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], rundb.SCHEMA_VERSION)
+        conn.close()
+
+    def test_add_query(self):
+        id1 = rundb.add_run(self.path, make_run())
+        id2 = rundb.add_run(self.path, make_run(dsthost="h2", started=200.0, status="failed"))
+        self.assertNotEqual(id1, id2)
+        runs = rundb.query(self.path)
+        self.assertEqual([rund["dsthost"] for rund in runs], ["h2", "h1"])
+        self.assertEqual(runs[1]["stats"], {"files_transferred": 3, "bytes_sent": 1000})
+        self.assertEqual((runs[1]["files_transferred"], runs[1]["bytes_sent"]), (3, 1000))
+
+    def test_query_filters(self):
+        rundb.add_run(self.path, make_run())
+        rundb.add_run(self.path, make_run(dsthost="h2", started=200.0, status="failed"))
+        rundb.add_run(self.path, make_run(name="n", dsthost="h3", started=300.0))
+        self.assertEqual(len(rundb.query(self.path, name="m")), 2)
+        self.assertEqual([d["dsthost"] for d in rundb.query(self.path, dsthosts=["h1", "h3"])], ["h3", "h1"])
+        self.assertEqual([d["dsthost"] for d in rundb.query(self.path, since=150)], ["h3", "h2"])
+        self.assertEqual([d["dsthost"] for d in rundb.query(self.path, status="failed")], ["h2"])
+        self.assertEqual([d["dsthost"] for d in rundb.query(self.path, limit=1)], ["h3"])
+
+    def test_last_synced(self):
+        rundb.add_run(self.path, make_run(mirrorpath="/data", ended=110.0))
+        rundb.add_run(self.path, make_run(mirrorpath="/data/a", ended=120.0))
+        self.assertEqual(rundb.get_last_synced(self.path, "m", "/data", "h1"), 110.0)
+        self.assertEqual(rundb.get_last_synced(self.path, "m", "/data/a/b", "h1"), 120.0)
+        self.assertEqual(rundb.get_last_synced(self.path, "m", "/data/b", "h1"), 110.0)
+        self.assertEqual(rundb.get_last_synced(self.path, "m", "/data", "h2"), None)
+        self.assertEqual(rundb.get_last_synced(self.path, "n", "/data", "h1"), None)
+
+    def test_last_synced_not_sibling(self):
+        rundb.add_run(self.path, make_run(mirrorpath="/data/a_b"))
+        self.assertEqual(rundb.get_last_synced(self.path, "m", "/data/a_bc", "h1"), None)
+        self.assertEqual(rundb.get_last_synced(self.path, "m", "/data/axb/c", "h1"), None)
+        self.assertEqual(rundb.get_last_synced(self.path, "m", "/data/a_b/c", "h1"), 110.0)
+
+    def test_last_synced_case(self):
+        rundb.add_run(self.path, make_run(mirrorpath="/data/Foo"))
+        self.assertEqual(rundb.get_last_synced(self.path, "m", "/data/foo/c", "h1"), None)
+        self.assertEqual(rundb.get_last_synced(self.path, "m", "/data/Foo/c", "h1"), 110.0)
+
+    def test_last_synced_ok_only(self):
+        rundb.add_run(self.path, make_run(status="failed", ended=200.0))
+        rundb.add_run(self.path, make_run(dryrun=True, ended=300.0))
+        self.assertEqual(rundb.get_last_synced(self.path, "m", "/data", "h1"), None)
+
+    def test_last_synced_not_partial(self):
+        rundb.add_run(self.path, make_run(ended=110.0))
+        rundb.add_run(self.path, make_run(partial=True, ended=200.0))
+        self.assertEqual(rundb.get_last_synced(self.path, "m", "/data", "h1"), 110.0)
+
+if __name__ == "__main__":
+    unittest.main()
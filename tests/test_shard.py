@@ -0,0 +1,92 @@
+#! /usr/bin/env python2
+#
+# test_shard.py
+
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "lib", "rmirr"))
+
+import shard
+
+MB = 1000*1000
+
+class PlanTest(unittest.TestCase):
+
+    def test_balanced(self):
+        weightsd = {"": [10*MB, 0], "a": [4*MB, 0], "b": [3*MB, 0], "c": [2*MB, 0], "d": [1*MB, 0]}
+        self.assertEqual(shard.plan(weightsd, 2), [["a", "d"], ["b", "c"]])
+
+    def test_heavy_unit_split(self):
+        weightsd = {
+            "": [10*MB, 0],
+            "big": [8*MB, 0], "big/x": [4*MB, 0], "big/y": [4*MB, 0],
+            "small": [2*MB, 0],
+        }
+        shards = shard.plan(weightsd, 2)
+        self.assertEqual(sorted(sum(shards, [])), ["big/x", "big/y", "small"])
+        self.assertEqual(len(shards), 2)
+
+    def test_fewer_units_than_shards(self):
+        self.assertEqual(shard.plan({"": [1, 0], "a": [1, 0]}, 4), [["a"]])
+        self.assertEqual(shard.plan({"": [1, 0]}, 4), [])
+
+    def test_file_cost(self):
+        weightsd = {"": [0, 0], "many": [0, 100], "few": [0, 1], "one": [0, 1]}
+        self.assertEqual(shard.plan(weightsd, 2), [["many"], ["few", "one"]])
+
+class FilterArgsTest(unittest.TestCase):
+
+    def test_filter_args(self):
+        self.assertEqual(shard.get_filter_args(["a/b", "c*"]),
+            ["--include=/a/", "--include=/a/b/***", "--include=/c\\*/***", "--exclude=*"])
+        self.assertEqual(shard.get_root_filter_args(["a/b"]), ["--exclude=/a/b"])
+
+class WeightsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_scan(self):
+        os.makedirs(os.path.join(self.dirpath, "a", "b"))
+        open(os.path.join(self.dirpath, "a", "b", "f"), "w").write("x"*10)
+        open(os.path.join(self.dirpath, "g"), "w").write("x"*5)
+        weightsd = shard.scan(self.dirpath, 1)
+        self.assertEqual(weightsd[""], [15, 2])
+        self.assertEqual(weightsd["a"], [10, 1])
+        self.assertFalse("a/b" in weightsd)
+
+    def test_save_load(self):
+        path = os.path.join(self.dirpath, "weights.json")
+        shard.save_weights(path, {"": [1, 1]}, 1000)
+        self.assertEqual(shard.load_weights(path, 10, 1005), {"": [1, 1]})
+        self.assertEqual(shard.load_weights(path, 10, 1011), None)
+
+if __name__ == "__main__":
+    unittest.main()
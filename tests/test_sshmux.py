@@ -0,0 +1,100 @@
+#! /usr/bin/env python2
+#
+# test_sshmux.py
+
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "lib", "rmirr"))
+
+import sshmux
+
+# stands in for ssh: logs arguments, fails for "failhost"
+FAKE_RSH = """#! /bin/sh
+echo "$*" >> "%s"
+for arg; do host="$arg"; done
+[ "$host" != failhost ]
+"""
+
+class SshmuxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.logpath = os.path.join(self.dirpath, "rsh.log")
+        self.rsh = os.path.join(self.dirpath, "fakessh")
+        with open(self.rsh, "w") as f:
+            f.write(FAKE_RSH % (self.logpath,))
+        os.chmod(self.rsh, 0755)
+        sshmux._mastersd.clear()
+        sshmux._rsh = self.rsh
+
+    def tearDown(self):
+        sshmux._mastersd.clear()
+        shutil.rmtree(self.dirpath)
+
+    def get_calls(self):
+        if not os.path.exists(self.logpath):
+            return []
+        return open(self.logpath).read().splitlines()
+
+    def test_master_started_once(self):
+        rsh = sshmux.get_rsh(self.dirpath, "user@h1", self.rsh)
+        self.assertEqual(rsh, sshmux.get_rsh(self.dirpath, "user@h1", self.rsh))
+        controlpath = sshmux.get_control_path(self.dirpath, "user@h1")
+        self.assertEqual(rsh, "%s -o ControlMaster=no -o ControlPath=%s" % (self.rsh, controlpath))
+        calls = self.get_calls()
+        self.assertEqual(len(calls), 1)
+        self.assertTrue("ControlMaster=yes" in calls[0])
+        self.assertTrue("ControlPersist=%d" % sshmux.PERSIST in calls[0])
+        self.assertTrue(calls[0].endswith("-N -f user@h1"))
+
+    def test_master_failure(self):
+        self.assertEqual(sshmux.get_rsh(self.dirpath, "failhost", self.rsh), None)
+        self.assertEqual(sshmux.get_rsh(self.dirpath, "failhost", self.rsh), None)
+        self.assertEqual(len(self.get_calls()), 1)
+
+    def test_control_path_per_process(self):
+        controlpath = sshmux.get_control_path(self.dirpath, "user@h1")
+        self.assertNotEqual(controlpath, sshmux.get_control_path(self.dirpath, "user@h2"))
+        token = sshmux._token
+        try:
+            sshmux._token = "other"
+            self.assertNotEqual(controlpath, sshmux.get_control_path(self.dirpath, "user@h1"))
+        finally:
+            sshmux._token = token
+
+    def test_close_all(self):
+        sshmux.get_rsh(self.dirpath, "user@h1", self.rsh)
+        sshmux.get_rsh(self.dirpath, "failhost", self.rsh)
+        sshmux.close_all()
+        calls = self.get_calls()
+        self.assertEqual(len(calls), 3)
+        self.assertTrue(calls[2].endswith("-O exit user@h1"))
+        self.assertEqual(sshmux._mastersd, {})
+
+if __name__ == "__main__":
+    unittest.main()
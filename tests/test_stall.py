@@ -0,0 +1,253 @@
+#! /usr/bin/env python2
+#
+# test_stall.py
+
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+import io
+import logging
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "lib", "rmirr"))
+
+import globls
+import rmirr
+import stall
+
+class FakeProcess:
+    """Stands in for a running process: exits after lifetime seconds.
+    """
+
+    def __init__(self, pid, lifetime):
+        self.pid = pid
+        self.exittime = time.time()+lifetime
+
+    def poll(self):
+        if time.time() >= self.exittime:
+            return 0
+        return None
+
+class FakeProcIo:
+    """Stands in for /proc/<pid>/io, with rchar/wchar per pid.
+    """
+
+    def __init__(self):
+        self.charsd = {}
+
+    def __call__(self, path, *args):
+        pid = int(path.split("/")[2])
+        if pid not in self.charsd:
+            raise IOError("no such process")
+        return io.BytesIO("rchar: %s\nwchar: %s\nsyscr: 1\n" % self.charsd[pid])
+
+class StallWaitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.procio = FakeProcIo()
+        stall.open = self.procio
+
+    def tearDown(self):
+        del stall.open
+        shutil.rmtree(self.dirpath)
+
+    def open_output(self, name):
+        return open(os.path.join(self.dirpath, name), "w+")
+
+    def test_progress_signature(self):
+        f = self.open_output("out")
+        p = FakeProcess(1001, 10)
+        self.assertEqual(stall.get_progress(p, f), (0,))
+        self.procio.charsd[1001] = (10, 20)
+        self.assertEqual(stall.get_progress(p, f), (0, 10, 20))
+        f.write("x")
+        f.flush()
+        self.assertEqual(stall.get_progress(p, f), (1, 10, 20))
+
+    def test_exited(self):
+        reason, maxidle = stall.wait([FakeProcess(1001, 0.1)], [self.open_output("out")], 5, None)
+        self.assertEqual(reason, None)
+        self.assertTrue(maxidle < 1)
+
+    def test_stalled(self):
+        t0 = time.time()
+        reason, maxidle = stall.wait([FakeProcess(1001, 10)], [self.open_output("out")], 0.3, None)
+        self.assertEqual(reason, "stalled")
+        self.assertTrue(0.3 <= maxidle < 1)
+        self.assertTrue(time.time()-t0 < 2)
+
+    def test_io_is_progress(self):
+        # the output does not grow but the process reads and writes
+        p = FakeProcess(1001, 1)
+        self.procio.charsd[1001] = (0, 0)
+        f = self.open_output("out")
+        t0 = time.time()
+        orig_get_progress = stall.get_progress
+
+        def get_progress(p, f):
+            self.procio.charsd[1001] = (int((time.time()-t0)*100), 0)
+            return orig_get_progress(p, f)
+
+        stall.get_progress = get_progress
+        try:
+            reason, maxidle = stall.wait([p], [f], 0.5, None)
+        finally:
+            stall.get_progress = orig_get_progress
+        self.assertEqual(reason, None)
+        self.assertTrue(maxidle < 0.5)
+
+    def test_one_stalled_of_several(self):
+        procs = [FakeProcess(1001, 0.1), FakeProcess(1002, 10)]
+        files = [self.open_output("out1"), self.open_output("out2")]
+        reason, _ = stall.wait(procs, files, 0.3, None)
+        self.assertEqual(reason, "stalled")
+
+    def test_not_watched(self):
+        p = FakeProcess(1001, 0.2)
+        p.wait = lambda: time.sleep(p.exittime-time.time()) or 0
+        # not polled
+        orig_get_progress = stall.get_progress
+        stall.get_progress = None
+        try:
+            self.assertEqual(stall.wait([p], [self.open_output("out")], None, None), (None, None))
+        finally:
+            stall.get_progress = orig_get_progress
+        self.assertEqual(p.poll(), 0)
+
+    def test_deadline(self):
+        t0 = time.time()
+        reason, _ = stall.wait([FakeProcess(1001, 10)], [self.open_output("out")], None, t0+0.3)
+        self.assertEqual(reason, "deadline")
+        self.assertTrue(0.3 <= time.time()-t0 < 2)
+
+class TerminateTest(unittest.TestCase):
+
+    def test_terminate(self):
+        p = subprocess.Popen(["sleep", "30"])
+        self.assertTrue(stall.terminate([p], 5))
+        self.assertEqual(p.returncode, -15)
+
+    def test_kill_after_grace(self):
+        p = subprocess.Popen(["sh", "-c", "trap '' TERM; echo ready; sleep 30"], stdout=subprocess.PIPE)
+        p.stdout.readline()
+        t0 = time.time()
+        self.assertTrue(stall.terminate([p], 0.3))
+        self.assertEqual(p.returncode, -9)
+        self.assertTrue(time.time()-t0 >= 0.3)
+
+class RunRsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.showreport = globls.showreport
+        self.stdout = sys.stdout
+        globls.showreport = True
+        rmirr.logger = logging.getLogger("test_stall")
+        sys.stdout = io.BytesIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        globls.showreport = self.showreport
+        shutil.rmtree(self.dirpath)
+
+    def test_terminated_report_not_written(self):
+        # a child keeps the output open after rsync is killed
+        transferd = {
+            "deadline": time.time()+0.3,
+            "dsthost": "h1",
+            "dstuserhostpath": "h1:/data",
+            "prefix": "",
+            "stall": {"timeout": None, "grace": 0.2, "max_runtime": 0},
+        }
+        repf = open(os.path.join(self.dirpath, "report"), "w+")
+        returncode = rmirr.run_rsync(transferd,
+            ["sh", "-c", "echo early; (sleep 1; echo late) & exec sleep 30"], repf)
+        self.assertEqual(returncode, rmirr.STALL_EXIT_CODE)
+        time.sleep(1.5)
+        repf.seek(0)
+        report = repf.read()
+        repf.close()
+        self.assertTrue(report.startswith("early\n"))
+        self.assertTrue("rmirr: terminated (deadline)" in report)
+        self.assertFalse("late" in report)
+
+class StallPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.idle_filepath = rmirr.IDLE_FILEPATH
+        rmirr.IDLE_FILEPATH = os.path.join(self.dirpath, "idle.json")
+        globls.defaultsd = {}
+        globls.stalltimeout = None
+        globls.maxruntime = None
+
+    def tearDown(self):
+        rmirr.IDLE_FILEPATH = self.idle_filepath
+        globls.stalltimeout = None
+        globls.maxruntime = None
+        shutil.rmtree(self.dirpath)
+
+    def get_policy(self, stalld, idle=None, **kwargs):
+        transferd = {"dsthost": "h1", "mirrorpath": "/data", "mirrord": {"stall": stalld}}
+        transferd["mirrord"].update(kwargs)
+        if idle != None:
+            with open(rmirr.IDLE_FILEPATH, "w") as f:
+                f.write('{"h1:/data": %s}' % (idle,))
+        return rmirr.get_stall_policy(transferd)
+
+    def test_fixed(self):
+        policyd = self.get_policy({"timeout": "10m", "grace": 3})
+        self.assertEqual((policyd["timeout"], policyd["grace"]), (600, 3))
+        self.assertEqual(self.get_policy({"timeout": "off"})["timeout"], None)
+        self.assertEqual(self.get_policy({"timeout": "0"})["timeout"], None)
+
+    def test_default_off(self):
+        self.assertEqual(self.get_policy({})["timeout"], None)
+
+    def test_auto_without_history(self):
+        self.assertEqual(self.get_policy({"timeout": "auto"})["timeout"], 1800)
+        self.assertEqual(self.get_policy({"timeout": "auto", "default": "1h"})["timeout"], 3600)
+
+    def test_auto_from_history(self):
+        self.assertEqual(self.get_policy({"timeout": "auto"}, idle=200)["timeout"], 800)
+        self.assertEqual(self.get_policy({"timeout": "auto", "factor": 2}, idle=200)["timeout"], 400)
+        # at least "min"
+        self.assertEqual(self.get_policy({"timeout": "auto"}, idle=10)["timeout"], 300)
+
+    def test_options_override(self):
+        globls.stalltimeout = "off"
+        self.assertEqual(self.get_policy({"timeout": "10m"})["timeout"], None)
+        globls.maxruntime = 60
+        self.assertEqual(self.get_policy({}, max_runtime="6h")["max_runtime"], 60)
+
+    def test_max_runtime(self):
+        self.assertEqual(self.get_policy({}, max_runtime="6h")["max_runtime"], 21600)
+        self.assertEqual(self.get_policy({})["max_runtime"], None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+#! /usr/bin/env python2
+#
+# test_verify.py
+
+
+# GPL--start
+# This file is part of rmirr
+# Copyright (C) 2018 John Marshall
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+import hashlib
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "lib", "rmirr"))
+
+import verify
+
+# stands in for ssh: runs the remote command locally
+FAKE_RSH = """#! /bin/sh
+shift
+exec sh -c "$*"
+"""
+
+class CompareTest(unittest.TestCase):
+
+    def test_compare(self):
+        cached = {"a": (1, 1.0, 1, "aa"), "b": (1, 1.0, 2, "bb"), "c": (1, 1.0, 3, "cc")}
+        remoted = {"a": "aa", "b": "xx"}
+        self.assertEqual(verify.compare(cached, ["a", "b", "c"], remoted), [("b", "differs"), ("c", "missing")])
+        self.assertEqual(verify.compare(cached, ["a"], remoted), [])
+
+    def test_sample(self):
+        relpaths = ["f%d" % i for i in range(1000)]
+        self.assertEqual(verify.sample(relpaths, 1, "s"), relpaths)
+        self.assertEqual(verify.sample(relpaths, 0.1, "s"), verify.sample(relpaths, 0.1, "s"))
+        self.assertTrue(50 < len(verify.sample(relpaths, 0.1, "s")) < 150)
+        self.assertNotEqual(verify.sample(relpaths, 0.1, "s"), verify.sample(relpaths, 0.1, "t"))
+
+    def test_is_excluded(self):
+        self.assertTrue(verify.is_excluded("a/.snapshot/f", [".snapshot"]))
+        self.assertTrue(verify.is_excluded("a/b.tmp", ["*.tmp"]))
+        self.assertTrue(verify.is_excluded("a/b/c", ["a/b"]))
+        self.assertTrue(verify.is_excluded("a/f", ["/a"]))
+        self.assertFalse(verify.is_excluded("x/a/f", ["/a"]))
+        self.assertFalse(verify.is_excluded("a/bc", ["b"]))
+
+class DigestsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.rsh = os.path.join(self.dirpath, "fakessh")
+        with open(self.rsh, "w") as f:
+            f.write(FAKE_RSH)
+        os.chmod(self.rsh, 0755)
+        self.dstpath = os.path.join(self.dirpath, "dst")
+        os.mkdir(self.dstpath)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def write(self, relpath, s):
+        path = os.path.join(self.dstpath, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(s)
+        return hashlib.sha1(s).hexdigest()
+
+    def test_remote_digests(self):
+        expectedd = {
+            "a": self.write("a", "1"),
+            "d/b c": self.write("d/b c", "2"),
+            "new\nline": self.write("new\nline", "3"),
+            "back\\slash": self.write("back\\slash", "4"),
+        }
+        remoted = verify.get_remote_digests([self.rsh], "h", self.dstpath, sorted(expectedd), "sha1")
+        self.assertEqual(remoted, expectedd)
+
+    def test_remote_digests_missing_files(self):
+        expectedd = {"a": self.write("a", "1")}
+        remoted = verify.get_remote_digests([self.rsh], "h", self.dstpath, ["a", "gone"], "sha1")
+        self.assertEqual(remoted, expectedd)
+
+    def test_remote_digests_no_dstpath(self):
+        self.assertRaises(Exception, verify.get_remote_digests,
+            [self.rsh], "h", os.path.join(self.dirpath, "nodst"), ["a"], "sha1")
+
+    def test_remote_digests_rsh_failure(self):
+        with open(self.rsh, "w") as f:
+            f.write("#! /bin/sh\nexit 255\n")
+        self.assertRaises(Exception, verify.get_remote_digests,
+            [self.rsh], "h", self.dstpath, ["a"], "sha1")
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.srcpath = os.path.join(self.dirpath, "src")
+        os.makedirs(os.path.join(self.srcpath, "d"))
+        open(os.path.join(self.srcpath, "d", "f"), "w").write("f")
+        open(os.path.join(self.srcpath, "g"), "w").write("g")
+        open(os.path.join(self.srcpath, "x.tmp"), "w").write("x")
+        os.symlink("g", os.path.join(self.srcpath, "l"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_update_cache(self):
+        cached = {}
+        relpaths, nhashed = verify.update_cache(cached, self.srcpath, "", ["*.tmp"], "sha1", 2)
+        self.assertEqual((sorted(relpaths), nhashed), (["d/f", "g"], 2))
+        self.assertEqual(cached["g"][3], hashlib.sha1("g").hexdigest())
+
+        # unchanged files are not hashed again; removed ones are dropped
+        os.remove(os.path.join(self.srcpath, "g"))
+        relpaths, nhashed = verify.update_cache(cached, self.srcpath, "", ["*.tmp"], "sha1", 2)
+        self.assertEqual((relpaths, nhashed), (["d/f"], 0))
+        self.assertEqual(sorted(cached), ["d/f"])
+
+    def test_update_cache_prefix(self):
+        cached = {"other/f": (1, 1.0, 1, "x")}
+        relpaths, _ = verify.update_cache(cached, os.path.join(self.srcpath, "d"), "d", [], "sha1", 1)
+        self.assertEqual(relpaths, ["d/f"])
+        self.assertEqual(sorted(cached), ["d/f", "other/f"])
+
+    def test_save_load(self):
+        path = os.path.join(self.dirpath, "cache")
+        verify.save_cache(path, {"a": (1, 1.0, 1, "aa")})
+        self.assertEqual(verify.load_cache(path), {"a": (1, 1.0, 1, "aa")})
+        self.assertEqual(verify.load_cache(os.path.join(self.dirpath, "nope")), {})
+
+if __name__ == "__main__":
+    unittest.main()